@@ -0,0 +1,292 @@
+"""
+Evaluation of many positions at once with NumPy
+
+Positions are encoded as rows of a (positions, 64) array of piece codes, and evaluation.evaluate_full is computed for
+the whole batch with array operations, so the cost of the Python interpreter is paid once per batch rather than once
+per square. The attacks of a sliding piece are found by gathering the squares along each of its rays and cutting each
+ray off after its first blocker.
+
+Boards can be encoded from engines, or straight from the bytes of a file of packed positions (see packing.py) without
+unpacking each position. NumPy isn't needed by the rest of the program, this module is for offline analysis and for
+scoring all the children of a node at once.
+
+usage:
+    python src/batch_evaluation.py                        # benchmark on positions from random games
+    python src/batch_evaluation.py positions.bin --batch-size 4096
+"""
+import argparse
+import random
+import sys
+import time
+
+import numpy as np
+
+import engine
+import evaluation
+from bitboard import KING_ATTACKS, KNIGHT_ATTACKS, iter_squares
+from evaluation import KING_SHIELDS, KING_ZONE_ATTACK, MOBILITY_WEIGHTS, SHIELD_BONUS, SQUARE_VALUES
+from packing import CODE_PIECES, PIECE_CODES, POSITION_SIZE
+
+EMPTY = len(CODE_PIECES)  # the code of an empty square, after the codes of the pieces
+OFF_BOARD = 64  # the padding of square lists, an extra column of each per-square array that is always empty
+BATCH_SIZE = 4096  # positions evaluated together, larger batches are split to bound the memory of the arrays
+
+_WHITE_KING = PIECE_CODES['wk']
+_BLACK_KING = PIECE_CODES['bk']
+_WHITE_PAWN = PIECE_CODES['wp']
+_BLACK_PAWN = PIECE_CODES['bp']
+
+
+def _pad(squares, width) -> list:
+    squares = list(squares)
+    return squares + [OFF_BOARD] * (width - len(squares))
+
+
+def _ray(sq, r_step, c_step) -> list:
+    row, col = sq >> 3, sq & 7
+    squares = []
+    while 0 <= row + r_step < 8 and 0 <= col + c_step < 8:
+        row, col = row + r_step, col + c_step
+        squares.append(row * 8 + col)
+    return squares
+
+
+# the squares along each ray from each square, nearest first, rook directions then bishop directions
+_DIRECTIONS = ((-1, 0), (0, 1), (1, 0), (0, -1), (-1, -1), (-1, 1), (1, 1), (1, -1))
+RAYS = np.array([[_pad(_ray(sq, r_step, c_step), 7) for r_step, c_step in _DIRECTIONS] for sq in range(64)])
+KNIGHT_TARGETS = np.array([_pad(iter_squares(KNIGHT_ATTACKS[sq]), 8) for sq in range(64)])
+KING_ZONES = np.array([[bool(KING_ATTACKS[king] >> sq & 1) for sq in range(64)] + [False] for king in range(64)])
+SHIELDS = {color: np.array([_pad(iter_squares(KING_SHIELDS[color][king]), 3) for king in range(64)])
+           for color in 'wb'}
+
+# for each piece code: its value on each square from white's point of view, the weight of its mobility from white's
+# point of view, which of the 8 directions it slides in, and whether it is a knight
+VALUES = np.zeros((EMPTY + 1, 64), dtype=np.int32)
+MOBILITY = np.zeros(EMPTY + 1, dtype=np.int32)
+SLIDES = np.zeros((EMPTY + 1, 8), dtype=bool)
+KNIGHTS = np.zeros(EMPTY + 1, dtype=bool)
+for _code, _piece in enumerate(CODE_PIECES):
+    _sign = 1 if _piece[0] == 'w' else -1
+    VALUES[_code] = [_sign * value for value in SQUARE_VALUES[_piece]]
+    MOBILITY[_code] = _sign * MOBILITY_WEIGHTS.get(_piece[1], 0)
+    SLIDES[_code, :4] = _piece[1] in 'rq'
+    SLIDES[_code, 4:] = _piece[1] in 'bq'
+    KNIGHTS[_code] = _piece[1] == 'n'
+
+
+def encode(engines) -> tuple:
+    """
+    Encode the positions of engines
+
+    :param engines: an iterable of engines
+    :return: tuple: the (positions, 64) array of piece codes and the array of colors to move, 1 when black is to move
+    """
+
+    codes = {**PIECE_CODES, '--': EMPTY}
+    boards, colors = [], []
+    for chess_engine in engines:
+        boards.append([codes[piece] for piece in chess_engine.squares])
+        colors.append(chess_engine.current_color == 'b')
+    return np.array(boards, dtype=np.int8).reshape(-1, 64), np.array(colors, dtype=np.int8)
+
+
+def encode_packed(data) -> tuple:
+    """
+    Encode packed positions without unpacking them one at a time
+
+    :param data: the bytes of one or more positions packed by packing.pack, such as a file read into memory
+    :return: tuple: the (positions, 64) array of piece codes and the array of colors to move, like encode
+    """
+
+    packed = np.frombuffer(data, dtype=np.uint8).reshape(-1, POSITION_SIZE)
+    # the bitboard is big-endian, so the last byte holds squares 0-7 with square 0 in its lowest bit
+    occupied = np.unpackbits(packed[:, 7::-1], axis=1, bitorder='little').astype(bool)
+    nibbles = packed[:, 8:24]
+    codes = np.stack((nibbles >> 4, nibbles & 15), axis=2).reshape(-1, 32)
+
+    # the code of an occupied square is at its rank among the occupied squares
+    ranks = np.minimum(np.cumsum(occupied, axis=1) - 1, 31)
+    boards = np.where(occupied, np.take_along_axis(codes, np.maximum(ranks, 0), axis=1), EMPTY)
+    return boards.astype(np.int8), (packed[:, 24] & 1).astype(np.int8)
+
+
+def evaluate_batch(boards, colors) -> np.ndarray:
+    """
+    Score encoded positions, the same as evaluation.evaluate_full
+
+    :param boards: np.ndarray: the (positions, 64) array of piece codes
+    :param colors: np.ndarray: the colors to move, 1 when black is to move
+    :return: np.ndarray: the score of each position in centipawns, positive when the side to move is better
+    """
+
+    scores = np.empty(len(boards), dtype=np.int32)
+    for start in range(0, len(boards), BATCH_SIZE):
+        end = start + BATCH_SIZE
+        scores[start:end] = _evaluate(boards[start:end], colors[start:end])
+    return scores
+
+
+def _evaluate(boards, colors) -> np.ndarray:
+    count = len(boards)
+    boards = boards.astype(np.intp)
+    padded = np.concatenate((boards, np.full((count, 1), EMPTY)), axis=1)  # OFF_BOARD is an empty square
+
+    score = VALUES[boards, np.arange(64)].sum(axis=1)
+
+    # pawns in front of their own king
+    rows = np.arange(count)[:, None]
+    white_king = np.argmax(boards == _WHITE_KING, axis=1)
+    black_king = np.argmax(boards == _BLACK_KING, axis=1)
+    score += SHIELD_BONUS * ((padded[rows, SHIELDS['w'][white_king]] == _WHITE_PAWN).sum(axis=1) -
+                             (padded[rows, SHIELDS['b'][black_king]] == _BLACK_PAWN).sum(axis=1))
+
+    # only the squares holding sliders are looked along, and a ray square is attacked when no square before it on the
+    # ray is occupied
+    positions, squares = np.nonzero(SLIDES[boards].any(axis=2))
+    rays = RAYS[squares]
+    targets = padded[positions[:, None, None], rays]
+    occupied = targets < EMPTY
+    blocked = np.cumsum(occupied, axis=2) - occupied > 0
+    codes = boards[positions, squares]
+    attacks = ~blocked & SLIDES[codes][:, :, None] & (rays < OFF_BOARD)
+    score += _attack_scores(count, positions, codes, rays, targets, attacks, white_king, black_king)
+
+    positions, squares = np.nonzero(KNIGHTS[boards])
+    jumps = KNIGHT_TARGETS[squares]
+    score += _attack_scores(count, positions, boards[positions, squares], jumps, padded[positions[:, None], jumps],
+                            jumps < OFF_BOARD, white_king, black_king)
+
+    return np.where(colors == 1, -score, score).astype(np.int32)
+
+
+def _attack_scores(count, positions, codes, squares, targets, attacks, white_king, black_king) -> np.ndarray:
+    """
+    Score the mobility of pieces and their attacks next to the enemy king
+
+    :param count: int: the number of positions
+    :param positions: np.ndarray: the position of each piece
+    :param codes: np.ndarray: the code of each piece
+    :param squares: np.ndarray: the squares each piece looks at, one row per piece
+    :param targets: np.ndarray: the codes on those squares
+    :param attacks: np.ndarray: whether each of those squares is attacked
+    :param white_king: np.ndarray: the square of the white king of each position
+    :param black_king: np.ndarray: the square of the black king of each position
+    :return: np.ndarray: the score of each position from white's point of view
+    """
+
+    white = codes < EMPTY // 2
+    shape = (-1,) + (1,) * (attacks.ndim - 1)
+    own = np.where(white.reshape(shape), targets < EMPTY // 2, (targets >= EMPTY // 2) & (targets < EMPTY))
+    mobility = (attacks & ~own).reshape(len(codes), -1).sum(axis=1)
+
+    zones = KING_ZONES[np.where(white, black_king[positions], white_king[positions])]
+    in_zone = np.take_along_axis(zones, squares.reshape(len(codes), -1), axis=1)
+    zone_attacks = (attacks.reshape(len(codes), -1) & in_zone).sum(axis=1)
+
+    piece_scores = MOBILITY[codes] * mobility + np.where(white, 1, -1) * KING_ZONE_ATTACK * zone_attacks
+    return np.bincount(positions, piece_scores, minlength=count).astype(np.int64)
+
+
+def evaluate_children(chess_engine, moves=None) -> list:
+    """
+    Score the position after each move in one batch
+
+    :param chess_engine: the engine holding the position, it is restored afterwards
+    :param moves: list: the packed moves to score, the legal moves by default
+    :return: list: the (move, score) pairs, with the scores from the point of view of the side to move before the move
+    """
+
+    if moves is None:
+        moves = chess_engine.move_generator.get_legal_moves()
+    if not moves:
+        return []
+
+    move_maker = chess_engine.move_maker
+    boards = []
+    for move in moves:
+        move_maker.apply_move(move, regenerate_moves=False)
+        boards.append(encode([chess_engine])[0][0])
+        move_maker.apply_move(is_undo=True, regenerate_moves=False)
+
+    # the children have the other side to move, and their scores are turned back to the side moving
+    colors = np.full(len(moves), chess_engine.current_color == 'w', dtype=np.int8)
+    return list(zip(moves, (-evaluate_batch(np.array(boards), colors)).tolist()))
+
+
+def random_positions(count, seed=0, max_plies=80) -> list:
+    """
+    Play random games from the start position and pack a position from each ply
+
+    :param count: int: the number of positions
+    :param seed: int: the seed of the random moves
+    :param max_plies: int: the longest game before starting a new one
+    :return: list: the packed positions
+    """
+
+    import packing
+    from perft import START_FEN
+
+    rng = random.Random(seed)
+    chess_engine = engine.Engine()
+    positions = []
+    while len(positions) < count:
+        chess_engine.set_fen(START_FEN)
+        for _ in range(max_plies):
+            moves = chess_engine.move_generator.get_legal_moves()
+            if not moves or len(positions) == count:
+                break
+            chess_engine.move_maker.apply_move(rng.choice(moves), regenerate_moves=False)
+            positions.append(packing.pack(chess_engine))
+    return positions
+
+
+def report(name, count, seconds) -> None:
+    seconds = max(seconds, 1e-9)
+    print(f"{name}: {count / seconds:.0f} positions/s ({seconds:.3f}s)")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark single and batched evaluation of positions.')
+    parser.add_argument('path', nargs='?', help='a file of packed positions, positions from random games by default')
+    parser.add_argument('--count', type=int, default=20_000, help='positions from random games (default: 20000)')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help=f"positions per call (default: {BATCH_SIZE})")
+    args = parser.parse_args(argv)
+
+    if args.path:
+        with open(args.path, 'rb') as file:
+            data = file.read()
+    else:
+        data = b''.join(random_positions(args.count))
+    count = len(data) // POSITION_SIZE
+    print(f"{count} positions")
+
+    # one position at a time in Python, the reference the batches are checked against
+    chess_engine = engine.Engine()
+    start = time.perf_counter()
+    expected = []
+    for i in range(count):
+        chess_engine.set_position(data[i * POSITION_SIZE:(i + 1) * POSITION_SIZE])
+        expected.append(evaluation.evaluate_full(chess_engine))
+    report('evaluate_full, single', count, time.perf_counter() - start)
+
+    single_count = min(count, 2000)
+    start = time.perf_counter()
+    for i in range(single_count):
+        evaluate_batch(*encode_packed(data[i * POSITION_SIZE:(i + 1) * POSITION_SIZE]))
+    report('evaluate_batch, single', single_count, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    scores = []
+    step = args.batch_size * POSITION_SIZE
+    for offset in range(0, len(data) - len(data) % POSITION_SIZE, step):
+        scores.extend(evaluate_batch(*encode_packed(data[offset:offset + step])).tolist())
+    report(f"evaluate_batch, {args.batch_size} at a time", count, time.perf_counter() - start)
+
+    mismatches = sum(a != b for a, b in zip(expected, scores))
+    print(f"{mismatches} scores differ from evaluate_full")
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
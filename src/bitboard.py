@@ -0,0 +1,182 @@
+"""
+Bitboard helpers and attack tables
+
+Squares are numbered 0-63 in the same order as the rows and columns of the board, so square 0 is a8 (row 0, column 0)
+and square 63 is h1 (row 7, column 7). Bit n of a bitboard is set when square n is in the set. The tables are built
+once when the module is imported.
+"""
+import itertools
+
+FULL = (1 << 64) - 1
+
+POS = tuple((sq // 8, sq % 8) for sq in range(64))
+BIT = tuple(1 << sq for sq in range(64))
+
+FILE_A = sum(BIT[row * 8] for row in range(8))
+FILE_H = FILE_A << 7
+NOT_FILE_A = FULL ^ FILE_A
+NOT_FILE_H = FULL ^ FILE_H
+ROWS = tuple(0xff << (row * 8) for row in range(8))
+
+
+def square(row, col) -> int:
+    """Return the square index of a row, column position"""
+
+    return row * 8 + col
+
+
+def iter_squares(bb):
+    """
+    Yield the index of each square in a bitboard, lowest first
+
+    :param bb: int: the bitboard to scan
+    """
+
+    while bb:
+        low = bb & -bb
+        yield low.bit_length() - 1
+        bb ^= low
+
+
+def _step_targets(sq, steps) -> int:
+    row, col = POS[sq]
+    targets = 0
+    for r_step, c_step in steps:
+        r, c = row + r_step, col + c_step
+        if 0 <= r <= 7 and 0 <= c <= 7:
+            targets |= BIT[square(r, c)]
+    return targets
+
+
+def _ray(sq, r_step, c_step) -> int:
+    row, col = POS[sq]
+    ray = 0
+    while 0 <= (row := row + r_step) <= 7 and 0 <= (col := col + c_step) <= 7:
+        ray |= BIT[square(row, col)]
+    return ray
+
+
+KNIGHT_STEPS = ((-1, -2), (1, -2), (-2, -1), (-2, 1), (-1, 2), (1, 2), (2, 1), (2, -1))
+KING_STEPS = ((-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1))
+
+KNIGHT_ATTACKS = tuple(_step_targets(sq, KNIGHT_STEPS) for sq in range(64))
+KING_ATTACKS = tuple(_step_targets(sq, KING_STEPS) for sq in range(64))
+# the squares attacked by a pawn of the given color standing on a square
+PAWN_ATTACKS = {
+    'w': tuple(_step_targets(sq, ((-1, -1), (-1, 1))) for sq in range(64)),
+    'b': tuple(_step_targets(sq, ((1, -1), (1, 1))) for sq in range(64))
+}
+
+# (rays, positive) pairs, a positive ray runs towards higher square indexes so its nearest square is its lowest bit
+ROOK_RAYS = tuple(
+    (tuple(_ray(sq, r_step, c_step) for sq in range(64)), r_step * 8 + c_step > 0)
+    for r_step, c_step in ((-1, 0), (0, 1), (1, 0), (0, -1))
+)
+BISHOP_RAYS = tuple(
+    (tuple(_ray(sq, r_step, c_step) for sq in range(64)), r_step * 8 + c_step > 0)
+    for r_step, c_step in ((-1, -1), (-1, 1), (1, 1), (1, -1))
+)
+
+
+def _lines():
+    between = [[0] * 64 for _ in range(64)]
+    line = [[0] * 64 for _ in range(64)]
+    for sq in range(64):
+        for r_step, c_step in KING_STEPS:
+            full_line = _ray(sq, r_step, c_step) | _ray(sq, -r_step, -c_step) | BIT[sq]
+            row, col = POS[sq]
+            squares_between = 0
+            while 0 <= (row := row + r_step) <= 7 and 0 <= (col := col + c_step) <= 7:
+                target = square(row, col)
+                between[sq][target] = squares_between
+                line[sq][target] = full_line
+                squares_between |= BIT[target]
+    return tuple(map(tuple, between)), tuple(map(tuple, line))
+
+
+# BETWEEN[a][b] holds the squares strictly between two squares on a shared rank, file or diagonal, and LINE[a][b] the
+# whole line through both of them. Both are empty for squares that don't share a line.
+BETWEEN, LINE = _lines()
+
+
+def _sliding_attacks(sq, occupied, directions) -> int:
+    attacks = 0
+    for rays, positive in directions:
+        ray = rays[sq]
+        blockers = ray & occupied
+        if blockers:
+            if positive:
+                blocker = (blockers & -blockers).bit_length() - 1
+            else:
+                blocker = blockers.bit_length() - 1
+            # cut the ray off behind the nearest blocker, the blocker itself stays attacked
+            ray ^= rays[blocker]
+        attacks |= ray
+    return attacks
+
+
+def _attack_tables(directions) -> tuple:
+    """
+    Find the attacks of a slider for every arrangement of the pieces that can block it
+
+    Only the squares on the slider's rays can block it, apart from the last square of each ray, which is attacked
+    whether or not it is occupied. The attacks of each square are stored in a dict keyed by the occupancy of its
+    blocking squares, so looking them up takes a mask and a dict lookup instead of a scan along each ray.
+
+    Each ray is cut off independently of the others, so the attacks along each ray are found for each arrangement of
+    its own blockers, and the table combines one arrangement of every ray. This keeps the tables quick to build when
+    the module is imported.
+
+    :return: tuple: the mask of blocking squares of each square, and the dict of attacks of each square
+    """
+
+    masks = []
+    tables = []
+    shared = {}  # different arrangements often have the same attacks, they share one int
+    for sq in range(64):
+        mask = 0
+        ray_options = []  # the (blockers, attacks) pairs of each ray
+        for rays, positive in directions:
+            ray = rays[sq]
+            if not ray:
+                continue
+            edge = ray.bit_length() - 1 if positive else (ray & -ray).bit_length() - 1
+            ray_mask = ray ^ BIT[edge]
+            mask |= ray_mask
+
+            # visit every subset of the ray's mask, the carry of the subtraction steps to the next one
+            options = []
+            blockers = 0
+            while True:
+                options.append((blockers, _sliding_attacks(sq, blockers, ((rays, positive),))))
+                blockers = (blockers - ray_mask) & ray_mask
+                if not blockers:
+                    break
+            ray_options.append(options)
+
+        table = {}
+        for combination in itertools.product(*ray_options):
+            blockers = attacks = 0
+            for ray_blockers, ray_attacks in combination:
+                blockers |= ray_blockers
+                attacks |= ray_attacks
+            table[blockers] = shared.setdefault(attacks, attacks)
+        masks.append(mask)
+        tables.append(table)
+    return tuple(masks), tuple(tables)
+
+
+ROOK_MASKS, ROOK_TABLES = _attack_tables(ROOK_RAYS)
+BISHOP_MASKS, BISHOP_TABLES = _attack_tables(BISHOP_RAYS)
+
+
+def rook_attacks(sq, occupied) -> int:
+    """Return the squares attacked by a rook on sq, stopping at the first occupied square in each direction"""
+
+    return ROOK_TABLES[sq][occupied & ROOK_MASKS[sq]]
+
+
+def bishop_attacks(sq, occupied) -> int:
+    """Return the squares attacked by a bishop on sq, stopping at the first occupied square in each direction"""
+
+    return BISHOP_TABLES[sq][occupied & BISHOP_MASKS[sq]]
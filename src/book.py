@@ -0,0 +1,181 @@
+"""
+Opening book
+
+A book file is a sorted array of fixed-width entries, one for each move played from a position in the games it was
+built from. Each entry packs into ENTRY_SIZE bytes, with integers stored big-endian:
+
+    bytes 0-7    the Zobrist key of the position (see zobrist.py)
+    bytes 8-9    the packed move (see engine.py)
+    bytes 10-11  the weight, the number of games the move was played in, capped at 65535
+    bytes 12-15  the points the move scored, 2 for a win and 1 for a draw
+
+Entries are sorted by key and then by weight, highest first, so the moves of a position are next to each other and
+are found by a binary search over a memory map of the file, without reading the rest of it.
+
+usage:
+    python src/book.py build games.pgn book.bin --max-ply 20 --min-count 2
+    python src/book.py probe book.bin --fen "<fen>"
+"""
+import argparse
+import random
+import struct
+import sys
+
+import engine
+import packing
+import pgn
+from perft import START_FEN, format_move
+
+ENTRY_SIZE = 16
+_ENTRY = struct.Struct('>QHHI')
+_KEY = struct.Struct('>Q')
+MAX_WEIGHT = 0xffff
+
+# the points scored by the side that played a move, by result and by whether white played it
+_POINTS = {'1-0': (0, 2), '0-1': (2, 0), '1/2-1/2': (1, 1)}
+
+
+def build_book(games, max_ply=20, min_count=1, chess_engine=None) -> list:
+    """
+    Count the moves played from each position in the opening of each game
+
+    A game is followed until max_ply or its first move that can't be played.
+
+    :param games: an iterable of (tags, movetext) pairs, such as pgn.read_games
+    :param max_ply: int: the number of plies of each game to add
+    :param min_count: int: leave out moves played in fewer games than this
+    :param chess_engine: the engine to replay the games on, one is made when not given
+    :return: list: the sorted (key, move, weight, points) entries
+    """
+
+    chess_engine = chess_engine or engine.Engine()
+    move_generator = chess_engine.move_generator
+    move_maker = chess_engine.move_maker
+    counts = {}  # [games, points] for each (key, move)
+
+    for tags, movetext in games:
+        moves, result = pgn.split_movetext(movetext)
+        black_points, white_points = _POINTS.get(tags.get('Result', result), (0, 0))
+        try:
+            chess_engine.set_fen(tags.get('FEN', START_FEN))
+        except ValueError:
+            continue
+
+        for san in moves[:max_ply]:
+            try:
+                move = pgn.parse_san(chess_engine, san, move_generator.get_legal_moves())
+            except ValueError:
+                break
+            count = counts.setdefault((chess_engine.key, move), [0, 0])
+            count[0] += 1
+            count[1] += white_points if chess_engine.current_color == 'w' else black_points
+            move_maker.apply_move(move, regenerate_moves=False)
+
+    entries = [(key, move, min(games, MAX_WEIGHT), points)
+               for (key, move), (games, points) in counts.items() if games >= min_count]
+    entries.sort(key=lambda entry: (entry[0], -entry[2], entry[1]))
+    return entries
+
+
+def write_book(path, entries) -> None:
+    """
+    Write sorted entries to a book file
+
+    :param path: str: the path of the file, it is replaced
+    :param entries: an iterable of (key, move, weight, points) tuples, sorted as build_book sorts them
+    :return: None
+    """
+
+    with open(path, 'wb') as file:
+        for entry in entries:
+            file.write(_ENTRY.pack(*entry))
+
+
+class OpeningBook(packing.FixedWidthFile):
+    def __init__(self, path, rng=None):
+        """
+        :param path: str: the path of a book file written by write_book
+        :param rng: random.Random: the source of the weighted move choices, the random module by default
+        """
+
+        super().__init__(path, ENTRY_SIZE, 'entries')
+        self.rng = rng or random
+
+    def get_entries(self, key) -> list:
+        """
+        Find the book moves of a position
+
+        :param key: int: the Zobrist key of the position
+        :return: list: the (key, move, weight, points) entries of the position, highest weight first
+        """
+
+        data = self._map
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if _KEY.unpack_from(data, middle * ENTRY_SIZE)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        entries = []
+        for index in range(low, self._count):
+            entry = _ENTRY.unpack_from(data, index * ENTRY_SIZE)
+            if entry[0] != key:
+                break
+            entries.append(entry)
+        return entries
+
+    def pick_move(self, chess_engine):
+        """
+        Choose a book move for the engine's position, with each move as likely as its weight
+
+        :param chess_engine: the engine holding the position
+        :return: int: the packed move, or None if the position isn't in the book
+        """
+
+        # a move must be legal, in case another position has the same key
+        legal_moves = set(chess_engine.move_generator.get_legal_moves())
+        entries = [entry for entry in self.get_entries(chess_engine.key) if entry[1] in legal_moves]
+        if not entries:
+            return None
+        return self.rng.choices([entry[1] for entry in entries], [entry[2] for entry in entries])[0]
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Build or look up an opening book.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = commands.add_parser('build', help='build a book from a PGN file')
+    build_parser.add_argument('pgn', help='the PGN file')
+    build_parser.add_argument('book', help='the book file to write')
+    build_parser.add_argument('--max-ply', type=int, default=20, help='plies of each game to add (default: 20)')
+    build_parser.add_argument('--min-count', type=int, default=1,
+                              help='leave out moves played in fewer games (default: 1)')
+
+    probe_parser = commands.add_parser('probe', help='print the book moves of a position')
+    probe_parser.add_argument('book', help='the book file')
+    probe_parser.add_argument('--fen', default=START_FEN, help='the position (default: start position)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        with open(args.pgn, encoding='utf-8', errors='replace') as file:
+            entries = build_book(pgn.read_games(file), args.max_ply, args.min_count)
+        write_book(args.book, entries)
+        print(f"{len(entries)} entries, {len({entry[0] for entry in entries})} positions")
+        return 0
+
+    chess_engine = engine.Engine()
+    chess_engine.set_fen(args.fen)
+    with OpeningBook(args.book) as book:
+        entries = book.get_entries(chess_engine.key)
+    total = sum(entry[2] for entry in entries)
+    for _, move, weight, points in entries:
+        print(f"{format_move(move)}  weight {weight} ({weight / total:.1%})  score {points / (2 * weight):.1%}")
+    if not entries:
+        print('position not in book')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
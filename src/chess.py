@@ -1,14 +1,25 @@
 import pygame as pg
+import argparse
 import sys
 
 import ui
+import book
 import engine
+import history
+import perft
+import profiler
+import search
+import tablebase
+import worker
 
+# the progress and moves of the background search, posted from the worker thread
+ENGINE_EVENT = pg.event.custom_type()
+HANDLED_EVENTS = [pg.QUIT, pg.VIDEOEXPOSE, pg.WINDOWEXPOSED, pg.MOUSEBUTTONDOWN, pg.KEYDOWN, ENGINE_EVENT]
 
-class Chess:
-    def __init__(self):
-        self.clock = pg.time.Clock()
 
+class Chess:
+    def __init__(self, computer_color=None, think_time=2.0, ponder=False, analyze=False, profile=False,
+                 profile_path=None, book_path=None, tablebase_dir=None):
         self.display = pg.display.set_mode((680, 680))
         pg.display.set_caption('PyChess')
         pg.display.set_icon(pg.image.load('src/images/icon.png').convert_alpha())
@@ -16,30 +27,167 @@ class Chess:
         self.rect = self.display.get_rect()
 
         self.engine = engine.Engine(self)
+        # every move goes through the history, for undo, redo and the draw rules
+        self.history = history.GameHistory(self.engine)
         self.board_ui = ui.BoardUI(self)
 
+        # the color played by the computer, or None for two players
+        self.computer_color = computer_color
+        self.think_time = think_time
+        self.ponder = ponder  # search on the player's time, expecting the reply the computer predicted
+        self.analyze = analyze  # search the player's positions and show the analysis
+
+        # searches run on a worker thread, so the window keeps responding while the computer thinks
+        # endings covered by the tablebase are scored exactly instead of by the evaluation
+        self.tablebase = tablebase.Tablebase(tablebase_dir) if tablebase_dir is not None else None
+        self.worker = worker.EngineWorker(self.post_progress, self.post_best_move, tablebase=self.tablebase)
+        self.search_id = None  # the id of the search whose results are used
+        self.search_kind = None  # 'move', 'ponder' or 'analysis'
+        self.searched_position = None  # the key and ply of the position the search was started for
+        self.ponder_move = None  # the player's reply that the computer expects
+        # the computer plays moves from the opening book without searching while the position is in it
+        self.book = book.OpeningBook(book_path) if book_path is not None else None
+
+        # counters and timers of the hot paths, shown over the board while enabled and written to profile_path on exit
+        self.profiler = profiler.Profiler()
+        profiler.attach_engine(self.profiler, self.engine)
+        profiler.attach_engine(self.profiler, self.worker.engine, 'search ')
+        self.profiler.attach(self.board_ui, 'draw', 'frame')
+        self.profile_path = profile_path
+        if profile:
+            self.profiler.enable()
+
     def run(self):
+        # only wake up for the events that are handled, mouse motion would otherwise wake the loop
+        pg.event.set_blocked(None)
+        pg.event.set_allowed(HANDLED_EVENTS)
         while True:
-            self.clock.tick(12)
-            self.check_events()
+            self.update_search()
             self.draw()
+            # sleep until there is input or search progress, then handle everything that is waiting
+            self.check_events([pg.event.wait()] + pg.event.get())
 
-    def check_events(self):
-        for event in pg.event.get():
+    def check_events(self, events):
+        for event in events:
             if event.type == pg.QUIT:
+                self.worker.close()
+                if self.profile_path is not None:
+                    self.profiler.export(self.profile_path)
                 sys.exit()
+            elif event.type in (pg.VIDEOEXPOSE, pg.WINDOWEXPOSED):
+                self.board_ui.invalidate()
+            elif event.type == ENGINE_EVENT:
+                self.handle_search_result(event)
             elif event.type == pg.MOUSEBUTTONDOWN:
-                self.board_ui.input.player_click()
+                if self.engine.current_color != self.computer_color and self.history.get_draw_reason() is None:
+                    self.board_ui.input.player_click()
             elif event.type == pg.KEYDOWN:
                 if event.key == pg.K_z:
-                    self.engine.move_maker.apply_move(is_undo=True)  # undo the last move taken
+                    self.ponder_move = None
+                    self.history.undo()  # undo the last move taken
+                    if self.computer_color is not None and self.engine.current_color == self.computer_color:
+                        self.history.undo()  # and the move before it, back to the player
+                elif event.key == pg.K_y:
+                    self.ponder_move = None
+                    self.history.redo()  # play the undone move again
+                    if self.computer_color is not None and self.engine.current_color == self.computer_color:
+                        self.history.redo()  # and the computer's reply, back to the player
+                elif event.key in (pg.K_HOME, pg.K_END):
+                    self.ponder_move = None
+                    self.history.go_to(0 if event.key == pg.K_HOME else len(self.history.moves))
+                elif event.key == pg.K_SPACE:
+                    self.worker.move_now()  # play the best move found so far
+                elif event.key == pg.K_p:
+                    self.profiler.toggle()
+                elif event.key == pg.K_a:
+                    self.analyze = not self.analyze
+                    self.searched_position = None  # start or stop the analysis
+
+    def post_progress(self, search_id, stats):
+        pg.event.post(pg.event.Event(ENGINE_EVENT, search_id=search_id, stats=stats, done=False, best_move=None))
+
+    def post_best_move(self, search_id, best_move, stats):
+        pg.event.post(pg.event.Event(ENGINE_EVENT, search_id=search_id, stats=stats, done=True, best_move=best_move))
+
+    def update_search(self):
+        """Start, redirect or stop the background search when the position on the board has changed"""
+
+        position_id = (self.engine.key, self.history.ply)
+        if position_id == self.searched_position:
+            return
+        self.searched_position = position_id
+        self.board_ui.analysis = None
+
+        chess_engine = self.engine
+        if not chess_engine.valid_moves or self.history.get_draw_reason() is not None:
+            self.worker.cancel()
+            self.search_id = None
+        elif chess_engine.current_color == self.computer_color:
+            book_move = self.book.pick_move(chess_engine) if self.book is not None else None
+            if book_move is not None:
+                self.worker.cancel()
+                self.search_id = None
+                self.ponder_move = None
+                self.history.push(book_move)
+                self.update_search()
+                return
+
+            # the running ponder search becomes the real search when the player made the expected move
+            last_move = self.history.get_last_move()
+            if not (self.search_kind == 'ponder' and last_move == self.ponder_move and self.worker.ponder_hit()):
+                self.search_id = self.worker.go(chess_engine.get_position(), self.think_time)
+            self.search_kind = 'move'
+        elif self.ponder and self.computer_color is not None and self.ponder_move in chess_engine.valid_moves:
+            self.search_id = self.worker.ponder(chess_engine.get_position(), self.ponder_move, self.think_time)
+            self.search_kind = 'ponder'
+        elif self.analyze:
+            self.search_id = self.worker.go(chess_engine.get_position())
+            self.search_kind = 'analysis'
+        else:
+            self.worker.cancel()
+            self.search_id = None
+
+    def handle_search_result(self, event):
+        position_id = (self.engine.key, self.history.ply)
+        if event.search_id != self.search_id or position_id != self.searched_position:
+            return  # the search was replaced, or the position changed before its event was handled
+
+        stats = event.stats
+        pv = ' '.join(map(perft.format_move, stats['pv'][:6]))
+        prefix = 'pondering ' if self.search_kind == 'ponder' else ''
+        self.board_ui.analysis = f"{prefix}depth {stats['depth']} {search.format_score(stats)} {pv}"
+
+        if event.done and self.search_kind == 'move':
+            self.play_computer_move(event.best_move, stats)
+
+    def play_computer_move(self, move, stats):
+        """Play the move found by the computer's search"""
+
+        self.ponder_move = stats['pv'][1] if len(stats['pv']) > 1 else None
+        self.search_id = None
+        self.history.push(move)
 
     def draw(self):
-        self.board_ui.draw()
-        pg.display.flip()
+        self.board_ui.profile = '\n'.join(self.profiler.format_lines()) if self.profiler.enabled else None
+        dirty_rects = self.board_ui.draw()
+        if dirty_rects:
+            pg.display.update(dirty_rects)
 
 
 if __name__ == '__main__':
-    chess = Chess()
+    parser = argparse.ArgumentParser(description='Play chess against another player or the computer.')
+    parser.add_argument('--computer', choices=('w', 'b'), help='the color played by the computer')
+    parser.add_argument('--think-time', type=float, default=2.0,
+                        help='seconds the computer may think about each move (default: 2)')
+    parser.add_argument('--ponder', action='store_true', help="let the computer think on the player's time")
+    parser.add_argument('--analyze', action='store_true', help='show live analysis of the position, toggled with A')
+    parser.add_argument('--book', metavar='PATH', help='an opening book for the computer, see book.py')
+    parser.add_argument('--tablebase', metavar='DIR', help='a directory of endgame tables, see tablebase.py')
+    parser.add_argument('--profile', action='store_true', help='start with profiling on, toggled with P')
+    parser.add_argument('--profile-out', metavar='PATH',
+                        help='write the profiling stats to a .json or .csv file on exit')
+    args = parser.parse_args()
+
+    chess = Chess(args.computer, args.think_time, args.ponder, args.analyze, args.profile, args.profile_out, args.book,
+                  args.tablebase)
     chess.run()
-    # cProfile.run("src.board_state.move_generator.test()")
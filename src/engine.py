@@ -1,8 +1,40 @@
+from bitboard import (
+    BETWEEN, BISHOP_MASKS, BISHOP_TABLES, BIT, FULL, KING_ATTACKS, KNIGHT_ATTACKS, LINE, NOT_FILE_A, NOT_FILE_H,
+    PAWN_ATTACKS, POS, ROOK_MASKS, ROOK_TABLES, ROWS, bishop_attacks, iter_squares, rook_attacks
+)
+import packing
+from zobrist import CASTLING_KEYS, EP_KEYS, PIECE_KEYS, SIDE_KEY, get_key
+
+# A move is packed into an int: bits 0-5 hold the starting square, bits 6-11 the target square and bits 12-15 a flag
+QUIET = 0
+DOUBLE_PUSH = 1
+CASTLE = 2
+EN_PASSANT = 3
+PROMOTE_N = 4  # a promotion flag is PROMOTE_N plus the index of the new piece in PROMOTION_PIECES
+PROMOTION_PIECES = 'nbrq'
+PROMOTION_FLAGS = (PROMOTE_N + 3, PROMOTE_N + 2, PROMOTE_N + 1, PROMOTE_N)
+PROMOTION_ROWS = ROWS[0] | ROWS[7]
+CAPTURE_ORDER = 'pnbrqk'  # the piece types from least to most valuable, for ordering captures
+
+# castling rights are a bit mask of white king side = 1, white queen side = 2, black king side = 4, black queen side = 8
+CASTLING_CHARS = 'KQkq'
+# the rights that are kept when a move starts or ends on each square, a king or rook that leaves its square loses them
+CASTLING_MASKS = tuple(
+    {0: 15 ^ 8, 4: 15 ^ 12, 7: 15 ^ 4, 56: 15 ^ 2, 60: 15 ^ 3, 63: 15 ^ 1}.get(sq, 15) for sq in range(64)
+)
+
+FEN_PIECES = {
+    'P': 'wp', 'N': 'wn', 'B': 'wb', 'R': 'wr', 'Q': 'wq', 'K': 'wk',
+    'p': 'bp', 'n': 'bn', 'b': 'bb', 'r': 'br', 'q': 'bq', 'k': 'bk'
+}
+PIECE_CHARS = {piece: char for char, piece in FEN_PIECES.items()}
+MAX_CLOCK = 0xffff  # the move clocks are packed into 16 bits, see packing.py
+
 
 class Engine:
-    def __init__(self, app):
-        self.app = app
-        self.board_array = [
+    def __init__(self, app=None):
+        self.app = app  # the engine does not depend on the app, so it can be built headless
+        board_array = [
             ['br', 'bn', 'bb', 'bq', 'bk', 'bb', 'bn', 'br'],
             ['bp', 'bp', 'bp', 'bp', 'bp', 'bp', 'bp', 'bp'],
             ['--', '--', '--', '--', '--', '--', '--', '--'],
@@ -12,41 +44,311 @@ class Engine:
             ['wp', 'wp', 'wp', 'wp', 'wp', 'wp', 'wp', 'wp'],
             ['wr', 'wn', 'wb', 'wq', 'wk', 'wb', 'wn', 'wr']
         ]
-        # create an 8x8 array to track changes to squares
-        self.num_changes = [[0] * 8 for _ in range(8)]
+        # the board is stored as one bitboard per piece and per color, along with the piece on each square
+        self.pieces = {f"{color}{piece_type}": 0 for color in 'wb' for piece_type in 'pnbrqk'}
+        self.occupied = {'w': 0, 'b': 0}
+        self.squares = ['--'] * 64
+        self.key = 0  # the Zobrist key of the position, kept up to date as the board changes
+        self.white_king_square = (7, 4)
+        self.black_king_square = (0, 4)
+        self.edit_board_array([((r, c), piece) for r, row in enumerate(board_array) for c, piece in enumerate(row)])
 
+        self.castling_rights = 15
         self.current_color = 'w'
         self.enemy_color = 'b'
-        self.white_king_square = (7, 4)
-        self.black_king_square = (0, 4)
 
         self.ep_square = ()
+        # the number of moves since the last capture or pawn move, and the number of the move being played
+        self.halfmove_clock = 0
+        self.fullmove_number = 1
+        self.key = get_key(self)
 
         self.move_generator = MoveGenerator(self)
         self.move_maker = MoveMaker(self)
 
+        # the undo stack, one (move, captured piece, en passant square, castling rights, halfmove clock, key) record
+        # per move made
         self.move_history = []
-        self.valid_moves = self.move_generator.get_legal_moves()
+        # the legal moves and the queries derived from them, kept until the moves are next generated
+        self.valid_moves = []
+        self.moves_by_square = {}
+        self.update_valid_moves()
+
+    @property
+    def board_array(self) -> list:
+        """
+        A copy of the board as 8 rows of 8 piece strings
+
+        Changes to the copy are not applied to the board, use edit_board_array to change the board.
+
+        :return: list: the rows of the board
+        """
+
+        return [self.squares[row * 8:row * 8 + 8] for row in range(8)]
+
+    def get_position(self) -> bytes:
+        """
+        Encode the position compactly, so that it can be stored or sent to another process and loaded with set_position
+
+        :return: bytes: the position packed into packing.POSITION_SIZE bytes
+        """
+
+        return packing.pack(self)
+
+    def set_position(self, position, regenerate_moves=True) -> None:
+        """
+        Replace the position with one encoded by get_position, clearing the move history
+
+        :param position: bytes: the packed position
+        :param regenerate_moves: bool: whether to update valid_moves, which only the UI needs
+        :return: None
+        """
+
+        self._set_up(*packing.unpack(position), regenerate_moves=regenerate_moves)
+
+    def get_fen(self) -> str:
+        """
+        :return: str: the position in Forsyth-Edwards notation
+        """
+
+        return f"{self.get_epd()} {self.halfmove_clock} {self.fullmove_number}"
+
+    def set_fen(self, fen) -> None:
+        """
+        Replace the position with one described in Forsyth-Edwards notation, clearing the move history
+
+        The move clocks may be left out, they default to 0 and 1.
+
+        :param fen: str: the position in Forsyth-Edwards notation
+        :return: None
+        """
+
+        fields = fen.split()
+        if len(fields) not in (4, 6):
+            raise ValueError(f"expected 4 or 6 fields in FEN: {fen!r}")
+        placements, color, castling_rights, ep_square = self._parse_fen_fields(fields[:4])
+        halfmove_clock, fullmove_number = (int(fields[4]), int(fields[5])) if len(fields) == 6 else (0, 1)
+        self._check_clocks(halfmove_clock, fullmove_number)
+        self._set_up(placements, color, ep_square, castling_rights, halfmove_clock, fullmove_number, check_legal=True)
+
+    def get_epd(self, operations=None) -> str:
+        """
+        Describe the position in Extended Position Description, which is a FEN without the move clocks followed by any
+        number of operations
+
+        :param operations: dict: operand strings by opcode, e.g. {'bm': 'Nf3', 'id': '"position 1"'}
+        :return: str: the position in EPD
+        """
+
+        rows = []
+        for row in range(8):
+            text = ''
+            empty = 0
+            for piece in self.squares[row * 8:row * 8 + 8]:
+                if piece == '--':
+                    empty += 1
+                    continue
+                if empty:
+                    text += str(empty)
+                    empty = 0
+                text += PIECE_CHARS[piece]
+            rows.append(text + str(empty) if empty else text)
+
+        castling = ''.join(char for i, char in enumerate(CASTLING_CHARS) if self.castling_rights >> i & 1) or '-'
+        if self.ep_square:
+            ep = f"{'abcdefgh'[self.ep_square[1]]}{8 - self.ep_square[0]}"
+        else:
+            ep = '-'
+
+        epd = f"{'/'.join(rows)} {self.current_color} {castling} {ep}"
+        for opcode, operand in (operations or {}).items():
+            epd += f" {opcode} {operand};" if operand != '' else f" {opcode};"
+        return epd
+
+    def set_epd(self, epd) -> dict:
+        """
+        Replace the position with one described in Extended Position Description, clearing the move history
+
+        The move clocks are taken from the hmvc and fmvn operations when present.
+
+        :param epd: str: the position in EPD
+        :return: dict: the operand strings of the operations by opcode, quotes are kept
+        """
+
+        fields = epd.split(None, 4)
+        if len(fields) < 4:
+            raise ValueError(f"expected at least 4 fields in EPD: {epd!r}")
+        placements, color, castling_rights, ep_square = self._parse_fen_fields(fields[:4])
+
+        operations = {}
+        text = fields[4] if len(fields) == 5 else ''
+        while text.strip():
+            operation, text = self._split_epd_operation(text.strip())
+            opcode, _, operand = operation.partition(' ')
+            operations[opcode] = operand.strip()
+
+        halfmove_clock = int(operations.get('hmvc', 0))
+        fullmove_number = int(operations.get('fmvn', 1))
+        self._check_clocks(halfmove_clock, fullmove_number)
+        self._set_up(placements, color, ep_square, castling_rights, halfmove_clock, fullmove_number, check_legal=True)
+        return operations
+
+    def set_fen_or_epd(self, line) -> dict:
+        """
+        Replace the position with one described in FEN or EPD, clearing the move history
+
+        :param line: str: the position in Forsyth-Edwards notation or Extended Position Description
+        :return: dict: the operand strings of the operations by opcode, empty for a FEN
+        """
+
+        fields = line.split()
+        # a FEN ends in its two move clocks, anything else after the first 4 fields is EPD operations
+        if len(fields) == 6 and fields[4].isdigit() and fields[5].isdigit():
+            self.set_fen(line)
+            return {}
+        return self.set_epd(line)
+
+    @staticmethod
+    def _split_epd_operation(text) -> tuple:
+        """Split the first operation off of the operations of an EPD, semicolons inside quotes don't end it"""
+
+        in_quotes = False
+        for i, char in enumerate(text):
+            if char == '"':
+                in_quotes = not in_quotes
+            elif char == ';' and not in_quotes:
+                return text[:i], text[i + 1:]
+        return text, ''
+
+    @staticmethod
+    def _parse_fen_fields(fields) -> tuple:
+        """
+        Parse the piece placement, color, castling and en passant fields that FEN and EPD share
+
+        :return: tuple: a list of (square, piece) pairs, the color to move, the castling rights and the en passant
+            square
+        """
+
+        placement, color, castling, ep = fields
+        rows = placement.split('/')
+        if len(rows) != 8 or color not in ('w', 'b'):
+            raise ValueError(f"invalid position: {' '.join(fields)!r}")
+
+        placements = []
+        for row, text in enumerate(rows):
+            col = 0
+            for char in text:
+                if char.isdigit():
+                    col += int(char)
+                elif char in FEN_PIECES:
+                    placements.append((row * 8 + col, FEN_PIECES[char]))
+                    col += 1
+                else:
+                    raise ValueError(f"invalid piece {char!r} in {placement!r}")
+            if col != 8:
+                raise ValueError(f"row {row + 1} of {placement!r} doesn't have 8 squares")
+
+        # the move generator and the packed format rely on one king of each color and at most 32 pieces
+        found = [piece for _, piece in placements]
+        if found.count('wk') != 1 or found.count('bk') != 1:
+            raise ValueError(f"expected one king of each color in {placement!r}")
+        if len(placements) > packing.MAX_PIECES:
+            raise ValueError(f"expected at most {packing.MAX_PIECES} pieces in {placement!r}")
+        if any(piece[1] == 'p' and BIT[sq] & PROMOTION_ROWS for sq, piece in placements):
+            raise ValueError(f"a pawn is on the first or last rank in {placement!r}")
+
+        castling_rights = sum(1 << i for i, char in enumerate(CASTLING_CHARS) if char in castling)
+        if ep == '-':
+            ep_square = ()
+        elif len(ep) == 2 and ep[0] in 'abcdefgh' and ep[1] in '36':
+            ep_square = (8 - int(ep[1]), 'abcdefgh'.index(ep[0]))
+        else:
+            raise ValueError(f"invalid en passant square {ep!r}")
+        return placements, color, castling_rights, ep_square
+
+    @staticmethod
+    def _check_clocks(halfmove_clock, fullmove_number) -> None:
+        if not 0 <= halfmove_clock <= MAX_CLOCK or not 0 <= fullmove_number <= MAX_CLOCK:
+            raise ValueError(f"move clocks must be from 0 to {MAX_CLOCK}, not {halfmove_clock} and {fullmove_number}")
+
+    def _set_up(self, placements, color, ep_square, castling_rights, halfmove_clock, fullmove_number,
+                regenerate_moves=True, check_legal=False) -> None:
+        """
+        Replace the position, placing the pieces straight onto an empty board
+
+        :param check_legal: bool: raise ValueError, leaving the position as it was, if the king of the side not to
+            move is in check, as the move generator would let it be captured
+        """
+
+        pieces, occupied, squares = self.pieces, self.occupied, self.squares
+        saved = (dict(pieces), dict(occupied), squares[:]) if check_legal else None
+        for piece in pieces:
+            pieces[piece] = 0
+        occupied['w'] = occupied['b'] = 0
+        squares[:] = ['--'] * 64
+        for sq, piece in placements:
+            pieces[piece] |= BIT[sq]
+            occupied[piece[0]] |= BIT[sq]
+            squares[sq] = piece
+
+        enemy_color = 'b' if color == 'w' else 'w'
+        if check_legal and self.move_generator.is_square_attacked(pieces[f"{enemy_color}k"].bit_length() - 1, color):
+            pieces.update(saved[0])
+            occupied.update(saved[1])
+            squares[:] = saved[2]
+            raise ValueError("the king of the side not to move is in check")
+
+        if pieces['wk']:
+            self.white_king_square = POS[pieces['wk'].bit_length() - 1]
+        if pieces['bk']:
+            self.black_king_square = POS[pieces['bk'].bit_length() - 1]
+
+        self.current_color = color
+        self.enemy_color = enemy_color
+        self.ep_square = tuple(ep_square)
+        self.castling_rights = castling_rights
+        self.halfmove_clock = halfmove_clock
+        self.fullmove_number = fullmove_number
+        self.key = get_key(self)
+        self.move_history.clear()
+        if regenerate_moves:
+            self.update_valid_moves()
+
+    def update_valid_moves(self) -> None:
+        """
+        Generate the legal moves of the position as Move objects, which the UI can compare with square pairs
+
+        The moves are indexed by their starting square, and the other queries about the position are cached until the
+        next time the moves are generated, so the UI can ask for them on every frame.
+        """
+
+        self.valid_moves = [Move(move) for move in self.move_generator.get_legal_moves()]
+        moves_by_square = {}
+        for move in self.valid_moves:
+            moves_by_square.setdefault(move.from_pos, []).append(move)
+        self.moves_by_square = moves_by_square
+        self._endgame_state = None
 
     def get_endgame_state(self):
-        checkmate = False
-        stalemate = False
+        """
+        :return: tuple: whether the position is stalemate and whether it is checkmate
+        """
 
-        if len(self.valid_moves) == 0:
-            # check if the king is in check
-            if self.current_color == 'w':
-                king_pos = self.white_king_square
-            else:
-                king_pos = self.black_king_square
+        # cached by the position key, as moves can be made without generating the valid moves
+        if self._endgame_state is None or self._endgame_state[0] != self.key:
+            checkmate = False
+            stalemate = False
 
-            self.swap_turns()
-            if king_pos in self.get_pseudo_in_check():
-                checkmate = True
-            else:
-                stalemate = True
-            self.swap_turns()
+            if not self.move_generator.has_legal_move():
+                # check if the king is in check
+                king = self.pieces[f"{self.current_color}k"]
+                if self.move_generator.is_square_attacked(king.bit_length() - 1, self.enemy_color):
+                    checkmate = True
+                else:
+                    stalemate = True
 
-        return stalemate, checkmate
+            self._endgame_state = self.key, (stalemate, checkmate)
+        return self._endgame_state[1]
 
     def get_pseudo_in_check(self) -> list:
         """
@@ -54,7 +356,7 @@ class Engine:
 
         :return: list: A list of squares in pseudo-legal check
         """
-        return [move.to_pos for move in self.move_generator.get_pseudo_legal_moves()]
+        return [POS[move >> 6 & 63] for move in self.move_generator.get_pseudo_legal_moves()]
 
     def get_legal_in_check(self) -> list:
         """
@@ -72,25 +374,26 @@ class Engine:
         """
         Get the starting positions of each from from the list of valid moves
 
-        :return: list: the starting positions of valid moves
+        :return: a set-like view of the starting positions of valid moves
         """
 
-        return [move.from_pos for move in self.valid_moves]
+        return self.moves_by_square.keys()
 
     def get_moves_of_square(self, from_pos) -> list:
         """
         Return all of the valid moves that start from the given position
 
         :param from_pos: tuple: the row, column location of the target square
-        :return: list: moves that start from the given position
+        :return: list: moves that start from the given position, shared with the index so it must not be changed
         """
 
-        return [move for move in self.valid_moves if move.from_pos == from_pos]
+        return self.moves_by_square.get(from_pos, [])
 
     def swap_turns(self) -> None:
         """Swap the current color and the enemy color"""
 
         self.current_color, self.enemy_color = self.enemy_color, self.current_color
+        self.key ^= SIDE_KEY
 
     def get_piece(self, row, col) -> str:
         """
@@ -101,20 +404,36 @@ class Engine:
         :return: string representation of  the piece from the board array
         """
 
-        return self.board_array[row][col]
+        return self.squares[row * 8 + col]
 
     def edit_board_array(self, changes) -> None:
         """
-        Edit the board array and update positions of king pieces
+        Edit the board and update positions of king pieces
 
-        Takes in a list or tuple of changes and applies each change to the board array
+        Takes in a list or tuple of changes and applies each change to the piece bitboards and the board squares
 
         :param changes: an array of [pos, piece] pairs (position is a row, column pair)
         :return: None
         """
 
+        pieces = self.pieces
+        occupied = self.occupied
+        squares = self.squares
+        key = self.key
         for pos, piece in changes:
-            self.board_array[pos[0]][pos[1]] = piece
+            sq = pos[0] * 8 + pos[1]
+            bit = BIT[sq]
+
+            old_piece = squares[sq]
+            if old_piece != '--':
+                pieces[old_piece] ^= bit
+                occupied[old_piece[0]] ^= bit
+                key ^= PIECE_KEYS[old_piece][sq]
+            if piece != '--':
+                pieces[piece] |= bit
+                occupied[piece[0]] |= bit
+                key ^= PIECE_KEYS[piece][sq]
+            squares[sq] = piece
 
             # update king position
             if piece == 'wk':
@@ -122,296 +441,642 @@ class Engine:
             elif piece == 'bk':
                 self.black_king_square = pos
 
-    def count_changes(self, changes, is_undo) -> None:
-        """
-        Updates the count of changes to squares that are changed by a set of changes
-
-        The method will extract the location from each change and consolidate them into a set that contains all of
-        the squares that were changed. For each position, the number of changes is either incremented or decremented
-        depending on whether the move is being made or undone.
-
-        :param changes: an array of [pos, piece] pairs (position is a row, column pair)
-        :param is_undo: bool:
-        :return: None
-        """
-        changed_squares = set(change[0] for change in changes)
-        if is_undo:
-            increment = -1
-        else:
-            increment = 1
-        for r, c in changed_squares:
-            self.num_changes[r][c] += increment
+        self.key = key
 
 
 class MoveGenerator:
     def __init__(self, engine):
         self.engine = engine
-        self.board_array = engine.board_array
-        self.get_moves = {
-            'p': self._generate_pawn_moves,
-            'r': self._generate_by_direction,
-            'k': self._generate_king_moves,
-            'b': self._generate_by_direction,
-            'q': self._generate_by_direction,
-            'n': self._generate_by_possible
-        }
-        self.args = {
-            'p': (),
-            'r': ((-1, 0), (0, 1), (1, 0), (0, -1)),
-            'b': ((-1, -1), (-1, 1), (1, 1), (1, -1)),
-            'q': ((-1, -1), (-1, 1), (1, 1), (1, -1), (-1, 0), (0, 1), (1, 0), (0, -1)),
-            'k': ((- 1, 0), (- 1, + 1), (0, + 1), (+ 1, + 1), (+ 1, 0), (+ 1, - 1), (0, - 1), (- 1, - 1)),
-            'n': ((- 1, - 2), (+ 1, - 2), (- 2, - 1), (- 2, + 1), (- 1, + 2), (+ 1, + 2), (+ 2, + 1), (+ 2, - 1))
-        }
 
     def get_legal_moves(self) -> list:
         """
-        Filter out illegal move by applying each pseudo-legal move and checking if the move results in a checked king.
+        Generate only legal moves, using the checking pieces, pinned pieces and enemy attacks of the position.
 
-        First, pseudo-legal moves are generated, then for each pseudo-legal move, the move is applied to the board array.
-        Then, the pseudo-legal moves are regenerated from the enemy perspective. If this results in the friendly king
-        being in check, the move is not added.
+        The enemy attacks are found once, and the king may only move to squares outside of them. When the king is in
+        check, the other pieces may only capture the checking piece or block its ray, and in double check only the king
+        may move. A pinned piece may only move along the line between its king and the pinning piece. En passant is the
+        one move that removes two pieces from a rank, so its legality is tested on the changed occupancy.
 
-        :return: list: a list of moves that don't result in the king being in check
+        :return: list: a list of packed moves that don't result in the king being in check
         """
 
-        legal_moves = []
-        for move in self.get_pseudo_legal_moves():
-
-            self.engine.move_maker.apply_move(move, swap_turns=True, regenerate_moves=False, count_changes=False)
+        engine = self.engine
+        color, enemy = engine.current_color, engine.enemy_color
+        pieces = engine.pieces
+        own = engine.occupied[color]
+        occupied = own | engine.occupied[enemy]
+        king_sq = pieces[f"{color}k"].bit_length() - 1
+
+        # remove the king from the board so that it can't step back along the ray of a checking slider
+        danger = self.get_attacked_squares(enemy, occupied ^ BIT[king_sq])
+        moves = self._generate_king_moves(king_sq, FULL ^ (own | danger), occupied, danger)
+
+        checkers = self.get_attackers(king_sq, enemy, occupied)
+        if checkers & (checkers - 1):
+            return moves  # double check, only the king can move
+        if checkers:
+            check_mask = checkers | BETWEEN[king_sq][checkers.bit_length() - 1]
+        else:
+            check_mask = FULL
+
+        pinned = self.get_pinned(king_sq, color, occupied)
+        targets = check_mask & ~own
+        pawns = pieces[f"{color}p"]
+
+        moves.extend(self._generate_pawn_moves(pawns & ~pinned, occupied, check_mask))
+        moves.extend(self._generate_en_passant(pawns, king_sq, occupied))
+        for sq in iter_squares(pawns & pinned):
+            moves.extend(self._generate_pawn_moves(BIT[sq], occupied, check_mask & LINE[king_sq][sq]))
+
+        # a pinned knight can never stay on the line of its pin
+        for sq in iter_squares(pieces[f"{color}n"] & ~pinned):
+            moves.extend(self._generate_by_targets(sq, KNIGHT_ATTACKS[sq] & targets))
+        # queens move as both a bishop and a rook
+        for sq in iter_squares(pieces[f"{color}b"] | pieces[f"{color}q"]):
+            piece_targets = targets & LINE[king_sq][sq] if BIT[sq] & pinned else targets
+            attacks = BISHOP_TABLES[sq][occupied & BISHOP_MASKS[sq]]
+            moves.extend(self._generate_by_targets(sq, attacks & piece_targets))
+        for sq in iter_squares(pieces[f"{color}r"] | pieces[f"{color}q"]):
+            piece_targets = targets & LINE[king_sq][sq] if BIT[sq] & pinned else targets
+            attacks = ROOK_TABLES[sq][occupied & ROOK_MASKS[sq]]
+            moves.extend(self._generate_by_targets(sq, attacks & piece_targets))
 
-            if self.engine.current_color == 'w':
-                king_pos = self.engine.black_king_square
-            else:
-                king_pos = self.engine.white_king_square
+        return moves
 
-            if king_pos not in self.engine.get_pseudo_in_check():
-                legal_moves.append(move)
+    def generate_staged(self, hash_move=None, quiet_key=None, quiets=True):
+        """
+        Yield the legal moves in stages, generating each stage only once the one before it is used up
+
+        The hash move comes first, then captures by most valuable victim and least valuable attacker, then promotions
+        and then quiet moves. Moves are generated pseudo-legally and each is checked only when it is about to be
+        yielded, so a caller that stops early, on a beta cutoff or after finding that there is a legal move, pays for
+        neither the later stages nor their legality checks.
+
+        :param hash_move: int: a packed move to try first, such as the best move of a transposition table entry, it is
+            skipped if it isn't legal in this position
+        :param quiet_key: callable: the quiet moves are sorted by it, highest first, generation order by default
+        :param quiets: bool: False to stop after the captures and promotions
+        :return: generator: the packed legal moves, each once
+        """
 
-            self.engine.move_maker.apply_move(is_undo=True, swap_turns=True, regenerate_moves=False, count_changes=False)
+        engine = self.engine
+        color, enemy = engine.current_color, engine.enemy_color
+        pieces = engine.pieces
+        own = engine.occupied[color]
+        enemies = engine.occupied[enemy]
+        occupied = own | enemies
+        empty = FULL ^ occupied
+        king_sq = pieces[f"{color}k"].bit_length() - 1
+
+        checkers = self.get_attackers(king_sq, enemy, occupied)
+        if checkers & (checkers - 1):
+            check_mask = 0  # double check, only the king can move
+        elif checkers:
+            check_mask = checkers | BETWEEN[king_sq][checkers.bit_length() - 1]
+        else:
+            check_mask = FULL
+        legality = (king_sq, occupied, check_mask, self.get_pinned(king_sq, color, occupied))
+
+        if hash_move is not None and self._is_pseudo_legal(hash_move, occupied) and \
+                self._is_legal(hash_move, *legality):
+            yield hash_move
+
+        captures = self._generate_stage(enemies, enemies, occupied)
+        if engine.ep_square:
+            ep = engine.ep_square[0] * 8 + engine.ep_square[1]
+            captures.extend(sq | ep << 6 | EN_PASSANT << 12
+                            for sq in iter_squares(PAWN_ATTACKS[enemy][ep] & pieces[f"{color}p"]))
+        captures.sort(key=self._capture_order, reverse=True)
+        for move in captures:
+            if move != hash_move and self._is_legal(move, *legality):
+                yield move
+
+        # pushes onto the last row, captures that promote were yielded with the captures
+        promotions = self._generate_pawn_moves(pieces[f"{color}p"], occupied, empty & PROMOTION_ROWS)
+        for move in promotions:
+            if move != hash_move and self._is_legal(move, *legality):
+                yield move
+
+        if not quiets:
+            return
+        moves = self._generate_stage(empty & ~PROMOTION_ROWS, empty, occupied)
+        rights = engine.castling_rights if color == 'w' else engine.castling_rights >> 2
+        # castling is checked against the attacked squares when it is generated, so they are only found when it could
+        # be allowed
+        danger = self.get_attacked_squares(enemy, occupied ^ BIT[king_sq]) if rights & 3 and not checkers else FULL
+        moves.extend(self._generate_king_moves(king_sq, 0, occupied, danger))
+        if quiet_key is not None:
+            moves.sort(key=quiet_key, reverse=True)
+        for move in moves:
+            if move != hash_move and self._is_legal(move, *legality):
+                yield move
+
+    def has_legal_move(self) -> bool:
+        """Check whether the side to move has any legal move, stopping at the first one found"""
+
+        return next(self.generate_staged(), None) is not None
+
+    def _generate_stage(self, pawn_targets, targets, occupied) -> list:
+        """Generate the pseudo-legal moves of every piece onto targets, with pawns moving onto pawn_targets"""
+
+        engine = self.engine
+        color = engine.current_color
+        pieces = engine.pieces
+        moves = self._generate_pawn_moves(pieces[f"{color}p"], occupied, pawn_targets)
+        for sq in iter_squares(pieces[f"{color}n"]):
+            moves.extend(self._generate_by_targets(sq, KNIGHT_ATTACKS[sq] & targets))
+        for sq in iter_squares(pieces[f"{color}b"] | pieces[f"{color}q"]):
+            moves.extend(self._generate_by_targets(sq, BISHOP_TABLES[sq][occupied & BISHOP_MASKS[sq]] & targets))
+        for sq in iter_squares(pieces[f"{color}r"] | pieces[f"{color}q"]):
+            moves.extend(self._generate_by_targets(sq, ROOK_TABLES[sq][occupied & ROOK_MASKS[sq]] & targets))
+        king_sq = pieces[f"{color}k"].bit_length() - 1
+        moves.extend(self._generate_by_targets(king_sq, KING_ATTACKS[king_sq] & targets))
+        return moves
 
-        return legal_moves
+    def _capture_order(self, move) -> int:
+        """Order captures by the victim, then by the attacker, least valuable first, then by the promotion piece"""
+
+        squares = self.engine.squares
+        victim = squares[move >> 6 & 63]
+        flag = move >> 12
+        victim_order = CAPTURE_ORDER.index(victim[1]) if victim != '--' else 0  # en passant takes a pawn
+        return victim_order * 64 - CAPTURE_ORDER.index(squares[move & 63][1]) * 8 + (flag if flag >= PROMOTE_N else 0)
+
+    def _is_pseudo_legal(self, move, occupied) -> bool:
+        """Check that a move, such as one from another position with the same hash, can be played here"""
+
+        engine = self.engine
+        color, enemy = engine.current_color, engine.enemy_color
+        from_sq = move & 63
+        piece = engine.squares[from_sq]
+        if piece[0] != color:
+            return False
+
+        targets = FULL ^ engine.occupied[color]
+        piece_type = piece[1]
+        if piece_type == 'p':
+            moves = self._generate_pawn_moves(BIT[from_sq], occupied, FULL)
+            if engine.ep_square:
+                ep = engine.ep_square[0] * 8 + engine.ep_square[1]
+                if PAWN_ATTACKS[enemy][ep] & BIT[from_sq]:
+                    moves.append(from_sq | ep << 6 | EN_PASSANT << 12)
+        elif piece_type == 'k':
+            # the attacked squares are only needed to check castling
+            danger = self.get_attacked_squares(enemy, occupied) if move >> 12 == CASTLE else 0
+            moves = self._generate_king_moves(from_sq, targets, occupied, danger)
+        elif piece_type == 'n':
+            moves = self._generate_by_targets(from_sq, KNIGHT_ATTACKS[from_sq] & targets)
+        else:
+            attacks = 0
+            if piece_type in 'bq':
+                attacks |= BISHOP_TABLES[from_sq][occupied & BISHOP_MASKS[from_sq]]
+            if piece_type in 'rq':
+                attacks |= ROOK_TABLES[from_sq][occupied & ROOK_MASKS[from_sq]]
+            moves = self._generate_by_targets(from_sq, attacks & targets)
+        return move in moves
+
+    def _is_legal(self, move, king_sq, occupied, check_mask, pinned) -> bool:
+        """Check that a pseudo-legal move doesn't leave the king attacked, see get_legal_moves"""
+
+        from_sq = move & 63
+        to_sq = move >> 6 & 63
+        flag = move >> 12
+        engine = self.engine
+        if from_sq == king_sq:
+            # castling is only generated when it is legal
+            return flag == CASTLE or not self.is_square_attacked(to_sq, engine.enemy_color, occupied ^ BIT[king_sq])
+        if flag == EN_PASSANT:
+            captured = to_sq + 8 if engine.current_color == 'w' else to_sq - 8
+            after = occupied ^ BIT[from_sq] ^ BIT[captured] | BIT[to_sq]
+            return not self.get_attackers(king_sq, engine.enemy_color, after) & ~BIT[captured]
+        if not check_mask & BIT[to_sq]:
+            return False
+        return not pinned & BIT[from_sq] or bool(LINE[king_sq][from_sq] & BIT[to_sq])
 
     def get_pseudo_legal_moves(self) -> list:
         """
         Get a list of pseudo-legal moves without checking whether or not the moves place the enemy king in check
 
-        :return: list: all moves, whether or not they place the king in check
+        :return: list: all packed moves, whether or not they place the king in check
         """
 
-        color = self.engine.current_color
-        moves = []
-        for r, row in enumerate(self.board_array):
-            for c, square in enumerate(row):
-                if square[0] == color:
-                    piece_type = square[1]
-                    moves.extend(self.get_moves[piece_type](r, c, self.args[piece_type]))
+        engine = self.engine
+        color, enemy = engine.current_color, engine.enemy_color
+        pieces = engine.pieces
+        own = engine.occupied[color]
+        occupied = own | engine.occupied[enemy]
+        targets = FULL ^ own
+
+        pawns = pieces[f"{color}p"]
+        moves = self._generate_pawn_moves(pawns, occupied, FULL)
+        if engine.ep_square:
+            ep = engine.ep_square[0] * 8 + engine.ep_square[1]
+            for sq in iter_squares(PAWN_ATTACKS[enemy][ep] & pawns):
+                moves.append(sq | ep << 6 | EN_PASSANT << 12)
+        for sq in iter_squares(pieces[f"{color}n"]):
+            moves.extend(self._generate_by_targets(sq, KNIGHT_ATTACKS[sq] & targets))
+        for sq in iter_squares(pieces[f"{color}b"] | pieces[f"{color}q"]):
+            moves.extend(self._generate_by_targets(sq, bishop_attacks(sq, occupied) & targets))
+        for sq in iter_squares(pieces[f"{color}r"] | pieces[f"{color}q"]):
+            moves.extend(self._generate_by_targets(sq, rook_attacks(sq, occupied) & targets))
+
+        king = pieces[f"{color}k"]
+        if king:
+            danger = self.get_attacked_squares(enemy, occupied)
+            moves.extend(self._generate_king_moves(king.bit_length() - 1, targets, occupied, danger))
 
         return moves
 
-    def _generate_pawn_moves(self, row, col, _):
-        r_step = -1 if self.engine.current_color == 'w' else 1
-        next_row = row + r_step
-        left_col = col - 1
-        right_col = col + 1
+    def get_attackers(self, sq, by_color, occupied) -> int:
+        """
+        Find the pieces of the given color that attack a square
 
-        moves = []
+        Instead of generating every enemy move, look outwards from the square with the attack tables for pieces that
+        could reach it.
 
-        if 0 <= next_row <= 7:
-            # forward movement
-            if self.board_array[next_row][col] == '--':
-                moves.append(PawnMove(self.engine, (row, col), (next_row, col)))
-                # check for double move
-                if (row in (1, 6)) and  (0 <= next_row+r_step <= 7) and (self.board_array[next_row+r_step][col] == '--'):
-                    moves.append(PawnMove(self.engine, (row, col), (next_row + r_step, col), make_ep=True))
-
-            # diagonal movement
-            if left_col >= 0:
-                if self.board_array[next_row][left_col][0] == self.engine.enemy_color:
-                    moves.append(PawnMove(self.engine, (row, col), (next_row, left_col)))
-                elif (next_row, left_col) == self.engine.ep_square:
-                    moves.append(PawnMove(self.engine, (row, col), (next_row, left_col), is_ep=True))
-
-            if right_col <= 7:
-                if self.board_array[next_row][right_col][0] == self.engine.enemy_color:
-                    moves.append(PawnMove(self.engine, (row, col), (next_row, right_col)))
-                elif (next_row, right_col) == self.engine.ep_square:
-                    moves.append(PawnMove(self.engine, (row, col), (next_row, right_col), is_ep=True))
+        :param sq: int: the index of the target square
+        :param by_color: str: the color of the attacking pieces
+        :param occupied: int: the bitboard of occupied squares that block sliding pieces
+        :return: int: a bitboard of the attacking pieces
+        """
 
-        return moves
+        pieces = self.engine.pieces
+        queens = pieces[f"{by_color}q"]
+        # a pawn attacks the square if a pawn of the other color on the square would attack the pawn
+        return (PAWN_ATTACKS['b' if by_color == 'w' else 'w'][sq] & pieces[f"{by_color}p"]
+                | KNIGHT_ATTACKS[sq] & pieces[f"{by_color}n"]
+                | KING_ATTACKS[sq] & pieces[f"{by_color}k"]
+                | BISHOP_TABLES[sq][occupied & BISHOP_MASKS[sq]] & (pieces[f"{by_color}b"] | queens)
+                | ROOK_TABLES[sq][occupied & ROOK_MASKS[sq]] & (pieces[f"{by_color}r"] | queens))
 
-    def _generate_king_moves(self,row, col, possible):
-        moves = []
-        for r, c in ((row + r_step, col + c_step) for r_step, c_step in possible):
-            if 0 <= r <= 7 and 0 <= c <= 7:
-                piece = self.board_array[r][c]
-                if piece == '--' or piece[0] == self.engine.enemy_color:
-                    moves.append(KingMove(self.engine, from_pos=(row, col), to_pos=(r, c)))
-
-        # check for castling moves
-        if (row, col) not in (legal_in_check := self.engine.get_legal_in_check()):
-            # left castle
-            if self.engine.num_changes[row][0] == 0:
-                l_castle = True
-                for step in range(1, 4):
-                    if self.board_array[row][col - step] != '--' or (row, col - step) in legal_in_check:
-                        l_castle = False
-                        break
-                if l_castle:
-                    moves.append(KingMove(self.engine, from_pos=(row, col), to_pos=(row, col - 2), castle=True))
-
-            # right castle
-            if self.engine.num_changes[row][7] == 0:
-                r_castle = True
-                for step in range(1, 3):
-                    if self.board_array[row][col + step] != '--' or (row, col + step) in legal_in_check:
-                        r_castle = False
-                        break
-                if r_castle:
-                    moves.append(KingMove(self.engine, from_pos=(row, col), to_pos=(row, col + 2), castle=True))
+    def is_square_attacked(self, sq, by_color, occupied=None) -> bool:
+        """
+        Check whether any piece of the given color attacks a square
 
-        return moves
+        :param sq: int: the index of the target square
+        :param by_color: str: the color of the attacking pieces
+        :param occupied: int: the occupied squares, defaults to the current board
+        :return: bool: True if the square is attacked
+        """
 
-    def _generate_by_possible(self, row, col, possible):
-        moves = []
-        for r, c in ((row + r_step, col + c_step) for r_step, c_step in possible):
-            if 0 <= r <= 7 and 0 <= c <= 7:
-                piece = self.board_array[r][c]
-                if piece == '--' or piece[0] == self.engine.enemy_color:
-                    moves.append(Move(self.engine, from_pos=(row, col), to_pos=(r, c)))
+        if occupied is None:
+            occupied = self.engine.occupied['w'] | self.engine.occupied['b']
+        return bool(self.get_attackers(sq, by_color, occupied))
+
+    def get_attacked_squares(self, color, occupied) -> int:
+        """
+        Find every square attacked by the pieces of a color
+
+        :param color: str: the color of the attacking pieces
+        :param occupied: int: the bitboard of occupied squares that block sliding pieces
+        :return: int: a bitboard of the attacked squares
+        """
+
+        pieces = self.engine.pieces
+        pawns = pieces[f"{color}p"]
+        if color == 'w':
+            attacked = ((pawns & NOT_FILE_A) >> 9) | ((pawns & NOT_FILE_H) >> 7)
+        else:
+            attacked = ((pawns & NOT_FILE_A) << 7) | ((pawns & NOT_FILE_H) << 9)
+
+        for sq in iter_squares(pieces[f"{color}n"]):
+            attacked |= KNIGHT_ATTACKS[sq]
+        for sq in iter_squares(pieces[f"{color}b"] | pieces[f"{color}q"]):
+            attacked |= BISHOP_TABLES[sq][occupied & BISHOP_MASKS[sq]]
+        for sq in iter_squares(pieces[f"{color}r"] | pieces[f"{color}q"]):
+            attacked |= ROOK_TABLES[sq][occupied & ROOK_MASKS[sq]]
+        for sq in iter_squares(pieces[f"{color}k"]):
+            attacked |= KING_ATTACKS[sq]
+
+        return attacked & FULL
+
+    def get_pinned(self, king_sq, color, occupied) -> int:
+        """
+        Find the pieces that are pinned to their king
+
+        An enemy slider that would attack the king if only enemy pieces blocked it pins the friendly piece in between,
+        as long as it is the only piece between them.
+
+        :param king_sq: int: the square of the king
+        :param color: str: the color of the king
+        :param occupied: int: the bitboard of occupied squares
+        :return: int: a bitboard of the pinned pieces
+        """
+
+        engine = self.engine
+        enemy = 'b' if color == 'w' else 'w'
+        pieces = engine.pieces
+        enemies = engine.occupied[enemy]
+        queens = pieces[f"{enemy}q"]
+        snipers = (rook_attacks(king_sq, enemies) & (pieces[f"{enemy}r"] | queens)
+                   | bishop_attacks(king_sq, enemies) & (pieces[f"{enemy}b"] | queens))
+
+        pinned = 0
+        for sq in iter_squares(snipers):
+            blockers = BETWEEN[king_sq][sq] & occupied
+            if blockers and not blockers & (blockers - 1):
+                pinned |= blockers & engine.occupied[color]
+        return pinned
+
+    def _generate_pawn_moves(self, pawns, occupied, mask) -> list:
+        engine = self.engine
+        empty = FULL ^ occupied
+        enemies = engine.occupied[engine.enemy_color]
+
+        # move every pawn at once by shifting the bitboard, then find each move's starting square from its target
+        if engine.current_color == 'w':
+            step = -8
+            single = (pawns >> 8) & empty
+            double = ((single & ROWS[5]) >> 8) & empty
+            left = ((pawns & NOT_FILE_A) >> 9) & enemies
+            right = ((pawns & NOT_FILE_H) >> 7) & enemies
+        else:
+            step = 8
+            single = (pawns << 8) & empty
+            double = ((single & ROWS[2]) << 8) & empty
+            left = ((pawns & NOT_FILE_A) << 7) & enemies
+            right = ((pawns & NOT_FILE_H) << 9) & enemies
+
+        moves = [to - 2 * step | to << 6 | DOUBLE_PUSH << 12 for to in iter_squares(double & mask)]
+        for targets, offset in ((single & mask, step), (left & mask, step - 1), (right & mask, step + 1)):
+            promotions = targets & PROMOTION_ROWS
+            moves.extend([to - offset | to << 6 for to in iter_squares(targets ^ promotions)])
+            for to in iter_squares(promotions):
+                # queen first so that the UI picks a queen promotion when a square is clicked
+                moves.extend([to - offset | to << 6 | flag << 12 for flag in PROMOTION_FLAGS])
 
         return moves
 
-    def _generate_by_direction(self, row, col, directions):
+    def _generate_en_passant(self, pawns, king_sq, occupied) -> list:
+        """Return the en passant captures that don't leave the king attacked once both pawns leave their squares"""
+
+        engine = self.engine
+        if not engine.ep_square:
+            return []
+
+        ep = engine.ep_square[0] * 8 + engine.ep_square[1]
+        captured = ep + 8 if engine.current_color == 'w' else ep - 8
+
         moves = []
-        for r_step, c_step in directions:
-            r, c = row, col
-            while 0 <= (r:=r+r_step) <= 7 and 0 <= (c:=c+c_step) <= 7:
-                piece = self.board_array[r][c]
-                if piece == '--':
-                    moves.append(Move(self.engine, from_pos=(row, col), to_pos=(r, c)))
-                elif piece[0] == self.engine.enemy_color:
-                    moves.append(Move(self.engine, from_pos=(row, col), to_pos=(r, c)))
-                    break
-                else:
-                    break
+        for sq in iter_squares(PAWN_ATTACKS[engine.enemy_color][ep] & pawns):
+            after = occupied ^ BIT[sq] ^ BIT[captured] | BIT[ep]
+            if not self.get_attackers(king_sq, engine.enemy_color, after) & ~BIT[captured]:
+                moves.append(sq | ep << 6 | EN_PASSANT << 12)
+        return moves
+
+    def _generate_king_moves(self, sq, targets, occupied, danger):
+        moves = [sq | to << 6 for to in iter_squares(KING_ATTACKS[sq] & targets)]
+
+        # check for castling moves, only a king on its home square may castle, and never out of check
+        engine = self.engine
+        color = engine.current_color
+        rights = engine.castling_rights if color == 'w' else engine.castling_rights >> 2
+        if not rights & 3 or sq != (60 if color == 'w' else 4) or danger & BIT[sq]:
+            return moves
+
+        rook = f"{color}r"
+        # left castle, the b-file square must be empty but may be attacked
+        if rights & 2 and engine.squares[sq - 4] == rook and \
+                not occupied & (BIT[sq - 1] | BIT[sq - 2] | BIT[sq - 3]) and not danger & (BIT[sq - 1] | BIT[sq - 2]):
+            moves.append(sq | sq - 2 << 6 | CASTLE << 12)
+
+        # right castle
+        if rights & 1 and engine.squares[sq + 3] == rook and \
+                not (occupied | danger) & (BIT[sq + 1] | BIT[sq + 2]):
+            moves.append(sq | sq + 2 << 6 | CASTLE << 12)
 
         return moves
 
+    def _generate_by_targets(self, sq, targets):
+        return [sq | to << 6 for to in iter_squares(targets)]
+
 
 class MoveMaker:
     def __init__(self, engine):
         self.engine = engine
-        self.board_array = engine.board_array
 
-    def apply_move(self, move=None, is_undo=False, swap_turns=True, regenerate_moves=True, count_changes=True) -> None:
+    def apply_move(self, move=None, is_undo=False, swap_turns=True, regenerate_moves=True) -> None:
         """
-        Make or undo the changes of a move.
+        Make or undo a move.
 
-        If making a move, build the changes of the move and then apply those changes to the board array. When rolling
-        back a move, if no move is provided, the last move is popped from the move history.
+        Making a move updates the board in place and pushes a compact record of what it can't recompute (the captured
+        piece, the en passant square, the castling rights, the halfmove clock and the position key) onto the move
+        history. Undoing pops the last record, so moves are always undone in the reverse order they were made.
 
-        :param move: the move object to be made or undone
+        :param move: the packed move to be made, not needed when undoing
         :param is_undo: whether or not to make or undo the move
         :param swap_turns: whether or not to swap the current color after changes are made
         :param regenerate_moves: whether or not to regenerate legal moves after the move is made
-        :param count_changes: whether or not to record the changes
         :return: None
         """
 
+        engine = self.engine
         if not is_undo:
-            self._build_move(move)
-            self.engine.edit_board_array(move.changes)
-            self.engine.ep_square = move.new_ep_pos
-            self.engine.move_history.append(move)
+            self._make(move)
+            if swap_turns:
+                engine.swap_turns()
         else:
-            if move is None:
-                try:
-                    move = self.engine.move_history.pop()
-                except IndexError:
-                    return -1  # make no changes
-
-            self.engine.edit_board_array(move.undo_changes)
-            self.engine.ep_square = move.old_ep_pos
-
-        if count_changes:
-            self.engine.count_changes(move.changes, is_undo=is_undo)
-        if swap_turns:
-            self.engine.swap_turns()
+            try:
+                move, captured, ep_square, castling_rights, halfmove_clock, key = engine.move_history.pop()
+            except IndexError:
+                return -1  # make no changes
+
+            self._unmake(move, captured)
+            if swap_turns:
+                engine.swap_turns()
+            engine.ep_square = ep_square
+            engine.castling_rights = castling_rights
+            engine.halfmove_clock = halfmove_clock
+            engine.key = key
+
         if regenerate_moves:
-            self.engine.valid_moves = self.engine.move_generator.get_legal_moves()
+            engine.update_valid_moves()
+
+    def _make(self, move) -> None:
+        engine = self.engine
+        squares, pieces, occupied = engine.squares, engine.pieces, engine.occupied
+        from_sq, to_sq, flag = move & 63, move >> 6 & 63, move >> 12
+        from_bit, to_bit = BIT[from_sq], BIT[to_sq]
+
+        piece = squares[from_sq]
+        captured = squares[to_sq]
+        color = piece[0]
+        engine.move_history.append(
+            (move, captured, engine.ep_square, engine.castling_rights, engine.halfmove_clock, engine.key)
+        )
+        key = engine.key
+        if engine.ep_square:
+            # the file is only in the key when a pawn of the side to move can capture en passant, see zobrist.get_key
+            ep = engine.ep_square[0] * 8 + engine.ep_square[1]
+            if PAWN_ATTACKS[engine.enemy_color][ep] & pieces[f"{color}p"]:
+                key ^= EP_KEYS[ep & 7]
+
+        if captured != '--':
+            pieces[captured] ^= to_bit
+            occupied[captured[0]] ^= to_bit
+            key ^= PIECE_KEYS[captured][to_sq]
+
+        placed = f"{color}{PROMOTION_PIECES[flag - PROMOTE_N]}" if flag >= PROMOTE_N else piece
+        pieces[piece] ^= from_bit
+        pieces[placed] ^= to_bit
+        occupied[color] ^= from_bit | to_bit
+        key ^= PIECE_KEYS[piece][from_sq] ^ PIECE_KEYS[placed][to_sq]
+        squares[from_sq] = '--'
+        squares[to_sq] = placed
+
+        if flag == CASTLE:
+            rook_from, rook_to = self._castle_rook_squares(to_sq)
+            rook = f"{color}r"
+            self._move_piece(rook, rook_from, rook_to)
+            key ^= PIECE_KEYS[rook][rook_from] ^ PIECE_KEYS[rook][rook_to]
+        elif flag == EN_PASSANT:
+            captured_sq = to_sq + 8 if color == 'w' else to_sq - 8
+            pawn = squares[captured_sq]
+            pieces[pawn] ^= BIT[captured_sq]
+            occupied[pawn[0]] ^= BIT[captured_sq]
+            key ^= PIECE_KEYS[pawn][captured_sq]
+            squares[captured_sq] = '--'
+
+        if piece[1] == 'k':
+            if color == 'w':
+                engine.white_king_square = POS[to_sq]
+            else:
+                engine.black_king_square = POS[to_sq]
 
-    def _build_move(self, move) -> None:
-        """
-        Add changes to the given move.
+        if flag == DOUBLE_PUSH:
+            ep = (from_sq + to_sq) // 2
+            engine.ep_square = POS[ep]
+            if PAWN_ATTACKS[color][ep] & pieces[f"{engine.enemy_color}p"]:
+                key ^= EP_KEYS[ep & 7]
+        else:
+            engine.ep_square = ()
 
-        :param move: The move object to build
-        :return: None
-        """
+        rights = engine.castling_rights
+        if rights:
+            new_rights = rights & CASTLING_MASKS[from_sq] & CASTLING_MASKS[to_sq]
+            if new_rights != rights:
+                key ^= CASTLING_KEYS[rights] ^ CASTLING_KEYS[new_rights]
+                engine.castling_rights = new_rights
 
-        moved_piece = self.engine.get_piece(*move.from_pos)
-        moved_color, moved_type = moved_piece[0], moved_piece[1]
+        if piece[1] == 'p' or captured != '--':
+            engine.halfmove_clock = 0
+        else:
+            engine.halfmove_clock += 1
+        if color == 'b':
+            engine.fullmove_number += 1
+        engine.key = key
+
+    def _unmake(self, move, captured) -> None:
+        engine = self.engine
+        squares, pieces, occupied = engine.squares, engine.pieces, engine.occupied
+        from_sq, to_sq, flag = move & 63, move >> 6 & 63, move >> 12
+        from_bit, to_bit = BIT[from_sq], BIT[to_sq]
+
+        placed = squares[to_sq]
+        color = placed[0]
+        piece = f"{color}p" if flag >= PROMOTE_N else placed
+        pieces[placed] ^= to_bit
+        pieces[piece] ^= from_bit
+        occupied[color] ^= from_bit | to_bit
+        squares[from_sq] = piece
+        squares[to_sq] = captured
+
+        if captured != '--':
+            pieces[captured] ^= to_bit
+            occupied[captured[0]] ^= to_bit
+
+        if flag == CASTLE:
+            rook_from, rook_to = self._castle_rook_squares(to_sq)
+            self._move_piece(f"{color}r", rook_to, rook_from)
+        elif flag == EN_PASSANT:
+            captured_sq = to_sq + 8 if color == 'w' else to_sq - 8
+            pawn = 'bp' if color == 'w' else 'wp'
+            pieces[pawn] ^= BIT[captured_sq]
+            occupied[pawn[0]] ^= BIT[captured_sq]
+            squares[captured_sq] = pawn
+
+        if piece[1] == 'k':
+            if color == 'w':
+                engine.white_king_square = POS[from_sq]
+            else:
+                engine.black_king_square = POS[from_sq]
+        if color == 'b':
+            engine.fullmove_number -= 1
 
-        changes = [(move.from_pos, '--'), (move.to_pos, moved_piece)]
+    def _move_piece(self, piece, from_sq, to_sq) -> None:
+        engine = self.engine
+        bits = BIT[from_sq] | BIT[to_sq]
+        engine.pieces[piece] ^= bits
+        engine.occupied[piece[0]] ^= bits
+        engine.squares[from_sq] = '--'
+        engine.squares[to_sq] = piece
 
-        if isinstance(move, PawnMove):
-            ep_step = 1 if moved_color == 'w' else -1
-            # pawn promotion
-            if move.to_row in (0, 7):
-                changes.append((move.to_pos, f"{moved_color}q"))
-            elif move.make_ep:
-                move.new_ep_pos = (move.to_row + ep_step, move.to_col)
-            elif move.is_ep:
-                changes.append(((move.to_row + ep_step, move.to_col), '--'))
+    @staticmethod
+    def _castle_rook_squares(king_to_sq) -> tuple:
+        """Return the starting and target squares of the rook for a castle that moves the king to the given square"""
 
-        elif isinstance(move, KingMove):
-            if move.castle:
-                if move.to_col < 4:  # left castle
-                    old_rook_pos = (move.to_row, 0)
-                    new_rook_pos = (move.to_row, move.to_col + 1)
-                    changes.extend([(new_rook_pos, f"{moved_color}r"), (old_rook_pos, '--')])
-                else:  # right castle
-                    old_rook_pos = (move.to_row, 7)
-                    new_rook_pos = (move.to_row, move.to_col - 1)
-                    changes.extend([(new_rook_pos, f"{moved_color}r"), (old_rook_pos, '--')])
+        if king_to_sq & 7 == 6:  # right castle
+            return king_to_sq + 1, king_to_sq - 1
+        return king_to_sq - 2, king_to_sq + 1
 
-        for change in changes:
-            changed_position = change[0]
-            move.changes.append(change)
-            move.undo_changes.append((changed_position, self.engine.get_piece(*changed_position)))
 
+class Move(int):
+    """
+    A packed move, as made by the move generator, with accessors for the UI
 
-class Move:
-    def __init__(self, engine, from_pos, to_pos):
-        self.board_state = engine
+    A move compares equal to its (from_pos, to_pos) pair of row, column positions, as well as to its packed int.
+    """
 
-        self.from_pos = from_pos
-        self.to_pos = to_pos
+    __slots__ = ()
 
-        self.from_row, self.from_col = from_pos
-        self.to_row, self.to_col = to_pos
+    @property
+    def from_sq(self) -> int:
+        return self & 63
 
-        self.changes = []
-        self.undo_changes = []
+    @property
+    def to_sq(self) -> int:
+        return self >> 6 & 63
 
-        self.new_ep_pos = ()
-        self.old_ep_pos = self.board_state.ep_square
+    @property
+    def flag(self) -> int:
+        return self >> 12
 
-    def __eq__(self, other):
-        return (self.from_pos, self.to_pos) == other
+    @property
+    def from_pos(self) -> tuple:
+        return POS[self & 63]
 
-    def __repr__(self):
-        return f"{self.from_pos} -> {self.to_pos}"
+    @property
+    def to_pos(self) -> tuple:
+        return POS[self >> 6 & 63]
+
+    @property
+    def promotion(self) -> str:
+        """The type of the piece a pawn promotes to, or an empty string"""
+
+        flag = self >> 12
+        return PROMOTION_PIECES[flag - PROMOTE_N] if flag >= PROMOTE_N else ''
 
+    @property
+    def is_ep(self) -> bool:
+        return self >> 12 == EN_PASSANT
 
-class PawnMove(Move):
-    def __init__(self, engine, from_pos, to_pos, make_ep=False, is_ep=False):
-        Move.__init__(self, engine, from_pos, to_pos)
-        self.make_ep = make_ep
-        self.is_ep = is_ep
+    @property
+    def make_ep(self) -> bool:
+        return self >> 12 == DOUBLE_PUSH
 
+    @property
+    def castle(self) -> bool:
+        return self >> 12 == CASTLE
+
+    def __eq__(self, other):
+        if isinstance(other, tuple):
+            return (self.from_pos, self.to_pos) == other
+        return int.__eq__(self, other)
 
-class KingMove(Move):
-    def __init__(self, engine, from_pos, to_pos, castle=False):
-        Move.__init__(self, engine, from_pos, to_pos)
-        self.castle = castle
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = int.__hash__
+
+    def __repr__(self):
+        return f"{self.from_pos} -> {self.to_pos}"
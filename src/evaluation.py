@@ -0,0 +1,154 @@
+"""
+Static evaluation of a position
+
+Scores are in centipawns from the point of view of the side to move. Each piece is worth its material value plus a
+bonus from its piece-square table, which rewards central knights, advanced pawns, a sheltered king and so on. The search
+uses only these, as they are cheap to compute. evaluate_full adds mobility and king safety, which need the attacks of
+every piece; batch_evaluation.py computes the same score for many positions at once with NumPy.
+"""
+from bitboard import (
+    BISHOP_MASKS, BISHOP_TABLES, BIT, KING_ATTACKS, KNIGHT_ATTACKS, PAWN_ATTACKS, ROOK_MASKS, ROOK_TABLES,
+    iter_squares
+)
+
+PIECE_VALUES = {'p': 100, 'n': 320, 'b': 330, 'r': 500, 'q': 900, 'k': 0}
+
+# tables are written from white's point of view with row 0 (the 8th rank) first, which is also the order of the squares
+PIECE_SQUARE_TABLES = {
+    'p': (
+        0, 0, 0, 0, 0, 0, 0, 0,
+        50, 50, 50, 50, 50, 50, 50, 50,
+        10, 10, 20, 30, 30, 20, 10, 10,
+        5, 5, 10, 25, 25, 10, 5, 5,
+        0, 0, 0, 20, 20, 0, 0, 0,
+        5, -5, -10, 0, 0, -10, -5, 5,
+        5, 10, 10, -20, -20, 10, 10, 5,
+        0, 0, 0, 0, 0, 0, 0, 0,
+    ),
+    'n': (
+        -50, -40, -30, -30, -30, -30, -40, -50,
+        -40, -20, 0, 0, 0, 0, -20, -40,
+        -30, 0, 10, 15, 15, 10, 0, -30,
+        -30, 5, 15, 20, 20, 15, 5, -30,
+        -30, 0, 15, 20, 20, 15, 0, -30,
+        -30, 5, 10, 15, 15, 10, 5, -30,
+        -40, -20, 0, 5, 5, 0, -20, -40,
+        -50, -40, -30, -30, -30, -30, -40, -50,
+    ),
+    'b': (
+        -20, -10, -10, -10, -10, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 10, 10, 5, 0, -10,
+        -10, 5, 5, 10, 10, 5, 5, -10,
+        -10, 0, 10, 10, 10, 10, 0, -10,
+        -10, 10, 10, 10, 10, 10, 10, -10,
+        -10, 5, 0, 0, 0, 0, 5, -10,
+        -20, -10, -10, -10, -10, -10, -10, -20,
+    ),
+    'r': (
+        0, 0, 0, 0, 0, 0, 0, 0,
+        5, 10, 10, 10, 10, 10, 10, 5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        0, 0, 0, 5, 5, 0, 0, 0,
+    ),
+    'q': (
+        -20, -10, -10, -5, -5, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 5, 5, 5, 0, -10,
+        -5, 0, 5, 5, 5, 5, 0, -5,
+        0, 0, 5, 5, 5, 5, 0, -5,
+        -10, 5, 5, 5, 5, 5, 0, -10,
+        -10, 0, 5, 0, 0, 0, 0, -10,
+        -20, -10, -10, -5, -5, -10, -10, -20,
+    ),
+    'k': (
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -20, -30, -30, -40, -40, -30, -30, -20,
+        -10, -20, -20, -20, -20, -20, -20, -10,
+        20, 20, 0, 0, 0, 0, 20, 20,
+        20, 30, 10, 0, 0, 10, 30, 20,
+    ),
+}
+
+# the value of each piece on each square, black squares are mirrored vertically (sq ^ 56 flips the row)
+SQUARE_VALUES = {}
+for _piece_type, _table in PIECE_SQUARE_TABLES.items():
+    SQUARE_VALUES[f"w{_piece_type}"] = tuple(PIECE_VALUES[_piece_type] + _table[sq] for sq in range(64))
+    SQUARE_VALUES[f"b{_piece_type}"] = tuple(PIECE_VALUES[_piece_type] + _table[sq ^ 56] for sq in range(64))
+
+# centipawns for each square a piece attacks that isn't held by a piece of its own color
+MOBILITY_WEIGHTS = {'n': 4, 'b': 5, 'r': 2, 'q': 1}
+SHIELD_BONUS = 10  # for each pawn on the three squares in front of its own king
+KING_ZONE_ATTACK = 8  # for each attack of a knight, bishop, rook or queen on a square next to the enemy king
+
+# the squares in front of a king of each color, where its pawns shelter it
+KING_SHIELDS = {
+    'w': tuple(PAWN_ATTACKS['w'][sq] | (BIT[sq - 8] if sq >= 8 else 0) for sq in range(64)),
+    'b': tuple(PAWN_ATTACKS['b'][sq] | (BIT[sq + 8] if sq < 56 else 0) for sq in range(64)),
+}
+
+
+def evaluate(engine) -> int:
+    """
+    Score the engine's position
+
+    :param engine: the engine holding the position
+    :return: int: the score in centipawns, positive when the side to move is better
+    """
+
+    score = 0
+    for piece, bb in engine.pieces.items():
+        if bb:
+            values = SQUARE_VALUES[piece]
+            piece_score = sum(values[sq] for sq in iter_squares(bb))
+            score += piece_score if piece[0] == 'w' else -piece_score
+
+    return score if engine.current_color == 'w' else -score
+
+
+def piece_attacks(piece_type, sq, occupied) -> int:
+    """
+    :return: int: the bitboard of the squares attacked by a knight, bishop, rook or queen
+    """
+
+    if piece_type == 'n':
+        return KNIGHT_ATTACKS[sq]
+    attacks = 0
+    if piece_type in 'rq':
+        attacks |= ROOK_TABLES[sq][occupied & ROOK_MASKS[sq]]
+    if piece_type in 'bq':
+        attacks |= BISHOP_TABLES[sq][occupied & BISHOP_MASKS[sq]]
+    return attacks
+
+
+def evaluate_full(engine) -> int:
+    """
+    Score the engine's position with mobility and king safety on top of evaluate
+
+    :param engine: the engine holding the position
+    :return: int: the score in centipawns, positive when the side to move is better
+    """
+
+    pieces, occupied = engine.pieces, engine.occupied
+    all_occupied = occupied['w'] | occupied['b']
+
+    score = 0
+    for color, enemy, sign in (('w', 'b', 1), ('b', 'w', -1)):
+        king = pieces[f"{color}k"].bit_length() - 1
+        enemy_zone = KING_ATTACKS[pieces[f"{enemy}k"].bit_length() - 1]
+        side_score = bin(KING_SHIELDS[color][king] & pieces[f"{color}p"]).count('1') * SHIELD_BONUS
+        for piece_type, weight in MOBILITY_WEIGHTS.items():
+            for sq in iter_squares(pieces[color + piece_type]):
+                attacks = piece_attacks(piece_type, sq, all_occupied)
+                side_score += bin(attacks & ~occupied[color]).count('1') * weight
+                side_score += bin(attacks & enemy_zone).count('1') * KING_ZONE_ATTACK
+        score += sign * side_score
+
+    return evaluate(engine) + (score if engine.current_color == 'w' else -score)
@@ -0,0 +1,223 @@
+"""
+The moves of a game, with undo, redo and jumps to any ply, and the draw rules
+
+GameHistory keeps every move played on an engine, including the moves that were undone and can be redone, and the
+position key after each ply. Undo and redo make or unmake a single move. A jump to a distant ply restores the nearest
+packed snapshot before it, taken every SNAPSHOT_INTERVAL plies, and replays the moves from there, so no jump replays
+more than SNAPSHOT_INTERVAL moves.
+
+A count of each position key on the line from the start to the current ply is updated as moves are made and unmade,
+so a threefold repetition is found with one lookup. The fifty-move rule uses the engine's halfmove clock. Every draw
+check is O(1) however long the game is.
+
+usage:
+    python src/history.py    # play lines whose draws were once missed and check the draw rules find them
+"""
+import sys
+
+SNAPSHOT_INTERVAL = 32
+FIFTY_MOVE_PLIES = 100  # the halfmove clock at which a game is drawn by the fifty-move rule
+REPETITIONS = 3
+
+DRAW_REASONS = ('threefold repetition', 'fifty-move rule', 'insufficient material')
+
+# lines from the start position in coordinate notation, with the repetitions and draw reason of their last position
+CHECK_LINES = (
+    # the position after 1...e5 occurs for the third time, e4 and e5 are double pushes that can't be taken en passant
+    ('knights out and back twice', 'e2e4 e7e5 g1f3 g8f6 f3g1 f6g8 g1f3 g8f6 f3g1 f6g8', 3, 'threefold repetition'),
+    ('knights out and back once', 'e2e4 e7e5 g1f3 g8f6 f3g1 f6g8', 2, None),
+)
+
+
+class GameHistory:
+    def __init__(self, chess_engine):
+        """
+        :param chess_engine: the engine the game is played on, its current position is the start of the history
+        """
+
+        self.engine = chess_engine
+        self.moves = []  # every move of the line, those from ply on were undone and can be redone
+        self.keys = []  # the position key at each ply, from the start position on
+        self.snapshots = []  # the packed position at every SNAPSHOT_INTERVAL plies
+        self.key_counts = {}  # how often each key occurs from the start up to the current ply
+        self.ply = 0
+        self.reset()
+
+    def reset(self) -> None:
+        """Start a new history from the engine's position"""
+
+        chess_engine = self.engine
+        self.moves = []
+        self.keys = [chess_engine.key]
+        self.snapshots = [chess_engine.get_position()]
+        self.key_counts = {chess_engine.key: 1}
+        self.ply = 0
+
+    def push(self, move, regenerate_moves=True) -> None:
+        """
+        Play a move, the moves that could be redone are dropped unless it is the next of them
+
+        :param move: int: the packed move
+        :param regenerate_moves: bool: passed on to MoveMaker.apply_move
+        :return: None
+        """
+
+        if self.ply < len(self.moves):
+            if self.moves[self.ply] == move:
+                self.redo(regenerate_moves)
+                return
+            del self.moves[self.ply:]
+            del self.keys[self.ply + 1:]
+            del self.snapshots[self.ply // SNAPSHOT_INTERVAL + 1:]
+
+        self.moves.append(move)
+        self._make(move, regenerate_moves)
+        self.keys.append(self.engine.key)
+        if self.ply % SNAPSHOT_INTERVAL == 0:
+            self.snapshots.append(self.engine.get_position())
+
+    def undo(self, regenerate_moves=True) -> bool:
+        """
+        Take back the move before the current ply
+
+        :return: bool: False if there was no move to take back
+        """
+
+        if not self.ply:
+            return False
+        self._count(self.keys[self.ply], -1)
+        self.ply -= 1
+        if self.engine.move_history:
+            self.engine.move_maker.apply_move(is_undo=True, regenerate_moves=regenerate_moves)
+        else:
+            # the engine's undo stack starts at the last snapshot that was restored
+            self._restore(self.ply, regenerate_moves)
+        return True
+
+    def redo(self, regenerate_moves=True) -> bool:
+        """
+        Play the next move that was taken back
+
+        :return: bool: False if there was no move to play again
+        """
+
+        if self.ply == len(self.moves):
+            return False
+        self._make(self.moves[self.ply], regenerate_moves)
+        return True
+
+    def go_to(self, ply) -> None:
+        """
+        Jump to a ply of the line, undoing or redoing moves when it is near and restoring a snapshot otherwise
+
+        :param ply: int: the number of moves from the start, clamped to the moves of the line
+        :return: None
+        """
+
+        ply = max(0, min(ply, len(self.moves)))
+        if ply >= self.ply and ply - self.ply <= SNAPSHOT_INTERVAL:
+            while self.ply < ply:
+                self.redo(regenerate_moves=self.ply + 1 == ply)
+            return
+        if ply < self.ply and self.ply - ply <= min(SNAPSHOT_INTERVAL, len(self.engine.move_history)):
+            while self.ply > ply:
+                self.undo(regenerate_moves=self.ply - 1 == ply)
+            return
+
+        step = 1 if ply > self.ply else -1
+        for index in range(self.ply + step, ply + step, step):
+            self._count(self.keys[index if step > 0 else index - step], step)
+        self.ply = ply
+        self._restore(ply, True)
+
+    def get_last_move(self):
+        """
+        :return: int: the move that led to the current position, or None at the start
+        """
+
+        return self.moves[self.ply - 1] if self.ply else None
+
+    def get_repetitions(self) -> int:
+        """
+        :return: int: how often the current position has occurred in the line up to the current ply
+        """
+
+        return self.key_counts.get(self.engine.key, 0)
+
+    def get_draw_reason(self):
+        """
+        :return: str: the rule the game is drawn by at the current ply, one of DRAW_REASONS, or None
+        """
+
+        if self.get_repetitions() >= REPETITIONS:
+            return 'threefold repetition'
+        if self.engine.halfmove_clock >= FIFTY_MOVE_PLIES:
+            return 'fifty-move rule'
+        if is_insufficient_material(self.engine):
+            return 'insufficient material'
+        return None
+
+    def _make(self, move, regenerate_moves) -> None:
+        self.engine.move_maker.apply_move(move, regenerate_moves=regenerate_moves)
+        self.ply += 1
+        self._count(self.engine.key, 1)
+
+    def _count(self, key, change) -> None:
+        count = self.key_counts.get(key, 0) + change
+        if count:
+            self.key_counts[key] = count
+        else:
+            del self.key_counts[key]
+
+    def _restore(self, ply, regenerate_moves) -> None:
+        """Set the engine to a ply by restoring the snapshot before it and replaying the moves after the snapshot"""
+
+        chess_engine = self.engine
+        start = ply // SNAPSHOT_INTERVAL * SNAPSHOT_INTERVAL
+        chess_engine.set_position(self.snapshots[start // SNAPSHOT_INTERVAL], regenerate_moves=False)
+        for move in self.moves[start:ply]:
+            chess_engine.move_maker.apply_move(move, regenerate_moves=False)
+        if regenerate_moves:
+            chess_engine.update_valid_moves()
+
+
+def is_insufficient_material(chess_engine) -> bool:
+    """Check for a king against a king and at most one bishop or knight, where no mate is possible"""
+
+    pieces = chess_engine.pieces
+    if pieces['wp'] | pieces['bp'] | pieces['wr'] | pieces['br'] | pieces['wq'] | pieces['bq']:
+        return False
+    minors = pieces['wn'] | pieces['bn'] | pieces['wb'] | pieces['bb']
+    return not minors & (minors - 1)
+
+
+def run_checks(out=sys.stdout) -> bool:
+    """
+    Play CHECK_LINES and compare the repetitions and draw reason of each final position
+
+    :param out: the stream to print the report to
+    :return: bool: True if every line ended as expected
+    """
+
+    import engine
+    import perft
+
+    passed = True
+    chess_engine = engine.Engine()
+    for name, line, repetitions, reason in CHECK_LINES:
+        chess_engine.set_fen(perft.START_FEN)
+        game = GameHistory(chess_engine)
+        for text in line.split():
+            game.push(next(move for move in chess_engine.move_generator.get_legal_moves()
+                           if perft.format_move(move) == text))
+        found = (game.get_repetitions(), game.get_draw_reason())
+        status = 'ok' if found == (repetitions, reason) else f"FAIL (expected {repetitions}, {reason})"
+        passed &= status == 'ok'
+        print(f"{name}: {found[0]} repetitions, {found[1]}  {status}", file=out)
+
+    print('all draws found' if passed else 'DRAW RULE MISMATCH', file=out)
+    return passed
+
+
+if __name__ == '__main__':
+    sys.exit(0 if run_checks() else 1)
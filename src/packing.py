@@ -0,0 +1,201 @@
+"""
+Fixed-width binary positions
+
+Every position packs into POSITION_SIZE bytes, so a file of positions can be read by index through a memory map
+without parsing any text. The layout, with integers stored big-endian:
+
+    bytes 0-7    the occupied squares as a bitboard
+    bytes 8-23   a 4-bit piece code for each occupied square in square order, two to a byte with the first in the high
+                 bits, so at most 32 pieces fit
+    byte 24      bit 0 is set when black is to move, bits 1-4 hold the castling rights
+    byte 25      the en passant square, NO_SQUARE when there is none
+    bytes 26-27  the halfmove clock
+    bytes 28-29  the fullmove number
+    bytes 30-31  reserved, always zero
+
+usage:
+    python src/packing.py positions.epd positions.bin    # pack a file of FEN or EPD lines
+    python src/packing.py positions.bin --read           # load every packed position, to measure the speed
+"""
+import argparse
+import mmap
+import os
+import struct
+import sys
+import time
+
+from bitboard import POS, iter_squares
+
+POSITION_SIZE = 32
+NO_SQUARE = 64
+MAX_PIECES = 32
+
+_LAYOUT = struct.Struct('>Q16sBBHH2x')
+PIECE_CODES = {f"{color}{piece_type}": i for i, (color, piece_type) in
+               enumerate((color, piece_type) for color in 'wb' for piece_type in 'pnbrqk')}
+CODE_PIECES = tuple(PIECE_CODES)
+
+
+def pack(engine) -> bytes:
+    """
+    Pack the engine's position
+
+    :param engine: the engine holding the position
+    :return: bytes: the POSITION_SIZE bytes of the position
+    """
+
+    occupancy = engine.occupied['w'] | engine.occupied['b']
+    squares = engine.squares
+    codes = [PIECE_CODES[squares[sq]] for sq in iter_squares(occupancy)]
+    if len(codes) > MAX_PIECES:
+        raise ValueError(f"a packed position holds at most {MAX_PIECES} pieces, not {len(codes)}")
+    codes.extend([0] * (MAX_PIECES - len(codes)))
+
+    flags = (engine.current_color == 'b') | engine.castling_rights << 1
+    ep = engine.ep_square[0] * 8 + engine.ep_square[1] if engine.ep_square else NO_SQUARE
+    nibbles = bytes(codes[i] << 4 | codes[i + 1] for i in range(0, MAX_PIECES, 2))
+    return _LAYOUT.pack(occupancy, nibbles, flags, ep, engine.halfmove_clock, engine.fullmove_number)
+
+
+def unpack(data) -> tuple:
+    """
+    Unpack a position packed by pack
+
+    :param data: bytes: the POSITION_SIZE bytes of the position
+    :return: tuple: a list of (square, piece) pairs, the color to move, the en passant square, the castling rights,
+        the halfmove clock and the fullmove number
+    """
+
+    occupancy, nibbles, flags, ep, halfmove_clock, fullmove_number = _LAYOUT.unpack(data)
+    placements = [(sq, CODE_PIECES[nibbles[i >> 1] >> 4 if i & 1 == 0 else nibbles[i >> 1] & 15])
+                  for i, sq in enumerate(iter_squares(occupancy))]
+    ep_square = POS[ep] if ep != NO_SQUARE else ()
+    return placements, 'b' if flags & 1 else 'w', ep_square, flags >> 1 & 15, halfmove_clock, fullmove_number
+
+
+def write_positions(path, positions) -> int:
+    """
+    Write packed positions to a file, replacing it
+
+    :param path: str: the path of the file
+    :param positions: an iterable of packed positions
+    :return: int: the number of positions written
+    """
+
+    count = 0
+    with open(path, 'wb') as file:
+        for position in positions:
+            file.write(position)
+            count += 1
+    return count
+
+
+class FixedWidthFile:
+    """
+    Read-only access to a file of fixed-width records through a memory map
+
+    Records are sliced out of the map as they are needed, so opening a file doesn't read it, and the operating system
+    shares the pages between processes that open the same file.
+    """
+
+    def __init__(self, path, record_size, records='records'):
+        """
+        :param path: str: the path of the file
+        :param record_size: int: the bytes in a record
+        :param records: str: what the records are called, for the error message
+        :raises ValueError: if the file isn't a whole number of records
+        """
+
+        self.path = path
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        if size % record_size:
+            self._file.close()
+            raise ValueError(f"{path} is not a whole number of {record_size}-byte {records}")
+
+        # an empty file can't be mapped
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        self._count = size // record_size
+
+    def __len__(self):
+        return self._count
+
+    def close(self) -> None:
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PositionFile(FixedWidthFile):
+    """Read-only access to a file of packed positions, by index"""
+
+    def __init__(self, path):
+        """
+        :param path: str: the path of a file written by write_positions
+        """
+
+        super().__init__(path, POSITION_SIZE, 'positions')
+
+    def __getitem__(self, index) -> bytes:
+        """
+        :param index: int: the index of the position, negative indexes count from the end
+        :return: bytes: the packed position
+        """
+
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('position index out of range')
+        offset = index * POSITION_SIZE
+        return self._map[offset:offset + POSITION_SIZE]
+
+    def __iter__(self):
+        data = self._map
+        for offset in range(0, self._count * POSITION_SIZE, POSITION_SIZE):
+            yield data[offset:offset + POSITION_SIZE]
+
+
+def main(argv=None) -> int:
+    import engine
+
+    parser = argparse.ArgumentParser(description='Pack FEN or EPD positions into fixed-width binary positions.')
+    parser.add_argument('source', help='a file with one FEN or EPD per line, or a packed file with --read')
+    parser.add_argument('output', nargs='?', help='the packed file to write')
+    parser.add_argument('--read', action='store_true', help='load every position of a packed file into an engine')
+    args = parser.parse_args(argv)
+
+    chess_engine = engine.Engine()
+    start = time.perf_counter()
+    if args.read:
+        with PositionFile(args.source) as positions:
+            for position in positions:
+                chess_engine.set_position(position)
+            count = len(positions)
+    else:
+        if args.output is None:
+            parser.error('an output file is needed to pack positions')
+
+        def read_positions():
+            with open(args.source) as file:
+                for line in file:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    chess_engine.set_fen_or_epd(line)
+                    yield chess_engine.get_position()
+
+        count = write_positions(args.output, read_positions())
+
+    seconds = max(time.perf_counter() - start, 1e-9)
+    print(f"{count} positions in {seconds:.3f}s, {count / seconds:.0f} positions/s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,137 @@
+"""
+Multi-process perft and search
+
+Python runs one thread at a time in a process, so the root moves of a position are split across a pool of processes
+instead. Each worker keeps its own Engine, which is set up from the packed position of Engine.get_position before each
+task. Results are merged in the order of the root moves, so they don't depend on which worker finishes first.
+"""
+import concurrent.futures
+import time
+
+import engine
+import perft
+import search
+import transposition
+
+# the state of a worker process, created once by _init_worker
+_engine = None
+_perft_table = None
+_search_table = None
+
+
+def _init_worker(hash_size) -> None:
+    global _engine, _perft_table, _search_table
+    _engine = engine.Engine()
+    _perft_table = transposition.TranspositionTable(hash_size) if hash_size else None
+    _search_table = transposition.TranspositionTable()
+
+
+def make_pool(workers, hash_size=0) -> concurrent.futures.ProcessPoolExecutor:
+    """
+    Start the worker processes
+
+    :param workers: int: the number of processes
+    :param hash_size: int: the size of each worker's perft transposition table, no table when 0
+    :return: ProcessPoolExecutor: the pool to pass to the parallel functions, shut it down when done
+    """
+
+    return concurrent.futures.ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(hash_size,))
+
+
+def _perft_task(position, move, depth) -> int:
+    _engine.set_position(position)
+    if depth == 1:
+        return 1
+    _engine.move_maker.apply_move(move, regenerate_moves=False)
+    return perft.perft(_engine, depth - 1, _perft_table)
+
+
+def parallel_divide(pool, chess_engine, depth) -> dict:
+    """
+    Perft split by root move, with one task per root move
+
+    :param pool: the pool made by make_pool
+    :param chess_engine: the engine holding the root position
+    :param depth: int: the number of plies to search, including the root move
+    :return: dict: the number of leaf nodes below each root move, in the order of the legal moves
+    """
+
+    position = chess_engine.get_position()
+    moves = chess_engine.move_generator.get_legal_moves()
+    futures = [pool.submit(_perft_task, position, move, depth) for move in moves]
+    return {perft.format_move(move): future.result() for move, future in zip(moves, futures)}
+
+
+def parallel_perft(pool, chess_engine, depth) -> int:
+    """Count the leaf nodes of the legal move tree, see parallel_divide"""
+
+    return sum(parallel_divide(pool, chess_engine, depth).values())
+
+
+def _search_task(position, root_moves, max_depth, time_limit) -> tuple:
+    _engine.set_position(position)
+    iterations = []
+
+    def record(stats):
+        iterations.append((stats['depth'], stats['score'], [perft.format_move(move) for move in stats['pv']]))
+
+    searcher = search.Searcher(_engine, _search_table)
+    searcher.search(max_depth, time_limit, record, root_moves)
+    nodes = searcher.nodes
+    if not iterations:
+        # a share that ran out of time before its first iteration finished would go unscored, and its moves unplayed
+        searcher.search(1, None, record, root_moves)
+        nodes += searcher.nodes
+    return iterations, nodes
+
+
+def parallel_search(pool, chess_engine, workers, max_depth=search.MAX_DEPTH, time_limit=None) -> tuple:
+    """
+    Search with the root moves split between the workers
+
+    Each worker runs an iterative deepening search over its share of the root moves. The workers may finish at
+    different depths, so their results are compared at the deepest iteration that every worker finished, and a worker
+    searches its share to depth 1 however long that takes. Equal scores go to the move that comes first in the legal
+    move order.
+
+    :param pool: the pool made by make_pool
+    :param chess_engine: the engine holding the root position
+    :param workers: int: the number of shares to split the root moves into
+    :param max_depth: int: the deepest iteration to search
+    :param time_limit: float: the number of seconds each worker may search for
+    :return: tuple: the best move (None if there are no legal moves) and a dict of stats like Searcher.get_stats, with
+        the principal variation in coordinate notation
+    """
+
+    start = time.perf_counter()
+    moves = chess_engine.move_generator.get_legal_moves()
+    if not moves:
+        return None, {}
+
+    position = chess_engine.get_position()
+    shares = [moves[i::workers] for i in range(min(workers, len(moves)))]
+    futures = [pool.submit(_search_task, position, share, max_depth, time_limit) for share in shares]
+    results = [future.result() for future in futures]
+
+    depth = min(iterations[-1][0] for iterations, _ in results)
+    order = {perft.format_move(move): index for index, move in enumerate(moves)}
+
+    best = None
+    for iterations, _ in results:
+        _, score, pv = iterations[depth - 1]
+        if best is None or (-score, order[pv[0]]) < (-best[0], order[best[1][0]]):
+            best = (score, pv)
+
+    seconds = time.perf_counter() - start
+    nodes = sum(worker_nodes for _, worker_nodes in results)
+    stats = {
+        'depth': depth,
+        'nodes': nodes,
+        'time': seconds,
+        'nps': int(nodes / seconds) if seconds > 0 else 0,
+        'score': best[0],
+        'mate': search.mate_in(best[0]),
+        'pv': best[1],
+    }
+    best_move = moves[order[best[1][0]]]
+    return best_move, stats
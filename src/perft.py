@@ -0,0 +1,253 @@
+"""
+Perft (performance test) for the move generator
+
+Counts the leaf nodes of the legal move tree to a fixed depth and compares the counts against published values. A
+mismatch means that the move generator or move maker is broken, and the nodes per second measure how fast they are.
+
+usage:
+    python src/perft.py                        # run the correctness suite
+    python src/perft.py 4                      # perft of the start position to depth 4
+    python src/perft.py 3 --fen "<fen>" --divide
+    python src/perft.py 5 --hash 1000000       # reuse the counts of transposed positions
+    python src/perft.py 5 --workers 4 --compare  # split the root moves across 4 processes
+    python src/perft.py 4 --profile stats.json   # count and time the move generator calls
+"""
+import argparse
+import sys
+import time
+
+import engine
+import transposition
+import zobrist
+
+
+START_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+
+# name, fen, known node counts for depth 1, 2, 3...
+POSITIONS = (
+    ('start', START_FEN,
+     (20, 400, 8902, 197281, 4865609)),
+    ('kiwipete', 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+     (48, 2039, 97862, 4085603)),
+    ('endgame en-passant', '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1',
+     (14, 191, 2812, 43238, 674624)),
+    ('promotions', 'r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1',
+     (6, 264, 9467, 422333)),
+    ('pins and checks', 'rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8',
+     (44, 1486, 62379, 2103487)),
+)
+
+
+def format_move(move) -> str:
+    """Return a packed move in coordinate notation, e.g. 'e2e4' or 'e7e8q'"""
+
+    move = engine.Move(move)
+    from_row, from_col = move.from_pos
+    to_row, to_col = move.to_pos
+    return f"{'abcdefgh'[from_col]}{8 - from_row}{'abcdefgh'[to_col]}{8 - to_row}{move.promotion}"
+
+
+def perft(chess_engine, depth, table=None) -> int:
+    """
+    Count the leaf nodes of the legal move tree
+
+    :param chess_engine: the engine holding the root position
+    :param depth: int: the number of plies to search
+    :param table: TranspositionTable: stores the counts of positions that are reached again by another move order
+    :return: int: the number of leaf nodes
+    """
+
+    if table is not None and depth > 1:
+        # the same position has a different count at each depth, so the depth is mixed into the key
+        key = chess_engine.key ^ depth
+        entry = table.probe(key)
+        if entry is not None:
+            return entry[2]
+
+    moves = chess_engine.move_generator.get_legal_moves()
+    if depth == 1:
+        return len(moves)
+
+    nodes = 0
+    for move in moves:
+        chess_engine.move_maker.apply_move(move, regenerate_moves=False)
+        nodes += perft(chess_engine, depth - 1, table)
+        chess_engine.move_maker.apply_move(is_undo=True, regenerate_moves=False)
+
+    if table is not None:
+        table.store(key, depth, nodes)
+    return nodes
+
+
+def divide(chess_engine, depth, table=None) -> dict:
+    """
+    Perft split by root move, used to find which move a node count mismatch comes from
+
+    :param chess_engine: the engine holding the root position
+    :param depth: int: the number of plies to search, including the root move
+    :param table: TranspositionTable: an optional table of counts, see perft
+    :return: dict: the number of leaf nodes below each root move
+    """
+
+    counts = {}
+    for move in chess_engine.move_generator.get_legal_moves():
+        if depth == 1:
+            counts[format_move(move)] = 1
+            continue
+        chess_engine.move_maker.apply_move(move, regenerate_moves=False)
+        counts[format_move(move)] = perft(chess_engine, depth - 1, table)
+        chess_engine.move_maker.apply_move(is_undo=True, regenerate_moves=False)
+    return counts
+
+
+def timed_perft(chess_engine, depth, table=None) -> tuple:
+    """Return the perft node count of the position along with the seconds it took"""
+
+    start = time.perf_counter()
+    nodes = perft(chess_engine, depth, table)
+    return nodes, time.perf_counter() - start
+
+
+def report(nodes, seconds) -> str:
+    """Format a node count with its time and speed"""
+
+    return f"{nodes:>10} nodes {seconds:8.3f}s {nodes / max(seconds, 1e-9):10.0f} nodes/s"
+
+
+def run_suite(max_nodes, table=None, out=sys.stdout) -> bool:
+    """
+    Run perft on every test position up to the deepest known count that is at most max_nodes
+
+    Besides the node counts, the position key must be the same after the search as before it, which checks that the
+    key is updated correctly when moves are made and undone.
+
+    :param max_nodes: int: skip depths whose known node count is larger than this
+    :param table: TranspositionTable: an optional table of counts, see perft
+    :param out: the stream to print the report to
+    :return: bool: True if every node count and position key matched
+    """
+
+    passed = True
+    total_nodes = 0
+    total_time = 0.0
+    for name, fen, counts in POSITIONS:
+        print(name, file=out)
+        chess_engine = engine.Engine()
+        chess_engine.set_fen(fen)
+        for depth, expected in enumerate(counts, start=1):
+            if expected > max_nodes:
+                break
+            nodes, seconds = timed_perft(chess_engine, depth, table)
+            total_nodes += nodes
+            total_time += seconds
+            if nodes != expected:
+                status = f"FAIL (expected {expected})"
+            elif chess_engine.key != zobrist.get_key(chess_engine):
+                status = 'FAIL (position key changed)'
+            else:
+                status = 'ok'
+            passed &= status == 'ok'
+            print(f"  depth {depth}: {report(nodes, seconds)}  {status}", file=out)
+
+    print(f"total: {report(total_nodes, total_time)}", file=out)
+    print('all node counts match' if passed else 'NODE COUNT MISMATCH', file=out)
+    if table is not None:
+        print_table_stats(table, out)
+    return passed
+
+
+def print_table_stats(table, out=sys.stdout) -> None:
+    stats = table.get_stats()
+    print(f"hash: {stats['filled']}/{stats['size']} filled, {stats['hits']} hits, {stats['misses']} misses "
+          f"({stats['hit_rate']:.1%} hit rate), {stats['replacements']} replaced", file=out)
+
+
+def run_parallel(chess_engine, args) -> int:
+    """Run perft or divide with the root moves split across worker processes, see main for the arguments"""
+
+    import parallel
+
+    with parallel.make_pool(args.workers, args.hash) as pool:
+        # start the workers before timing, the first searches would otherwise include their start up
+        parallel.parallel_perft(pool, chess_engine, 1)
+
+        start = time.perf_counter()
+        counts = parallel.parallel_divide(pool, chess_engine, args.depth)
+        parallel_time = time.perf_counter() - start
+
+    if args.divide:
+        for move, nodes in sorted(counts.items()):
+            print(f"{move}: {nodes}")
+        print(f"moves: {len(counts)}")
+    nodes = sum(counts.values())
+    print(f"depth {args.depth}, {args.workers} workers: {report(nodes, parallel_time)}")
+
+    if args.compare:
+        single_table = transposition.TranspositionTable(args.hash) if args.hash else None
+        single_nodes, single_time = timed_perft(chess_engine, args.depth, single_table)
+        print(f"depth {args.depth}, 1 process:  {report(single_nodes, single_time)}")
+        print(f"speedup: {single_time / max(parallel_time, 1e-9):.2f}x")
+        if single_nodes != nodes:
+            print('NODE COUNT MISMATCH')
+            return 1
+    return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Count and time the nodes of the legal move tree.')
+    parser.add_argument('depth', type=int, nargs='?', help='search depth, runs the test suite when omitted')
+    parser.add_argument('--fen', default=START_FEN, help='position to search (default: start position)')
+    parser.add_argument('--divide', action='store_true', help='print the node count below each root move')
+    parser.add_argument('--max-nodes', type=int, default=100_000,
+                        help='largest known node count searched by the test suite (default: 100000)')
+    parser.add_argument('--hash', type=int, default=0, metavar='SLOTS',
+                        help='size of the transposition table for node counts (default: no table)')
+    parser.add_argument('--workers', type=int, default=1, help='split the root moves across this many processes')
+    parser.add_argument('--compare', action='store_true',
+                        help='also run in a single process and report the speedup of --workers')
+    parser.add_argument('--profile', metavar='PATH',
+                        help='count and time the move generation and write the stats to a .json or .csv file')
+    args = parser.parse_args(argv)
+
+    table = transposition.TranspositionTable(args.hash) if args.hash else None
+
+    if args.depth is None:
+        return 0 if run_suite(args.max_nodes, table) else 1
+
+    chess_engine = engine.Engine()
+    chess_engine.set_fen(args.fen)
+
+    if args.workers > 1:
+        return run_parallel(chess_engine, args)
+
+    if args.profile:
+        import profiler
+
+        move_profiler = profiler.Profiler()
+        profiler.attach_engine(move_profiler, chess_engine)
+        move_profiler.enable()
+
+    if args.divide:
+        start = time.perf_counter()
+        counts = divide(chess_engine, args.depth, table)
+        seconds = time.perf_counter() - start
+        for move, nodes in sorted(counts.items()):
+            print(f"{move}: {nodes}")
+        print(f"moves: {len(counts)}")
+        nodes = sum(counts.values())
+        print(f"total: {report(nodes, seconds)}")
+    else:
+        for depth in range(1, args.depth + 1):
+            nodes, seconds = timed_perft(chess_engine, depth, table)
+            print(f"depth {depth}: {report(nodes, seconds)}")
+
+    if table is not None:
+        print_table_stats(table)
+    if args.profile:
+        move_profiler.export(args.profile)
+        print('\n'.join(move_profiler.format_lines()))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,362 @@
+"""
+Streaming PGN reading and game replay
+
+Games are read from a PGN file one at a time, so a file of any size is processed in a bounded amount of memory. Each
+game is replayed on a reused Engine by matching its SAN moves against the legal moves of each position, which
+validates the game and finds its final state. Large files can be replayed across a pool of processes, with the main
+process reading games and handing them out in batches.
+
+usage:
+    python src/pgn.py games.pgn
+    python src/pgn.py games.pgn --workers 4 --errors
+    python src/pgn.py --check    # read games that were once read wrongly
+"""
+import argparse
+import collections
+import concurrent.futures
+import re
+import sys
+import time
+
+import engine
+from engine import CASTLE, PROMOTE_N, PROMOTION_PIECES
+from perft import START_FEN
+
+RESULTS = ('1-0', '0-1', '1/2-1/2', '*')
+
+_TAG = re.compile(r'\[\s*(\w+)\s*"((?:[^"\\]|\\.)*)"\s*\]')
+# comments, variations and numeric annotation glyphs are skipped, the rest of the movetext splits into tokens
+_MOVETEXT_TOKEN = re.compile(r'\{[^}]*\}|;[^\n]*|\(|\)|\$\d+|[^\s(){};]+')
+_MOVE_NUMBER = re.compile(r'\d+\.+')
+_COMMENT_START = re.compile(r'[{;]')
+# games that were once read wrongly, with the Event tag, number of plies and checkmate state each must be read with
+CHECK_PGN = '''[Event "brace in a rest-of-line comment"]
+
+1. e4 e5 2. Bc4 Nc6 3. Qh5 Nf6 ; a comment { with a brace
+4. Qxf7# 1-0
+
+[Event "game after it"]
+
+1. d4 d5 *
+
+[Event "tag pair in a comment"]
+
+1. e4 { a comment over lines ; with a semicolon
+[Event "not a game"]
+} e5 *
+'''
+CHECK_GAMES = (
+    ('brace in a rest-of-line comment', 7, True),
+    ('game after it', 2, False),
+    ('tag pair in a comment', 2, False),
+)
+_SAN = re.compile(r'([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([NBRQnbrq]))?')
+
+
+def read_games(lines):
+    """
+    Read games from PGN text one at a time
+
+    :param lines: an iterable of lines, such as an open file
+    :return: generator: a (tags, movetext) pair for each game, with the tags in a dict
+    """
+
+    tags = {}
+    movetext = []
+    in_comment = False  # a comment in braces may span lines, and a line inside it is never a tag pair
+
+    for line in lines:
+        stripped = line.strip()
+        if not in_comment and stripped.startswith('['):
+            if movetext:
+                yield tags, ''.join(movetext)
+                tags = {}
+                movetext = []
+            match = _TAG.match(stripped)
+            if match:
+                tags[match.group(1)] = match.group(2).replace('\\"', '"').replace('\\\\', '\\')
+        elif stripped.startswith('%') and not in_comment:
+            continue  # an escaped line
+        elif stripped or movetext:
+            movetext.append(line if line.endswith('\n') else line + '\n')
+            in_comment = _ends_in_comment(line, in_comment)
+
+    if tags or ''.join(movetext).strip():
+        yield tags, ''.join(movetext)
+
+
+def _ends_in_comment(line, in_comment) -> bool:
+    """
+    Follow the comments of a line of movetext
+
+    Inside a comment in braces only a closing brace counts, and a comment from a semicolon to the end of the line
+    ignores braces.
+
+    :param line: str: the line
+    :param in_comment: bool: whether the line starts inside a comment in braces
+    :return: bool: whether the line ends inside a comment in braces
+    """
+
+    pos = 0
+    while True:
+        if in_comment:
+            pos = line.find('}', pos)
+            if pos < 0:
+                return True
+            in_comment = False
+            pos += 1
+        else:
+            match = _COMMENT_START.search(line, pos)
+            if match is None or match.group() == ';':
+                return False
+            in_comment = True
+            pos = match.end()
+
+
+def split_movetext(movetext) -> tuple:
+    """
+    Find the moves of the main line of a game
+
+    :param movetext: str: the movetext section of a game
+    :return: tuple: a list of the SAN moves and the game termination marker, or None if there isn't one
+    """
+
+    moves = []
+    result = None
+    variation_depth = 0
+    for token in _MOVETEXT_TOKEN.findall(movetext):
+        first = token[0]
+        if first == '(':
+            variation_depth += 1
+        elif first == ')':
+            variation_depth -= 1
+        elif variation_depth or first in '{;$':
+            continue
+        elif token in RESULTS:
+            result = token
+        else:
+            # a move number may be joined to its move, as in 1.e4
+            token = _MOVE_NUMBER.sub('', token, count=1) if first.isdigit() else token
+            if token:
+                moves.append(token)
+    return moves, result
+
+
+def parse_san(chess_engine, san, legal_moves=None) -> int:
+    """
+    Find the legal move described in standard algebraic notation
+
+    :param chess_engine: the engine holding the position
+    :param san: str: the move, e.g. 'e4', 'Nbd7', 'exd6', 'O-O' or 'e8=Q+'
+    :param legal_moves: list: the legal moves of the position, generated when not given
+    :return: int: the packed move
+    :raises ValueError: if the move can't be read, is illegal or is ambiguous
+    """
+
+    if legal_moves is None:
+        legal_moves = chess_engine.move_generator.get_legal_moves()
+    text = san.rstrip('+#!?')
+
+    if text in ('O-O', '0-0', 'O-O-O', '0-0-0'):
+        col = 6 if len(text) == 3 else 2
+        for move in legal_moves:
+            if move >> 12 == CASTLE and move >> 6 & 7 == col:
+                return move
+        raise ValueError(f"illegal move {san!r}")
+
+    match = _SAN.fullmatch(text)
+    if match is None:
+        raise ValueError(f"can't read move {san!r}")
+    piece_type, from_file, from_rank, target, promotion = match.groups()
+    piece_type = piece_type.lower() if piece_type else 'p'
+    to_sq = (8 - int(target[1])) * 8 + 'abcdefgh'.index(target[0])
+    flag = PROMOTE_N + PROMOTION_PIECES.index(promotion.lower()) if promotion else None
+
+    squares = chess_engine.squares
+    found = []
+    for move in legal_moves:
+        from_sq = move & 63
+        if move >> 6 & 63 != to_sq or squares[from_sq][1] != piece_type:
+            continue
+        if from_file and 'abcdefgh'[from_sq & 7] != from_file or from_rank and 8 - (from_sq >> 3) != int(from_rank):
+            continue
+        move_flag = move >> 12
+        if (move_flag if move_flag >= PROMOTE_N else None) != flag:
+            continue
+        found.append(move)
+
+    if not found:
+        raise ValueError(f"illegal move {san!r}")
+    if len(found) > 1:
+        raise ValueError(f"ambiguous move {san!r}")
+    return found[0]
+
+
+def replay_game(chess_engine, tags, movetext) -> dict:
+    """
+    Play through a game on the engine, stopping at the first move that can't be played
+
+    :param chess_engine: the engine to play the game on, its position is replaced
+    :param tags: dict: the tag pairs of the game, a FEN tag sets the starting position
+    :param movetext: str: the movetext of the game
+    :return: dict: the number of plies played, the error of the first move that couldn't be played (or None), the
+        stalemate and checkmate state of the final position, the recorded result and the final FEN
+    """
+
+    moves, result = split_movetext(movetext)
+    error = None
+    plies = 0
+    try:
+        chess_engine.set_fen(tags.get('FEN', START_FEN))
+    except ValueError as e:
+        error = f"bad FEN tag: {e}"
+        moves = []
+
+    move_generator = chess_engine.move_generator
+    move_maker = chess_engine.move_maker
+    for san in moves:
+        try:
+            move = parse_san(chess_engine, san, move_generator.get_legal_moves())
+        except ValueError as e:
+            error = f"ply {plies + 1}: {e}"
+            break
+        move_maker.apply_move(move, regenerate_moves=False)
+        plies += 1
+
+    stalemate, checkmate = chess_engine.get_endgame_state()
+    return {
+        'plies': plies,
+        'error': error,
+        'stalemate': stalemate,
+        'checkmate': checkmate,
+        'result': tags.get('Result', result),
+        'fen': chess_engine.get_fen(),
+    }
+
+
+def replay_games(games, chess_engine=None):
+    """
+    Replay games one at a time on a single engine
+
+    :param games: an iterable of (tags, movetext) pairs, such as read_games
+    :param chess_engine: the engine to reuse, one is made when not given
+    :return: generator: a dict for each game like replay_game, along with its tags
+    """
+
+    chess_engine = chess_engine or engine.Engine()
+    for tags, movetext in games:
+        game = replay_game(chess_engine, tags, movetext)
+        game['tags'] = tags
+        yield game
+
+
+# the engine of a worker process, created once by _init_worker
+_engine = None
+
+
+def _init_worker() -> None:
+    global _engine
+    _engine = engine.Engine()
+
+
+def _replay_batch(games) -> list:
+    return list(replay_games(games, _engine))
+
+
+def parallel_replay_games(games, workers, batch_size=100, max_pending=None):
+    """
+    Replay games across a pool of processes, see replay_games
+
+    Games are sent to the workers in batches, and no more than max_pending batches are waiting or running at once, so
+    memory use stays bounded however many games there are. Results come back in the order of the games.
+
+    :param games: an iterable of (tags, movetext) pairs, such as read_games
+    :param workers: int: the number of processes
+    :param batch_size: int: the number of games sent to a worker at a time
+    :param max_pending: int: the number of batches in flight, defaults to twice the number of workers
+    :return: generator: a dict for each game like replay_games
+    """
+
+    max_pending = max_pending or 2 * workers
+    pending = collections.deque()
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=_init_worker) as pool:
+        batch = []
+        for game in games:
+            batch.append(game)
+            if len(batch) < batch_size:
+                continue
+            pending.append(pool.submit(_replay_batch, batch))
+            batch = []
+            if len(pending) >= max_pending:
+                yield from pending.popleft().result()
+
+        if batch:
+            pending.append(pool.submit(_replay_batch, batch))
+        while pending:
+            yield from pending.popleft().result()
+
+
+def run_checks(out=sys.stdout) -> bool:
+    """
+    Read and replay CHECK_PGN and compare the games with CHECK_GAMES
+
+    :param out: the stream to print the report to
+    :return: bool: True if every game was read as expected
+    """
+
+    games = [(game['tags'].get('Event'), game['plies'], game['checkmate'], game['error'])
+             for game in replay_games(read_games(CHECK_PGN.splitlines(True)))]
+    expected = [(*game, None) for game in CHECK_GAMES]
+    for found in games:
+        print(f"{found[0]}: {found[1]} plies{', checkmate' if found[2] else ''}{', ' + found[3] if found[3] else ''}  "
+              f"{'ok' if found in expected else 'FAIL'}", file=out)
+    passed = games == expected
+    print('all games read as expected' if passed else 'GAMES READ WRONGLY', file=out)
+    return passed
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Replay the games of a PGN file to check that their moves are legal.')
+    parser.add_argument('path', nargs='?', help='the PGN file')
+    parser.add_argument('--check', action='store_true', help='read games that were once read wrongly and stop')
+    parser.add_argument('--workers', type=int, default=1, help='replay games across this many processes')
+    parser.add_argument('--batch-size', type=int, default=100, help='games sent to a worker at a time (default: 100)')
+    parser.add_argument('--errors', action='store_true', help='print each game that has an illegal move')
+    args = parser.parse_args(argv)
+
+    if args.check:
+        return 0 if run_checks() else 1
+    if args.path is None:
+        parser.error('a PGN file is needed unless --check is given')
+
+    counts = collections.Counter()
+    start = time.perf_counter()
+    with open(args.path, encoding='utf-8', errors='replace') as file:
+        games = read_games(file)
+        if args.workers > 1:
+            results = parallel_replay_games(games, args.workers, args.batch_size)
+        else:
+            results = replay_games(games)
+
+        for index, game in enumerate(results, 1):
+            counts['games'] += 1
+            counts['plies'] += game['plies']
+            if game['error']:
+                counts['errors'] += 1
+                if args.errors:
+                    tags = game['tags']
+                    print(f"game {index} ({tags.get('White', '?')} - {tags.get('Black', '?')}): {game['error']}")
+            elif game['checkmate']:
+                counts['checkmates'] += 1
+            elif game['stalemate']:
+                counts['stalemates'] += 1
+
+    seconds = max(time.perf_counter() - start, 1e-9)
+    print(f"{counts['games']} games, {counts['plies']} plies in {seconds:.2f}s "
+          f"({counts['plies'] / seconds:.0f} plies/s)")
+    print(f"{counts['errors']} with errors, {counts['checkmates']} checkmates, {counts['stalemates']} stalemates")
+    return 1 if counts['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,192 @@
+"""
+Counters and timers for the hot paths
+
+A Profiler replaces methods of the objects attached to it with timing wrappers while it is enabled, and removes the
+wrappers again when it is disabled. The wrappers are set on the instances, so a disabled profiler leaves the plain
+class methods in place and costs nothing. For each method it records the number of calls, the total and longest wall
+time, and optionally the number of items returned, such as the moves generated. A generator method is timed while it
+runs between yields, and its items are the values it yields.
+
+Stats can be exported as JSON or CSV to compare runs offline.
+"""
+import csv
+import json
+import operator
+import time
+
+FIELDS = ('name', 'calls', 'items', 'total_ms', 'mean_us', 'max_ms', 'items_per_call')
+
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        # each attached method as an (object, method name, stat name, how to count items, is a generator) tuple
+        self.targets = []
+        self.stats = {}  # [calls, items, total seconds, longest seconds] for each stat name
+
+    def attach(self, obj, method_name, name=None, count_items=False, generator=False) -> None:
+        """
+        Add a method to profile, it is wrapped straight away if the profiler is enabled
+
+        :param obj: the object whose method is profiled
+        :param method_name: str: the name of the method
+        :param name: str: the name of the stat, the method name by default
+        :param count_items: bool or callable: also count the length of the returned values, or the number a callable
+            makes of each returned value
+        :param generator: bool: the method is a generator, the values it yields are counted as its items
+        :return: None
+        """
+
+        target = (obj, method_name, name or method_name, count_items, generator)
+        self.targets.append(target)
+        if self.enabled:
+            self._wrap(*target)
+
+    def enable(self) -> None:
+        if not self.enabled:
+            self.enabled = True
+            for target in self.targets:
+                self._wrap(*target)
+
+    def disable(self) -> None:
+        if self.enabled:
+            self.enabled = False
+            for obj, method_name, *_ in self.targets:
+                if method_name in vars(obj):
+                    delattr(obj, method_name)  # the class method shows through again
+
+    def toggle(self) -> bool:
+        """
+        :return: bool: whether the profiler is now enabled
+        """
+
+        if self.enabled:
+            self.disable()
+        else:
+            self.enable()
+        return self.enabled
+
+    def reset(self) -> None:
+        """Zero every counter"""
+
+        for stat in self.stats.values():
+            stat[:] = [0, 0, 0.0, 0.0]
+
+    def _wrap(self, obj, method_name, name, count_items, generator) -> None:
+        method = getattr(obj, method_name)
+        stat = self.stats.setdefault(name, [0, 0, 0.0, 0.0])
+        perf_counter = time.perf_counter
+        if generator:
+            setattr(obj, method_name, self._generator_wrapper(method, stat))
+            return
+        count = len if count_items is True else count_items
+
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            result = method(*args, **kwargs)
+            elapsed = perf_counter() - start
+            stat[0] += 1
+            stat[2] += elapsed
+            if elapsed > stat[3]:
+                stat[3] = elapsed
+            if count:
+                stat[1] += count(result)
+            return result
+
+        setattr(obj, method_name, wrapper)
+
+    @staticmethod
+    def _generator_wrapper(method, stat):
+        perf_counter = time.perf_counter
+
+        def wrapper(*args, **kwargs):
+            stat[0] += 1
+            items = method(*args, **kwargs)
+            elapsed = 0.0
+            try:
+                while True:
+                    start = perf_counter()
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        return
+                    finally:
+                        elapsed += perf_counter() - start
+                    stat[1] += 1
+                    yield item
+            finally:
+                # a caller that stops early closes the generator, the time until then is recorded
+                stat[2] += elapsed
+                if elapsed > stat[3]:
+                    stat[3] = elapsed
+
+        return wrapper
+
+    def get_rows(self) -> list:
+        """
+        :return: list: a dict of the FIELDS of each stat that has been called
+        """
+
+        rows = []
+        for name, (calls, items, total, longest) in self.stats.items():
+            if calls:
+                rows.append({
+                    'name': name,
+                    'calls': calls,
+                    'items': items,
+                    'total_ms': round(total * 1e3, 3),
+                    'mean_us': round(total / calls * 1e6, 3),
+                    'max_ms': round(longest * 1e3, 3),
+                    'items_per_call': round(items / calls, 3),
+                })
+        return rows
+
+    def format_lines(self) -> list:
+        """
+        :return: list: a short line of text for each stat, for the overlay
+        """
+
+        lines = []
+        for row in self.get_rows():
+            line = f"{row['name']}: {row['calls']} calls, {row['mean_us']:.0f}us mean, {row['max_ms']:.1f}ms max"
+            if row['items']:
+                line += f", {row['items']} items, {row['items_per_call']:.1f} per call"
+            lines.append(line)
+        return lines or ['profiling, nothing called yet']
+
+    def export(self, path) -> None:
+        """
+        Write the stats to a file, as CSV if the path ends in .csv and as JSON otherwise
+
+        :param path: str: the path of the file
+        :return: None
+        """
+
+        rows = self.get_rows()
+        with open(path, 'w', newline='') as file:
+            if path.endswith('.csv'):
+                writer = csv.DictWriter(file, FIELDS)
+                writer.writeheader()
+                writer.writerows(rows)
+            else:
+                json.dump({'time': time.time(), 'stats': rows}, file, indent=2)
+
+
+def attach_engine(profiler, chess_engine, prefix='') -> None:
+    """
+    Profile the move generation and move making of an engine
+
+    :param profiler: Profiler: the profiler to attach to
+    :param chess_engine: the engine to profile
+    :param prefix: str: added to the start of the stat names, to tell engines apart
+    :return: None
+    """
+
+    profiler.attach(chess_engine.move_generator, 'get_legal_moves', f"{prefix}legal moves", count_items=True)
+    profiler.attach(chess_engine.move_generator, 'get_pseudo_legal_moves', f"{prefix}pseudo-legal moves",
+                    count_items=True)
+    profiler.attach(chess_engine.move_maker, 'apply_move', f"{prefix}apply move")
+    # the search generates moves in stages and checks each pseudo-legal move as it is yielded
+    profiler.attach(chess_engine.move_generator, 'generate_staged', f"{prefix}staged moves", generator=True)
+    profiler.attach(chess_engine.move_generator, '_is_legal', f"{prefix}moves filtered as illegal",
+                    count_items=operator.not_)
@@ -0,0 +1,420 @@
+"""
+Alpha-beta search for a computer player
+
+The search is a negamax alpha-beta search with iterative deepening. Each iteration searches one ply deeper than the
+last, until the depth limit is reached or the time budget runs out, and the best move of the deepest finished iteration
+is played. Leaf positions are resolved with a quiescence search over captures. Moves are ordered with the move from the
+transposition table first, then captures by most valuable victim and least valuable attacker (MVV-LVA), then
+promotions, then killer moves and then quiet moves by their history score. Each group is generated only when the search
+reaches it, so a cutoff on an early move skips generating the rest.
+
+usage:
+    python src/search.py --movetime 5
+    python src/search.py --fen "<fen>" --depth 4
+"""
+import argparse
+import sys
+import time
+
+import engine
+import tablebase
+import transposition
+from engine import EN_PASSANT
+from evaluation import evaluate
+
+INFINITY = 1_000_000
+MATE = 100_000
+MATE_BOUND = MATE - 1000  # scores beyond this are mates, found within 1000 plies
+
+MAX_DEPTH = 64
+CHECK_INTERVAL = 64  # the number of nodes between checks of the clock, a few milliseconds of search
+
+
+def to_table_score(score, ply) -> int:
+    """Store mate scores as the distance from the stored position instead of from the root"""
+
+    if score > MATE_BOUND:
+        return score + ply
+    if score < -MATE_BOUND:
+        return score - ply
+    return score
+
+
+def from_table_score(score, ply) -> int:
+    if score > MATE_BOUND:
+        return score - ply
+    if score < -MATE_BOUND:
+        return score + ply
+    return score
+
+
+def mate_in(score):
+    """Return the number of moves to a forced mate (negative when being mated), or None if the score isn't a mate"""
+
+    if score > MATE_BOUND:
+        return (MATE - score + 1) // 2
+    if score < -MATE_BOUND:
+        return -(MATE + score) // 2
+    return None
+
+
+class Searcher:
+    def __init__(self, chess_engine, table=None, tablebase=None, evaluator=evaluate):
+        """
+        :param chess_engine: the engine holding the position to search, the position is restored after each search
+        :param table: TranspositionTable: the table to share between searches, a new one is made by default
+        :param tablebase: Tablebase: endgame tables that score the positions they cover exactly, see tablebase.py
+        :param evaluator: callable: scores the leaf positions, evaluation.evaluate by default
+        """
+
+        self.engine = chess_engine
+        self.table = table if table is not None else transposition.TranspositionTable()
+        self.tablebase = tablebase
+        self.evaluator = evaluator
+
+        self.killers = [[None, None] for _ in range(MAX_DEPTH + 1)]
+        self.history = {'w': {}, 'b': {}}
+
+        self.deadline = None
+        self.soft_deadline = None  # no iteration is started after it
+        self.soft_time_limit = None
+        self.stopped = False
+        self.next_check = CHECK_INTERVAL
+
+        # statistics of the current search
+        self.depth = 0
+        self.seldepth = 0
+        self.nodes = 0
+        self.tablebase_hits = 0
+        self.score = 0
+        self.pv = []
+        self.start_time = 0.0
+
+    def search(self, max_depth=MAX_DEPTH, time_limit=None, on_iteration=None, root_moves=None, soft_time_limit=None):
+        """
+        Find the best move of the current position
+
+        :param max_depth: int: the deepest iteration to search
+        :param time_limit: float: the number of seconds the search may take, the search is stopped when they run out
+        :param on_iteration: callable: called with the stats dict after each finished iteration
+        :param root_moves: list: the legal moves to choose from, all legal moves by default
+        :param soft_time_limit: float: the number of seconds after which no new iteration is started, as it would
+            likely be stopped before it finishes. An iteration that changes the best move extends it by half
+        :return: the best move, or None if there are no legal moves
+        """
+
+        self.start_time = time.perf_counter()
+        self._set_deadlines(self.start_time, time_limit, soft_time_limit)
+        self.stopped = False
+        self.next_check = CHECK_INTERVAL
+        self.depth = self.seldepth = self.nodes = self.tablebase_hits = self.score = 0
+        self.pv = []
+        self.killers = [[None, None] for _ in range(MAX_DEPTH + 1)]
+        self.table.new_search()
+
+        if root_moves is None:
+            root_moves = self.engine.move_generator.get_legal_moves()
+        if not root_moves:
+            return None
+        best_move = root_moves[0]
+
+        for depth in range(1, min(max_depth, MAX_DEPTH) + 1):
+            score, move, pv = self._search_root(depth, root_moves, best_move)
+            if self.stopped:
+                # the previous best move is searched first, so a partial iteration is used once it has been searched
+                if move is not None:
+                    best_move, self.score, self.pv = move, score, pv
+                break
+
+            changed = move != best_move
+            best_move = move
+            self.depth, self.score, self.pv = depth, score, pv
+            if on_iteration is not None:
+                on_iteration(self.get_stats())
+            if abs(score) > MATE_BOUND and MATE - abs(score) <= depth:
+                break  # a forced mate was found that no deeper search can improve on
+            if self.soft_deadline is not None:
+                extension = self.soft_time_limit / 2 if changed else 0.0
+                if time.perf_counter() >= self.soft_deadline + extension:
+                    break
+
+        return best_move
+
+    def set_time_limit(self, time_limit, soft_time_limit=None) -> None:
+        """
+        Change the time limit of the running search
+
+        :param time_limit: float: the number of seconds the search may take from now, None to search until stopped
+        :param soft_time_limit: float: the number of seconds from now after which no new iteration is started
+        :return: None
+        """
+
+        self._set_deadlines(time.perf_counter(), time_limit, soft_time_limit)
+
+    def stop(self) -> None:
+        """Stop the search as soon as possible, it returns the best move found so far"""
+
+        self.stopped = True
+
+    def get_stats(self) -> dict:
+        """
+        :return: dict: the depth reached, node count, speed, score and principal variation of the last search
+        """
+
+        elapsed = time.perf_counter() - self.start_time
+        return {
+            'depth': self.depth,
+            'seldepth': self.seldepth,
+            'nodes': self.nodes,
+            'time': elapsed,
+            'nps': int(self.nodes / elapsed) if elapsed > 0 else 0,
+            'tbhits': self.tablebase_hits,
+            'score': self.score,
+            'mate': mate_in(self.score),
+            'pv': list(self.pv),
+            'hash': self.table.get_stats(),
+        }
+
+    def _search_root(self, depth, root_moves, best_move) -> tuple:
+        alpha, beta = -INFINITY, INFINITY
+        best_score, best, best_pv = -INFINITY, None, []
+
+        # the best move of the previous iteration is searched first
+        moves = sorted(root_moves, key=lambda m: m != best_move)
+
+        move_maker = self.engine.move_maker
+        for move in moves:
+            move_maker.apply_move(move, regenerate_moves=False)
+            score, child_pv = self._negamax(depth - 1, -beta, -alpha, 1)
+            score = -score
+            move_maker.apply_move(is_undo=True, regenerate_moves=False)
+            if self.stopped:
+                break
+
+            if score > best_score:
+                best_score, best, best_pv = score, move, [move] + child_pv
+                alpha = max(alpha, score)
+
+        if best is not None:
+            self.table.store(self.engine.key, depth, to_table_score(best_score, 0), transposition.EXACT, best)
+        return best_score, best, best_pv
+
+    def _negamax(self, depth, alpha, beta, ply) -> tuple:
+        """
+        Search a position to a fixed depth
+
+        :return: tuple: the score of the position and its principal variation
+        """
+
+        if depth <= 0:
+            return self._quiescence(alpha, beta, ply), []
+
+        self._count_node(ply)
+        if self.stopped:
+            return 0, []
+
+        chess_engine = self.engine
+        if self.tablebase is not None:
+            score = self._probe_tablebase(ply)
+            if score is not None:
+                return score, []
+
+        key = chess_engine.key
+        original_alpha = alpha
+
+        tt_move = None
+        entry = self.table.probe(key)
+        if entry is not None:
+            _, entry_depth, value, flag, tt_move, _ = entry
+            if entry_depth >= depth:
+                value = from_table_score(value, ply)
+                if flag == transposition.EXACT or \
+                        (flag == transposition.LOWER and value >= beta) or \
+                        (flag == transposition.UPPER and value <= alpha):
+                    return value, []
+
+        # moves are generated in stages as they are searched, so a cutoff skips generating the rest
+        best_score, best_move, best_pv = -INFINITY, None, []
+        move_maker = chess_engine.move_maker
+        for move in chess_engine.move_generator.generate_staged(tt_move, self._quiet_key(ply)):
+            move_maker.apply_move(move, regenerate_moves=False)
+            score, child_pv = self._negamax(depth - 1, -beta, -alpha, ply + 1)
+            score = -score
+            move_maker.apply_move(is_undo=True, regenerate_moves=False)
+            if self.stopped:
+                return 0, []
+
+            if score > best_score:
+                best_score, best_move = score, move
+                if score > alpha:
+                    alpha = score
+                    best_pv = [move] + child_pv
+                    if alpha >= beta:
+                        if not self._is_capture(move):
+                            self._update_quiet_cutoff(move, depth, ply)
+                        break
+
+        if best_move is None:
+            king = chess_engine.pieces[f"{chess_engine.current_color}k"]
+            if chess_engine.move_generator.is_square_attacked(king.bit_length() - 1, chess_engine.enemy_color):
+                return -MATE + ply, []  # checkmate
+            return 0, []  # stalemate
+
+        if best_score <= original_alpha:
+            flag = transposition.UPPER
+        elif best_score >= beta:
+            flag = transposition.LOWER
+        else:
+            flag = transposition.EXACT
+        self.table.store(key, depth, to_table_score(best_score, ply), flag, best_move)
+        return best_score, best_pv
+
+    def _probe_tablebase(self, ply):
+        """
+        :return: int: the exact score of the position from the tablebase, or None if it isn't covered
+        """
+
+        occupied = self.engine.occupied
+        if bin(occupied['w'] | occupied['b']).count('1') > tablebase.MAX_PIECES + 2:
+            return None
+        found = self.tablebase.probe(self.engine)
+        if found is None:
+            return None
+
+        self.tablebase_hits += 1
+        result, distance = found
+        if result == tablebase.WIN:
+            return MATE - ply - distance
+        if result == tablebase.LOSS:
+            return -MATE + ply + distance
+        return 0
+
+    def _quiescence(self, alpha, beta, ply) -> int:
+        """Search captures and promotions until the position is quiet, so that leaves aren't scored mid-exchange"""
+
+        self._count_node(ply)
+        if self.stopped:
+            return 0
+
+        stand_pat = self.evaluator(self.engine)
+        if stand_pat >= beta:
+            return stand_pat
+        alpha = max(alpha, stand_pat)
+
+        move_maker = self.engine.move_maker
+        for move in self.engine.move_generator.generate_staged(quiets=False):
+            move_maker.apply_move(move, regenerate_moves=False)
+            score = -self._quiescence(-beta, -alpha, ply + 1)
+            move_maker.apply_move(is_undo=True, regenerate_moves=False)
+            if self.stopped:
+                return 0
+
+            if score >= beta:
+                return score
+            alpha = max(alpha, score)
+
+        return alpha
+
+    def _set_deadlines(self, now, time_limit, soft_time_limit) -> None:
+        self.deadline = None if time_limit is None else now + time_limit
+        # the limit is set before the deadline, another thread may change them while the search reads them
+        self.soft_time_limit = soft_time_limit
+        self.soft_deadline = None if soft_time_limit is None else now + soft_time_limit
+
+    def _count_node(self, ply) -> None:
+        self.nodes += 1
+        self.seldepth = max(self.seldepth, ply)
+        if self.nodes >= self.next_check:
+            self.next_check += CHECK_INTERVAL
+            if self.deadline is not None and time.perf_counter() >= self.deadline:
+                self.stopped = True
+
+    def _is_capture(self, move) -> bool:
+        return self.engine.squares[move >> 6 & 63] != '--' or move >> 12 == EN_PASSANT
+
+    def _quiet_key(self, ply):
+        """
+        :return: callable: the order of the quiet moves at a ply, killer moves first and then by history score
+        """
+
+        killers = self.killers[ply] if ply <= MAX_DEPTH else (None, None)
+        history = self.history[self.engine.current_color]
+
+        def score(move):
+            if move == killers[0]:
+                return 2_000_000
+            if move == killers[1]:
+                return 1_000_000
+            return history.get(move & 0xfff, 0)
+
+        return score
+
+    def _update_quiet_cutoff(self, move, depth, ply) -> None:
+        """Remember a quiet move that caused a beta cutoff as a killer of its ply and raise its history score"""
+
+        if ply <= MAX_DEPTH:
+            killers = self.killers[ply]
+            if killers[0] != move:
+                killers[1], killers[0] = killers[0], move
+
+        # indexed by the starting and target squares of the move
+        history = self.history[self.engine.current_color]
+        history[move & 0xfff] = min(history.get(move & 0xfff, 0) + depth * depth, 700_000)
+
+
+def format_score(stats) -> str:
+    if stats['mate'] is not None:
+        return f"mate {stats['mate']}"
+    return f"cp {stats['score']}"
+
+
+def main(argv=None) -> int:
+    import perft
+
+    parser = argparse.ArgumentParser(description='Search a position and print the stats of each iteration.')
+    parser.add_argument('--fen', default=perft.START_FEN, help='position to search (default: start position)')
+    parser.add_argument('--depth', type=int, default=MAX_DEPTH, help='deepest iteration to search')
+    parser.add_argument('--movetime', type=float, help='seconds to search for')
+    parser.add_argument('--workers', type=int, default=1, help='split the root moves across this many processes')
+    parser.add_argument('--tablebase', metavar='DIR', help='a directory of endgame tables, see tablebase.py')
+    parser.add_argument('--compare', action='store_true',
+                        help='also run a single-process search and report the speedup of --workers, '
+                             'use with --depth so that both searches do the same work')
+    args = parser.parse_args(argv)
+
+    chess_engine = engine.Engine()
+    chess_engine.set_fen(args.fen)
+
+    parallel_stats = None
+    if args.workers > 1:
+        import parallel
+
+        with parallel.make_pool(args.workers) as pool:
+            best_move, parallel_stats = parallel.parallel_search(pool, chess_engine, args.workers, args.depth,
+                                                                 args.movetime)
+        print(f"{args.workers} workers: depth {parallel_stats['depth']} score {format_score(parallel_stats)} "
+              f"nodes {parallel_stats['nodes']} nps {parallel_stats['nps']} time {parallel_stats['time']:.3f} "
+              f"pv {' '.join(parallel_stats['pv'])}")
+        print(f"bestmove {perft.format_move(best_move) if best_move is not None else '(none)'}")
+        if not args.compare:
+            return 0
+
+    searcher = Searcher(chess_engine, tablebase=tablebase.Tablebase(args.tablebase) if args.tablebase else None)
+
+    def print_iteration(stats):
+        pv = ' '.join(perft.format_move(move) for move in stats['pv'])
+        print(f"depth {stats['depth']} seldepth {stats['seldepth']} score {format_score(stats)} "
+              f"nodes {stats['nodes']} nps {stats['nps']} time {stats['time']:.3f} pv {pv}")
+
+    best_move = searcher.search(args.depth, args.movetime, print_iteration)
+    print(f"bestmove {perft.format_move(best_move) if best_move is not None else '(none)'}")
+
+    if parallel_stats is not None:
+        single_time = searcher.get_stats()['time']
+        print(f"speedup of {args.workers} workers: {single_time / parallel_stats['time']:.2f}x "
+              f"({single_time:.3f}s single process, {parallel_stats['time']:.3f}s parallel)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,326 @@
+"""
+Hosting many games at once from one process
+
+A GameServer holds each game as a small record: the position packed by Engine.get_position, the moves played as
+2-byte ints and the position keys since the last capture or pawn move, which are all the repetition rule can look at.
+A game takes a few hundred bytes this way, against several kilobytes for an Engine with its board, caches and move
+generator. Every game shares one Engine: to play a move, the game's position is loaded into it, the move is checked
+against the legal moves and made, and the new position is packed back into the game. The attack tables and Zobrist
+keys are module-level, so they are shared as well.
+
+The server speaks a line-based protocol over a local TCP or Unix socket, and asyncio serves every connection from one
+thread. A command runs from start to finish without awaiting, so the shared Engine is never used by two commands at
+once. Replies start with 'ok' or 'error':
+
+    new [<fen>]             start a game, replies with its id
+    move <id> <move>        play a move in coordinate notation, e.g. e2e4 or e7e8q, replies with the result and the
+                            reason when it ends the game
+    legal <id>              the legal moves
+    fen <id>                the position
+    moves <id>              the moves played
+    close <id>              forget a game
+    stats                   the number of games, their memory and the latency of moves
+
+usage:
+    python src/server.py --port 8765
+    python src/server.py --bench --games 5000 --clients 50
+"""
+import argparse
+import array
+import asyncio
+import collections
+import itertools
+import random
+import sys
+import time
+import tracemalloc
+
+import engine
+import history
+import perft
+import uci
+
+LATENCY_SAMPLES = 10_000  # the number of recent moves the latency percentiles are taken from
+
+
+class Game:
+    __slots__ = ('position', 'moves', 'keys', 'result', 'reason')
+
+    def __init__(self, position, key):
+        """
+        :param position: bytes: the start position packed by Engine.get_position
+        :param key: int: the Zobrist key of the start position
+        """
+
+        self.position = position
+        self.moves = array.array('H')  # the packed moves played
+        self.keys = array.array('Q', (key,))  # the keys since the last capture or pawn move, for repetitions
+        self.result = None  # '1-0', '0-1' or '1/2-1/2' once the game has ended
+        self.reason = None
+
+    def get_size(self) -> int:
+        """
+        :return: int: the bytes taken by the game and its fields, apart from the result strings, which are shared
+        """
+
+        return sys.getsizeof(self) + sys.getsizeof(self.position) + sys.getsizeof(self.moves) + \
+            sys.getsizeof(self.keys)
+
+
+class GameServer:
+    def __init__(self):
+        self.engine = engine.Engine()
+        self.games = {}
+        self._ids = itertools.count(1)
+        self._loaded = None  # the game whose position the engine holds, so that it needn't be loaded again
+        self.moves_played = 0
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)  # the seconds taken by recent moves
+
+    def handle(self, line) -> str:
+        """
+        Run a command
+
+        :param line: str: the command line
+        :return: str: the reply, without a line break
+        """
+
+        tokens = line.split()
+        if not tokens:
+            return 'error empty command'
+        command, args = tokens[0], tokens[1:]
+        if command == 'new':
+            return self.new_game(' '.join(args) if args else perft.START_FEN)
+        if command == 'stats':
+            return 'ok ' + ' '.join(f"{name} {value}" for name, value in self.get_stats().items())
+        if command not in ('move', 'legal', 'fen', 'moves', 'close'):
+            return f"error unknown command {command}"
+
+        game_id = int(args[0]) if args and args[0].isdigit() else None
+        game = self.games.get(game_id)
+        if game is None:
+            return 'error unknown game'
+        if command == 'move':
+            if len(args) != 2:
+                return 'error expected move <id> <move>'
+            return self.play_move(game, args[1])
+        if command == 'close':
+            del self.games[game_id]
+            if self._loaded is game:
+                self._loaded = None
+            return 'ok'
+
+        chess_engine = self._load(game)
+        if command == 'legal':
+            return ' '.join(['ok', *map(perft.format_move, chess_engine.move_generator.get_legal_moves())])
+        if command == 'fen':
+            return f"ok {chess_engine.get_fen()}"
+        return ' '.join(['ok', *map(perft.format_move, game.moves)])
+
+    def new_game(self, fen) -> str:
+        chess_engine = self.engine
+        self._loaded = None
+        try:
+            chess_engine.set_fen(fen)
+        except (ValueError, IndexError, KeyError):
+            return 'error invalid fen'
+
+        game_id = next(self._ids)
+        game = Game(chess_engine.get_position(), chess_engine.key)
+        self.games[game_id] = game
+        self._loaded = game
+        self._check_end(game)
+        return f"ok {game_id}"
+
+    def play_move(self, game, text) -> str:
+        """
+        Play a move in a game, if it is legal and the game hasn't ended
+
+        :param game: Game: the game
+        :param text: str: the move in coordinate notation
+        :return: str: the reply
+        """
+
+        start = time.perf_counter()
+        if game.result is not None:
+            return f"error the game has ended {game.result} {game.reason}"
+        chess_engine = self._load(game)
+        move = uci.parse_move(chess_engine, text)
+        if move is None:
+            return f"error illegal move {text}"
+
+        chess_engine.move_maker.apply_move(move, regenerate_moves=False)
+        chess_engine.move_history.clear()  # the game record is the history, the engine never undoes its moves
+        game.position = chess_engine.get_position()
+        game.moves.append(move)
+        if chess_engine.halfmove_clock == 0:
+            # no earlier position can occur again after a capture or pawn move
+            game.keys = array.array('Q', (chess_engine.key,))
+        else:
+            game.keys.append(chess_engine.key)
+        self._check_end(game)
+
+        self.moves_played += 1
+        self.latencies.append(time.perf_counter() - start)
+        return f"ok {game.result} {game.reason}" if game.result is not None else 'ok'
+
+    def get_stats(self) -> dict:
+        """
+        :return: dict: the number of games, the average bytes per game, the moves played and the median and 99th
+            percentile of the microseconds taken by recent moves
+        """
+
+        games = self.games.values()
+        latencies = sorted(self.latencies)
+        return {
+            'games': len(self.games),
+            'bytes_per_game': sum(game.get_size() for game in games) // len(games) if games else 0,
+            'moves': self.moves_played,
+            'latency_p50_us': int(latencies[len(latencies) // 2] * 1e6) if latencies else 0,
+            'latency_p99_us': int(latencies[len(latencies) * 99 // 100] * 1e6) if latencies else 0,
+        }
+
+    def _load(self, game):
+        """Load a game's position into the shared engine, unless it holds it already"""
+
+        if self._loaded is not game:
+            self.engine.set_position(game.position, regenerate_moves=False)
+            self._loaded = game
+        return self.engine
+
+    def _check_end(self, game) -> None:
+        chess_engine = self.engine
+        stalemate, checkmate = chess_engine.get_endgame_state()
+        if checkmate:
+            game.result, game.reason = ('0-1' if chess_engine.current_color == 'w' else '1-0'), 'checkmate'
+        elif stalemate:
+            game.result, game.reason = '1/2-1/2', 'stalemate'
+        elif game.keys.count(chess_engine.key) >= history.REPETITIONS:
+            game.result, game.reason = '1/2-1/2', 'threefold repetition'
+        elif chess_engine.halfmove_clock >= history.FIFTY_MOVE_PLIES:
+            game.result, game.reason = '1/2-1/2', 'fifty-move rule'
+        elif history.is_insufficient_material(chess_engine):
+            game.result, game.reason = '1/2-1/2', 'insufficient material'
+
+
+async def handle_client(game_server, reader, writer) -> None:
+    """Answer the commands of a connection, one reply line per command line, until it closes"""
+
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            writer.write(game_server.handle(line.decode('ascii', 'replace')).encode() + b'\n')
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def start(game_server, host='127.0.0.1', port=8765, path=None):
+    """
+    :param game_server: GameServer: the games to serve
+    :param path: str: the path of a Unix socket to listen on instead of host and port
+    :return: asyncio.Server: the listening server
+    """
+
+    def on_connect(reader, writer):
+        return handle_client(game_server, reader, writer)
+
+    if path is not None:
+        return await asyncio.start_unix_server(on_connect, path)
+    return await asyncio.start_server(on_connect, host, port)
+
+
+async def _bench_client(host, port, game_ids, max_plies, rng, latencies) -> None:
+    reader, writer = await asyncio.open_connection(host, port)
+
+    async def request(line):
+        writer.write(line.encode() + b'\n')
+        await writer.drain()
+        return (await reader.readline()).decode().split()
+
+    # the games take turns, so that each client keeps many games going at once
+    active = list(game_ids)
+    for _ in range(max_plies):
+        for game_id in list(active):
+            moves = (await request(f"legal {game_id}"))[1:]
+            start = time.perf_counter()
+            reply = await request(f"move {game_id} {rng.choice(moves)}")
+            latencies.append(time.perf_counter() - start)
+            if len(reply) > 1:
+                active.remove(game_id)  # the game has ended
+        if not active:
+            break
+    writer.close()
+
+
+async def bench(games, clients, max_plies, seed=None) -> None:
+    """
+    Start a server, create games and play random moves in them from many connections at once, and print the memory
+    per game and the latency of moves as seen by the clients
+    """
+
+    game_server = GameServer()
+    server = await start(game_server, port=0)
+    host, port = server.sockets[0].getsockname()[:2]
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    game_ids = [int(game_server.new_game(perft.START_FEN).split()[1]) for _ in range(games)]
+    created = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print(f"{games} games created, {created // games} bytes allocated per game, "
+          f"{game_server.get_stats()['bytes_per_game']} bytes per game record")
+
+    rng = random.Random(seed)
+    latencies = []
+    start_time = time.perf_counter()
+    await asyncio.gather(*(_bench_client(host, port, game_ids[i::clients], max_plies, random.Random(rng.random()),
+                                         latencies) for i in range(clients)))
+    seconds = time.perf_counter() - start_time
+    server.close()
+    await server.wait_closed()
+
+    latencies.sort()
+    stats = game_server.get_stats()
+    print(f"{stats['moves']} moves by {clients} clients in {seconds:.2f}s, {stats['moves'] / seconds:.0f} moves/s")
+    print(f"move latency seen by clients: median {latencies[len(latencies) // 2] * 1e3:.2f}ms, "
+          f"99th percentile {latencies[len(latencies) * 99 // 100] * 1e3:.2f}ms")
+    print(f"move time in the server: median {stats['latency_p50_us']}us, 99th percentile {stats['latency_p99_us']}us")
+    print(f"{stats['bytes_per_game']} bytes per game record after {max_plies} plies")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Host many chess games over a local socket.')
+    parser.add_argument('--host', default='127.0.0.1', help='the address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8765, help='the port to listen on (default: 8765)')
+    parser.add_argument('--unix', metavar='PATH', help='listen on a Unix socket instead')
+    parser.add_argument('--bench', action='store_true', help='play random games against a server and report the '
+                                                             'memory per game and the move latency')
+    parser.add_argument('--games', type=int, default=1000, help='the games to create with --bench (default: 1000)')
+    parser.add_argument('--clients', type=int, default=20, help='the connections to play them from (default: 20)')
+    parser.add_argument('--plies', type=int, default=40, help='the most plies of each game (default: 40)')
+    parser.add_argument('--seed', type=int, help='the seed of the random moves')
+    args = parser.parse_args(argv)
+
+    if args.bench:
+        asyncio.run(bench(args.games, args.clients, args.plies, args.seed))
+        return 0
+
+    async def serve():
+        server = await start(GameServer(), args.host, args.port, args.unix)
+        print(f"serving on {args.unix or f'{args.host}:{args.port}'}", flush=True)
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,531 @@
+"""
+Endgame tablebases for a king and up to two pieces against a lone king
+
+A table holds the result of every position of one set of pieces with either side to move: a win for the side with the
+pieces, a draw, or an illegal position, along with the distance to mate in plies. Tables are generated by retrograde
+analysis. Mates are found first, then positions are resolved backwards from them one ply at a time, by undoing the
+moves that lead to positions already resolved. A position with the defending king to move is lost once every one of
+its moves leads to a lost position; what is never resolved is a draw. Captures and promotions lead into smaller tables,
+which are generated first.
+
+The strong side is stored as white. Without pawns the board is reduced by its 8 symmetries, so that the white king is
+always in the triangle a1-d1-d4, and with pawns it is mirrored so that the white king is on files a-d. The index of a
+position is then the white king's place in the reduced squares followed by the squares of the black king and of the
+pieces, 6 bits each. A table file holds the results bit-packed 4 to a byte and a byte of distance for each position.
+
+usage:
+    python src/tablebase.py generate KQK KRK KPK KBNK --dir tables
+    python src/tablebase.py probe --dir tables --fen "<fen>"
+"""
+import argparse
+import itertools
+import mmap
+import os
+import struct
+import sys
+import time
+
+from bitboard import (
+    BISHOP_MASKS, BISHOP_TABLES, BIT, KING_ATTACKS, KNIGHT_ATTACKS, PAWN_ATTACKS, ROOK_MASKS, ROOK_TABLES,
+    iter_squares
+)
+
+# results of a position for the side to move
+DRAW = 0
+WIN = 1
+LOSS = 2
+ILLEGAL = 3
+NO_DTM = 255  # the distance of a draw or an illegal position
+
+PIECE_ORDER = 'QRBNP'
+MAX_PIECES = 2  # pieces besides the kings
+
+MAGIC = b'PYTB'
+_HEADER = struct.Struct('>4sB8sI')
+VERSION = 1
+
+# states of a position during generation
+_UNRESOLVED = 0
+_RESOLVED = 1
+_DRAWN = 2
+_BROKEN = 3
+
+
+def _apply(transform, sq) -> int:
+    row, col = sq >> 3, sq & 7
+    if transform & 4:
+        row, col = col, row
+    if transform & 2:
+        row = 7 - row
+    if transform & 1:
+        col = 7 - col
+    return row * 8 + col
+
+
+# the 8 symmetries of the board as square maps, and the reduced squares of the white king with and without pawns
+TRANSFORMS = tuple(tuple(_apply(transform, sq) for sq in range(64)) for transform in range(8))
+PAWNLESS_KING_SQUARES = tuple(sq for sq in range(64) if sq >> 3 >= 4 and sq & 7 <= 3 and (sq >> 3) + (sq & 7) >= 7)
+PAWN_KING_SQUARES = tuple(sq for sq in range(64) if sq & 7 <= 3)
+
+
+def _canonical(king_squares, transforms) -> tuple:
+    """Find the symmetry that moves the white king into the reduced squares, for each square of the white king"""
+
+    canonical = []
+    for sq in range(64):
+        for transform in transforms:
+            target = TRANSFORMS[transform][sq]
+            if target in king_squares:
+                canonical.append((TRANSFORMS[transform], king_squares.index(target)))
+                break
+    return tuple(canonical)
+
+
+_PAWNLESS_CANONICAL = _canonical(PAWNLESS_KING_SQUARES, range(8))
+_PAWN_CANONICAL = _canonical(PAWN_KING_SQUARES, (0, 1))  # pawns only move up the board, so files are mirrored only
+
+
+def get_signature(pieces) -> str:
+    """
+    :param pieces: str: the pieces of the strong side besides its king, e.g. 'NB'
+    :return: str: the name of the table, e.g. 'KBNK'
+    """
+
+    return f"K{''.join(sorted(pieces, key=PIECE_ORDER.index))}K"
+
+
+def _sort_pieces(pieces, squares) -> tuple:
+    """Put pieces and their squares into the order of a signature"""
+
+    pairs = sorted(zip(pieces, squares), key=lambda pair: PIECE_ORDER.index(pair[0]))
+    return ''.join(piece for piece, _ in pairs), [sq for _, sq in pairs]
+
+
+def _attacks(piece, sq, occupied) -> int:
+    if piece == 'N':
+        return KNIGHT_ATTACKS[sq]
+    if piece == 'P':
+        return PAWN_ATTACKS['w'][sq]
+    attacks = 0
+    if piece in 'QR':
+        attacks |= ROOK_TABLES[sq][occupied & ROOK_MASKS[sq]]
+    if piece in 'QB':
+        attacks |= BISHOP_TABLES[sq][occupied & BISHOP_MASKS[sq]]
+    return attacks
+
+
+class Table:
+    def __init__(self, signature, data):
+        """
+        :param signature: str: the name of the table, e.g. 'KQK'
+        :param data: the contents of a table file, as bytes or a memory map
+        """
+
+        self.signature = signature
+        self.pieces = signature[1:-1]
+        if 'P' in self.pieces:
+            self.king_squares, self.canonical = PAWN_KING_SQUARES, _PAWN_CANONICAL
+        else:
+            self.king_squares, self.canonical = PAWNLESS_KING_SQUARES, _PAWNLESS_CANONICAL
+        self.size = len(self.king_squares) * 64 ** (len(self.pieces) + 1)
+
+        self.data = data
+        self.wdl_size = (self.size + 3) // 4
+        self.dtm_offset = _HEADER.size + 2 * self.wdl_size
+
+    def get_index(self, white_king, black_king, squares) -> int:
+        """
+        :param white_king: int: the square of the strong side's king
+        :param black_king: int: the square of the lone king
+        :param squares: list: the squares of the pieces, in the order of the signature
+        :return: int: the index of the position, after moving it into the reduced squares
+        """
+
+        transform, index = self.canonical[white_king]
+        index = index * 64 + transform[black_king]
+        for sq in squares:
+            index = index * 64 + transform[sq]
+        return index
+
+    def get(self, side, index) -> tuple:
+        """
+        :param side: int: 0 when the strong side is to move, 1 when the lone king is
+        :param index: int: the index of the position, see get_index
+        :return: tuple: the result for the side to move (WIN, DRAW, LOSS or ILLEGAL) and the plies to mate
+        """
+
+        byte = self.data[_HEADER.size + side * self.wdl_size + (index >> 2)]
+        return byte >> ((index & 3) << 1) & 3, self.data[self.dtm_offset + side * self.size + index]
+
+    @classmethod
+    def from_results(cls, signature, results, distances):
+        """
+        Pack the results of a generated table
+
+        :param signature: str: the name of the table
+        :param results: tuple: a bytearray of the result of each index for each side to move
+        :param distances: tuple: a bytearray of the plies to mate of each index for each side to move
+        :return: Table: the table
+        """
+
+        parts = [_HEADER.pack(MAGIC, VERSION, signature.encode(), len(results[0]))]
+        for side_results in results:
+            padded = side_results + bytes(-len(side_results) % 4)
+            parts.append(bytes(a | b << 2 | c << 4 | d << 6 for a, b, c, d in
+                               zip(padded[0::4], padded[1::4], padded[2::4], padded[3::4])))
+        parts.extend(bytes(side_distances) for side_distances in distances)
+        return cls(signature, b''.join(parts))
+
+    @classmethod
+    def load(cls, path):
+        """Map a table file into memory"""
+
+        with open(path, 'rb') as file:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, signature, _ = _HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} table file")
+        return cls(signature.rstrip(b'\0').decode(), data)
+
+    def save(self, path) -> None:
+        with open(path, 'wb') as file:
+            file.write(self.data)
+
+
+class _Generator:
+    def __init__(self, signature, get_table):
+        self.signature = signature
+        self.get_table = get_table  # finds the table of a smaller set of pieces
+        self.table = Table(signature, b'')
+        self.pieces = self.table.pieces
+        # the symmetries that map positions with each reduced white king square onto the positions stored under it
+        transforms = (TRANSFORMS[0], TRANSFORMS[1]) if 'P' in self.pieces else TRANSFORMS
+        canonical = self.table.canonical
+        self.image_transforms = [[transform for transform in transforms
+                                  if all(canonical[transform[white_king]][0][transform[sq]] == sq for sq in range(64))]
+                                 for white_king in self.table.king_squares]
+
+        size = self.table.size
+        self.states = (bytearray(size), bytearray(size))
+        self.distances = (bytearray([NO_DTM]) * size, bytearray([NO_DTM]) * size)
+        self.counters = bytearray(size)  # the moves of the lone king that lead to unresolved positions
+        self.capture_distances = bytearray(size)  # the longest loss that the lone king reaches by capturing
+        self.buckets = {}  # the positions resolved at each distance, as (side, index) pairs
+
+    def generate(self) -> Table:
+        self._find_terminal_positions()
+
+        distance = 0
+        while self.buckets:
+            if distance > NO_DTM - 1:
+                raise ValueError(f"{self.signature} has mates longer than {NO_DTM - 1} plies")
+            for side, index in self.buckets.pop(distance, ()):
+                if self.states[side][index] == _UNRESOLVED:
+                    self._resolve(side, index, distance)
+            distance += 1
+
+        results = []
+        for side, won in ((0, WIN), (1, LOSS)):
+            states = self.states[side]
+            results.append(bytearray(won if state == _RESOLVED else ILLEGAL if state == _BROKEN else DRAW
+                                     for state in states))
+        return Table.from_results(self.signature, results, self.distances)
+
+    def _push(self, distance, side, index) -> None:
+        self.buckets.setdefault(distance, []).append((side, index))
+
+    def _decode(self, index) -> tuple:
+        squares = []
+        for _ in range(len(self.pieces)):
+            index, sq = divmod(index, 64)
+            squares.append(sq)
+        king_index, black_king = divmod(index, 64)
+        return king_index, black_king, squares[::-1]
+
+    def _find_terminal_positions(self) -> None:
+        """Mark illegal positions, find mates, stalemates and the results of captures and promotions"""
+
+        table = self.table
+        pieces = self.pieces
+        index = 0
+        for white_king in table.king_squares:
+            for black_king, *squares in itertools.product(range(64), repeat=len(pieces) + 1):
+                self._classify(index, white_king, black_king, squares)
+                index += 1
+
+    def _classify(self, index, white_king, black_king, squares) -> None:
+        pieces = self.pieces
+        occupied = BIT[white_king] | BIT[black_king]
+        for piece, sq in zip(pieces, squares):
+            occupied |= BIT[sq]
+        # squares must differ, pawns can't stand on the first or last rank, and kings can't touch
+        if bin(occupied).count('1') != len(pieces) + 2 or KING_ATTACKS[white_king] & BIT[black_king] or \
+                any(piece == 'P' and sq >> 3 in (0, 7) for piece, sq in zip(pieces, squares)):
+            self.states[0][index] = self.states[1][index] = _BROKEN
+            return
+
+        white_attacks = KING_ATTACKS[white_king]
+        for piece, sq in zip(pieces, squares):
+            white_attacks |= _attacks(piece, sq, occupied)
+
+        # white to move: the black king can't be in check
+        if white_attacks & BIT[black_king]:
+            self.states[0][index] = _BROKEN
+        else:
+            self._find_promotions(index, white_king, black_king, squares, occupied)
+
+        # black to move: the black king doesn't block the attacks on the squares behind it
+        empty_king = occupied ^ BIT[black_king]
+        white_attacks = KING_ATTACKS[white_king]
+        for piece, sq in zip(pieces, squares):
+            white_attacks |= _attacks(piece, sq, empty_king)
+
+        children = set()
+        capture_distance = 0
+        has_moves = False
+        for target in iter_squares(KING_ATTACKS[black_king] & ~white_attacks):
+            if target in squares:
+                has_moves = True
+                result, distance = self._capture(white_king, target, squares.index(target), squares)
+                if result != WIN:
+                    self.states[1][index] = _DRAWN  # capturing draws
+                    return
+                capture_distance = max(capture_distance, distance + 1)
+            else:
+                has_moves = True
+                children.add(self.table.get_index(white_king, target, squares))
+
+        if not has_moves:
+            if white_attacks & BIT[black_king]:
+                self._push(0, 1, index)  # checkmate
+            else:
+                self.states[1][index] = _DRAWN  # stalemate
+            return
+
+        self.counters[index] = len(children)
+        self.capture_distances[index] = capture_distance
+        if not children:
+            self._push(capture_distance, 1, index)
+
+    def _capture(self, white_king, black_king, captured, squares) -> tuple:
+        """Return the result and distance for white to move after the lone king captures a piece"""
+
+        pieces = self.pieces[:captured] + self.pieces[captured + 1:]
+        if not pieces:
+            return DRAW, NO_DTM
+        pieces, rest = _sort_pieces(pieces, squares[:captured] + squares[captured + 1:])
+        table = self.get_table(get_signature(pieces))
+        return table.get(0, table.get_index(white_king, black_king, rest))
+
+    def _find_promotions(self, index, white_king, black_king, squares, occupied) -> None:
+        """Queue a win for white to move through each promotion that leads to a lost position"""
+
+        for i, (piece, sq) in enumerate(zip(self.pieces, squares)):
+            if piece != 'P' or sq >> 3 != 1 or occupied & BIT[sq - 8]:
+                continue
+            for promotion in 'QRBN':
+                pieces, rest = _sort_pieces(self.pieces[:i] + promotion + self.pieces[i + 1:],
+                                            squares[:i] + [sq - 8] + squares[i + 1:])
+                table = self.get_table(get_signature(pieces))
+                result, distance = table.get(1, table.get_index(white_king, black_king, rest))
+                if result == LOSS:
+                    self._push(distance + 1, 0, index)
+
+    def _resolve(self, side, index, distance) -> None:
+        self.states[side][index] = _RESOLVED
+        self.distances[side][index] = distance
+        get_index = self.table.get_index
+
+        # an index stands for each symmetric image that is stored under it, and each is reached by moves of its own
+        king_index, black_king, squares = self._decode(index)
+        white_king = self.table.king_squares[king_index]
+        images = {(transform[white_king], transform[black_king], tuple(transform[sq] for sq in squares))
+                  for transform in self.image_transforms[king_index]}
+
+        if side == 1:
+            # black is lost, so white wins from every position that has a move to here
+            states = self.states[0]
+            predecessors = set()
+            for white_king, black_king, squares in images:
+                squares = list(squares)
+                occupied = self._get_occupied(white_king, black_king, squares)
+                for origin in iter_squares(KING_ATTACKS[white_king] & ~occupied):
+                    predecessors.add(get_index(origin, black_king, squares))
+                for i, (piece, sq) in enumerate(zip(self.pieces, squares)):
+                    for origin in self._unmove_origins(piece, sq, occupied):
+                        predecessors.add(get_index(white_king, black_king, squares[:i] + [origin] + squares[i + 1:]))
+            for predecessor in predecessors:
+                if states[predecessor] == _UNRESOLVED:
+                    self._push(distance + 1, 0, predecessor)
+            return
+
+        # white wins, so one more move of the black king leads to a lost position. Each position a move of the black
+        # king leads to was counted once, so each predecessor is counted down once
+        states = self.states[1]
+        predecessors = set()
+        for white_king, black_king, squares in images:
+            squares = list(squares)
+            occupied = self._get_occupied(white_king, black_king, squares)
+            for origin in iter_squares(KING_ATTACKS[black_king] & ~occupied):
+                predecessors.add(get_index(white_king, origin, squares))
+        for predecessor in predecessors:
+            if states[predecessor] == _UNRESOLVED:
+                self.counters[predecessor] -= 1
+                if not self.counters[predecessor]:
+                    self._push(max(distance + 1, self.capture_distances[predecessor]), 1, predecessor)
+
+    @staticmethod
+    def _get_occupied(white_king, black_king, squares) -> int:
+        occupied = BIT[white_king] | BIT[black_king]
+        for sq in squares:
+            occupied |= BIT[sq]
+        return occupied
+
+    @staticmethod
+    def _unmove_origins(piece, sq, occupied):
+        """Yield the squares a piece could have moved to sq from, without capturing or promoting"""
+
+        if piece != 'P':
+            yield from iter_squares(_attacks(piece, sq, occupied) & ~occupied)
+            return
+
+        # white pawns move towards row 0
+        if sq >> 3 <= 5 and not occupied & BIT[sq + 8]:
+            yield sq + 8
+            if sq >> 3 == 4 and not occupied & BIT[sq + 16]:
+                yield sq + 16
+
+
+class Tablebase:
+    def __init__(self, directory):
+        """
+        :param directory: str: the directory of the table files, named after their signatures
+        """
+
+        self.directory = directory
+        self.tables = {}
+
+    def get_table(self, signature):
+        """
+        :return: Table: the table of a signature, or None if there is no file for it
+        """
+
+        if signature not in self.tables:
+            path = os.path.join(self.directory, f"{signature}.tb")
+            self.tables[signature] = Table.load(path) if os.path.exists(path) else None
+        return self.tables[signature]
+
+    def probe(self, chess_engine):
+        """
+        Look up the engine's position
+
+        :param chess_engine: the engine holding the position
+        :return: tuple: the result for the side to move (WIN, DRAW or LOSS) and the plies to mate, or None if the
+            position isn't covered by a table
+        """
+
+        if chess_engine.castling_rights:
+            return None
+        squares = chess_engine.squares
+        white = [(piece[1].upper(), sq) for sq, piece in enumerate(squares) if piece[0] == 'w' and piece[1] != 'k']
+        black = [(piece[1].upper(), sq) for sq, piece in enumerate(squares) if piece[0] == 'b' and piece[1] != 'k']
+        if white and black or len(white) + len(black) > MAX_PIECES:
+            return None
+        if not white and not black:
+            return DRAW, NO_DTM
+
+        # the table has the strong side as white, so black's pieces are mirrored onto white's side of the board
+        strong = 'w' if white else 'b'
+        flip = 0 if strong == 'w' else 56
+        pieces, piece_squares = _sort_pieces(*zip(*[(piece, sq ^ flip) for piece, sq in white or black]))
+        table = self.get_table(get_signature(pieces))
+        if table is None:
+            return None
+
+        strong_king = chess_engine.pieces[f"{strong}k"].bit_length() - 1
+        weak_king = chess_engine.pieces['bk' if strong == 'w' else 'wk'].bit_length() - 1
+        index = table.get_index(strong_king ^ flip, weak_king ^ flip, piece_squares)
+        result, distance = table.get(0 if chess_engine.current_color == strong else 1, index)
+        return None if result == ILLEGAL else (result, distance)
+
+
+def adjudicate(tablebase, chess_engine):
+    """
+    Decide the result of a game from its position, assuming perfect play from there
+
+    :param tablebase: Tablebase: the tables to look the position up in
+    :param chess_engine: the engine holding the position
+    :return: str: '1-0', '0-1' or '1/2-1/2', or None if the position isn't covered
+    """
+
+    found = tablebase.probe(chess_engine)
+    if found is None:
+        return None
+    if found[0] == DRAW:
+        return '1/2-1/2'
+    white_wins = (found[0] == WIN) == (chess_engine.current_color == 'w')
+    return '1-0' if white_wins else '0-1'
+
+
+def generate(signatures, directory, out=sys.stdout) -> None:
+    """
+    Generate tables and the smaller tables they depend on, skipping the tables that already exist
+
+    :param signatures: list: the names of the tables, e.g. ['KQK', 'KBNK']
+    :param directory: str: the directory to write the table files to
+    :param out: the stream to report progress to
+    :return: None
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    tablebase = Tablebase(directory)
+
+    def get_table(signature):
+        table = tablebase.get_table(signature)
+        if table is None:
+            pieces = signature[1:-1]
+            if len(pieces) > MAX_PIECES or any(piece not in PIECE_ORDER for piece in pieces) or \
+                    signature != get_signature(pieces):
+                raise ValueError(f"can't generate {signature}, expected a king and up to {MAX_PIECES} pieces "
+                                 f"from {PIECE_ORDER} against a king, e.g. KBNK")
+            start = time.perf_counter()
+            table = _Generator(signature, get_table).generate()
+            table.save(os.path.join(directory, f"{signature}.tb"))
+            tablebase.tables[signature] = table
+            print(f"{signature}: {table.size * 2} positions in {time.perf_counter() - start:.1f}s", file=out)
+        return table
+
+    for signature in signatures:
+        get_table(signature.upper())
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Generate or probe endgame tablebases.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    generate_parser = commands.add_parser('generate', help='generate tables')
+    generate_parser.add_argument('signatures', nargs='+', help='the tables to generate, e.g. KQK KBNK')
+    generate_parser.add_argument('--dir', default='tables', help='the directory of the table files')
+    probe_parser = commands.add_parser('probe', help='look up a position')
+    probe_parser.add_argument('--fen', required=True, help='the position')
+    probe_parser.add_argument('--dir', default='tables', help='the directory of the table files')
+    args = parser.parse_args(argv)
+
+    if args.command == 'generate':
+        generate(args.signatures, args.dir)
+        return 0
+
+    import engine
+
+    chess_engine = engine.Engine()
+    chess_engine.set_fen(args.fen)
+    found = Tablebase(args.dir).probe(chess_engine)
+    if found is None:
+        print('position not in the tablebase')
+        return 1
+    result, distance = found
+    print({WIN: f"win, mate in {distance} plies", LOSS: f"loss, mated in {distance} plies", DRAW: 'draw'}[result])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,396 @@
+"""
+Self-play matches between two engine configurations
+
+Games are played across a pool of processes, each with its own Engine. Every opening is played twice, once with each
+engine as white, and the openings are drawn from a list in a shuffled order. Games end by the rules (checkmate,
+stalemate, repetition, the fifty-move rule and insufficient material, see history.py), by the endgame tables when
+given, when both engines agree that one side is winning by RESIGN_SCORE for RESIGN_PLIES plies, when a clock runs out,
+or as a draw after the move limit.
+
+Results are printed as games finish, with the Elo difference of the first engine and its 95% error bar. With --sprt
+the match is a sequential probability ratio test of the hypotheses that the first engine is elo0 or elo1 stronger: it
+stops as soon as the log-likelihood ratio of the results crosses a bound set by the error rates alpha and beta, which
+usually takes far fewer games than a fixed-length match.
+
+An engine configuration is a comma separated list of settings:
+    movetime=<seconds>      think for a fixed time per move (default 0.1)
+    tc=<seconds>+<inc>      play on a clock, with time allocated as in uci.py
+    depth=<plies>           the deepest iteration to search
+    hash=<MB>               the size of the transposition table
+    eval=basic|full         evaluation.evaluate or evaluation.evaluate_full
+
+usage:
+    python src/tournament.py --games 1000 --workers 8 --engine2 eval=full --sprt 0 10
+    python src/tournament.py --engine1 tc=10+0.1 --engine2 tc=5+0.05 --openings openings.epd
+"""
+import argparse
+import concurrent.futures
+import math
+import os
+import random
+import sys
+import time
+
+import engine
+import history
+import perft
+import search
+import tablebase
+import transposition
+import uci
+from evaluation import evaluate, evaluate_full
+
+EVALUATIONS = {'basic': evaluate, 'full': evaluate_full}
+DEFAULT_CONFIG = {'movetime': 0.1, 'tc': None, 'depth': search.MAX_DEPTH, 'hash': 16, 'eval': 'basic'}
+
+# the openings used without --openings, in coordinate notation from the start position
+DEFAULT_OPENINGS = (
+    'e2e4 e7e5 g1f3 b8c6 f1b5',
+    'e2e4 e7e5 g1f3 b8c6 f1c4',
+    'e2e4 c7c5 g1f3 d7d6 d2d4',
+    'e2e4 c7c5 b1c3 b8c6 g2g3',
+    'e2e4 e7e6 d2d4 d7d5 b1c3',
+    'e2e4 c7c6 d2d4 d7d5 e4e5',
+    'e2e4 d7d5 e4d5 d8d5 b1c3',
+    'd2d4 d7d5 c2c4 e7e6 b1c3',
+    'd2d4 d7d5 c2c4 c7c6 g1f3',
+    'd2d4 g8f6 c2c4 g7g6 b1c3',
+    'd2d4 g8f6 c2c4 e7e6 g1f3',
+    'd2d4 f7f5 g2g3 g8f6 f1g2',
+    'c2c4 e7e5 b1c3 g8f6 g2g3',
+    'c2c4 c7c5 g1f3 b8c6 b1c3',
+    'g1f3 d7d5 g2g3 g8f6 f1g2',
+    'g1f3 g8f6 c2c4 b7b6 g2g3',
+)
+
+RESULT_SCORES = {'1-0': 1.0, '1/2-1/2': 0.5, '0-1': 0.0}
+MAX_PLIES = 400
+RESIGN_SCORE = 1000  # centipawns
+RESIGN_PLIES = 6
+
+# the state of a worker process, created once by _init_worker
+_engine = None
+_tablebase = None
+
+
+def parse_config(text) -> dict:
+    """
+    :param text: str: comma separated settings, e.g. 'tc=10+0.1,eval=full'
+    :return: dict: DEFAULT_CONFIG updated with the settings, the time control as a (seconds, increment) tuple
+    """
+
+    config = dict(DEFAULT_CONFIG)
+    for setting in filter(None, text.split(',')):
+        name, _, value = setting.partition('=')
+        name = name.strip()
+        if name == 'movetime':
+            config['movetime'] = float(value)
+        elif name == 'tc':
+            base, _, increment = value.partition('+')
+            config['tc'] = (float(base), float(increment or 0))
+        elif name in ('depth', 'hash'):
+            config[name] = int(value)
+        elif name == 'eval':
+            if value not in EVALUATIONS:
+                raise ValueError(f"unknown evaluation {value!r}, expected one of {', '.join(EVALUATIONS)}")
+            config['eval'] = value
+        else:
+            raise ValueError(f"unknown setting {name!r}")
+    return config
+
+
+def read_openings(path, chess_engine) -> list:
+    """
+    :param path: str: a file with one FEN or EPD per line
+    :param chess_engine: the engine used to pack the positions
+    :return: list: the positions packed by Engine.get_position
+    """
+
+    openings = []
+    with open(path) as file:
+        for line in file:
+            if not line.strip():
+                continue
+            chess_engine.set_fen_or_epd(line)
+            openings.append(chess_engine.get_position())
+    return openings
+
+
+def default_openings(chess_engine) -> list:
+    """
+    :return: list: the positions of DEFAULT_OPENINGS packed by Engine.get_position
+    """
+
+    openings = []
+    for line in DEFAULT_OPENINGS:
+        chess_engine.set_fen(perft.START_FEN)
+        for text in line.split():
+            chess_engine.move_maker.apply_move(uci.parse_move(chess_engine, text))
+        openings.append(chess_engine.get_position())
+    return openings
+
+
+class _Player:
+    def __init__(self, chess_engine, config, tables):
+        table = transposition.TranspositionTable(config['hash'] * (1 << 20) // uci.SLOT_BYTES)
+        self.searcher = search.Searcher(chess_engine, table, tables, EVALUATIONS[config['eval']])
+        self.config = config
+        self.clock, self.increment = config['tc'] or (None, 0.0)
+
+    def think(self) -> tuple:
+        """
+        :return: tuple: the move, its score for the side to move and whether the clock ran out
+        """
+
+        config = self.config
+        if self.clock is None:
+            soft_limit, time_limit = None, config['movetime']
+        else:
+            soft_limit, time_limit = uci.allocate_time(self.clock, self.increment)
+
+        start = time.perf_counter()
+        move = self.searcher.search(config['depth'], time_limit, soft_time_limit=soft_limit)
+        if self.clock is None:
+            return move, self.searcher.score, False
+        self.clock -= time.perf_counter() - start
+        if self.clock < 0:
+            return move, self.searcher.score, True
+        self.clock += self.increment
+        return move, self.searcher.score, False
+
+
+def _init_worker(tablebase_dir) -> None:
+    global _engine, _tablebase
+    _engine = engine.Engine()
+    _tablebase = tablebase.Tablebase(tablebase_dir) if tablebase_dir else None
+
+
+def play_game(opening, white_config, black_config, max_plies=MAX_PLIES) -> tuple:
+    """
+    Play a game in a worker process
+
+    :param opening: bytes: the start position packed by Engine.get_position
+    :param white_config: dict: the configuration of the engine playing white, see parse_config
+    :param black_config: dict: the configuration of the engine playing black
+    :param max_plies: int: the number of plies after which the game is drawn
+    :return: tuple: the result ('1-0', '0-1' or '1/2-1/2'), the reason the game ended and the number of plies played
+    """
+
+    chess_engine = _engine
+    chess_engine.set_position(opening)
+    game = history.GameHistory(chess_engine)
+    players = {
+        'w': _Player(chess_engine, white_config, _tablebase),
+        'b': _Player(chess_engine, black_config, _tablebase),
+    }
+    leader, leading_plies = None, 0  # the side both engines agree is winning, and for how many plies
+
+    while True:
+        color = chess_engine.current_color
+        stalemate, checkmate = chess_engine.get_endgame_state()
+        if checkmate:
+            return ('0-1' if color == 'w' else '1-0'), 'checkmate', game.ply
+        if stalemate:
+            return '1/2-1/2', 'stalemate', game.ply
+        reason = game.get_draw_reason()
+        if reason is not None:
+            return '1/2-1/2', reason, game.ply
+        if _tablebase is not None:
+            result = tablebase.adjudicate(_tablebase, chess_engine)
+            if result is not None:
+                return result, 'tablebase', game.ply
+        if game.ply >= max_plies:
+            return '1/2-1/2', 'move limit', game.ply
+
+        move, score, out_of_time = players[color].think()
+        if out_of_time:
+            return ('0-1' if color == 'w' else '1-0'), 'time forfeit', game.ply
+
+        winning = color if score >= RESIGN_SCORE else chess_engine.enemy_color if score <= -RESIGN_SCORE else None
+        leading_plies = leading_plies + 1 if winning is not None and winning == leader else int(winning is not None)
+        leader = winning
+        if leading_plies >= RESIGN_PLIES:
+            return ('1-0' if leader == 'w' else '0-1'), 'adjudication', game.ply
+
+        game.push(move, regenerate_moves=False)
+
+
+def expected_score(elo) -> float:
+    return 1 / (1 + 10 ** (-elo / 400))
+
+
+def elo_difference(score) -> float:
+    """
+    :param score: float: the average score per game, between 0 and 1
+    :return: float: the Elo difference that gives the score, infinite for a score of 0 or 1
+    """
+
+    if score <= 0:
+        return -math.inf
+    if score >= 1:
+        return math.inf
+    return 400 * math.log10(score / (1 - score))
+
+
+def _score_variance(wins, draws, losses) -> tuple:
+    games = wins + draws + losses
+    score = (wins + draws / 2) / games
+    variance = (wins * (1 - score) ** 2 + draws * (0.5 - score) ** 2 + losses * score ** 2) / games
+    return score, variance
+
+
+def elo_estimate(wins, draws, losses) -> tuple:
+    """
+    :return: tuple: the Elo difference of the results and the half width of its 95% confidence interval
+    """
+
+    games = wins + draws + losses
+    if not games:
+        return 0.0, math.inf
+    score, variance = _score_variance(wins, draws, losses)
+    if not 0 < score < 1 or not variance:
+        # every game had the same result, there is nothing to measure the spread with yet
+        return elo_difference(score), math.inf
+    margin = 1.96 * math.sqrt(variance / games)
+    return elo_difference(score), (elo_difference(score + margin) - elo_difference(score - margin)) / 2
+
+
+def sprt_llr(wins, draws, losses, elo0, elo1) -> float:
+    """
+    The log-likelihood ratio of the hypotheses that the Elo difference is elo1 rather than elo0
+
+    Uses the generalized SPRT approximation, which treats the average score as normally distributed with the variance
+    of the results so far.
+
+    :return: float: the log-likelihood ratio, positive when the results favour elo1
+    """
+
+    games = wins + draws + losses
+    if not games:
+        return 0.0
+    score, variance = _score_variance(wins, draws, losses)
+    if not variance:
+        return 0.0  # every game had the same result, there is nothing to measure the spread with yet
+    score0, score1 = expected_score(elo0), expected_score(elo1)
+    return games * (score1 - score0) * (2 * score - score0 - score1) / (2 * variance)
+
+
+def sprt_bounds(alpha, beta) -> tuple:
+    """
+    :param alpha: float: the chance of accepting elo1 when elo0 is true
+    :param beta: float: the chance of accepting elo0 when elo1 is true
+    :return: tuple: the log-likelihood ratios below which elo0 and above which elo1 is accepted
+    """
+
+    return math.log(beta / (1 - alpha)), math.log((1 - beta) / alpha)
+
+
+def run_match(openings, configs, games, workers, max_plies=MAX_PLIES, tablebase_dir=None, max_pending=None):
+    """
+    Play games across a pool of processes, yielding them as they finish
+
+    Game n plays opening n // 2, with the first engine as white in the even games. No more than max_pending games are
+    queued or running at once, so stopping the generator early leaves little work to cancel.
+
+    :param openings: list: the start positions packed by Engine.get_position, in the order they are played
+    :param configs: tuple: the configurations of the two engines, see parse_config
+    :param games: int: the number of games to play
+    :param workers: int: the number of processes
+    :param max_plies: int: the number of plies after which a game is drawn
+    :param tablebase_dir: str: a directory of endgame tables to adjudicate the games with
+    :param max_pending: int: the number of games in flight, defaults to twice the number of workers
+    :return: a generator of (game number, the first engine's score, result, reason, plies) tuples
+    """
+
+    max_pending = max_pending or 2 * workers
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=_init_worker,
+                                                initargs=(tablebase_dir,)) as pool:
+        pending = {}
+        next_game = 0
+        try:
+            while pending or next_game < games:
+                while next_game < games and len(pending) < max_pending:
+                    first_is_white = next_game % 2 == 0
+                    white, black = configs if first_is_white else configs[::-1]
+                    opening = openings[next_game // 2 % len(openings)]
+                    future = pool.submit(play_game, opening, white, black, max_plies)
+                    pending[future] = next_game
+                    next_game += 1
+
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    number = pending.pop(future)
+                    result, reason, plies = future.result()
+                    score = RESULT_SCORES[result] if number % 2 == 0 else 1 - RESULT_SCORES[result]
+                    yield number, score, result, reason, plies
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Play games between two engine configurations.')
+    parser.add_argument('--engine1', default='', help='the configuration of the engine being tested, see above')
+    parser.add_argument('--engine2', default='', help='the configuration of the engine it is measured against')
+    parser.add_argument('--games', type=int, default=1000, help='the most games to play (default: 1000)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='play games across this many processes (default: one per CPU)')
+    parser.add_argument('--openings', help='a file with one FEN or EPD per line (default: a short built-in list)')
+    parser.add_argument('--seed', type=int, help='the seed of the opening order')
+    parser.add_argument('--max-plies', type=int, default=MAX_PLIES,
+                        help=f"plies after which a game is drawn (default: {MAX_PLIES})")
+    parser.add_argument('--tablebase', metavar='DIR', help='a directory of endgame tables to adjudicate with')
+    parser.add_argument('--sprt', nargs=2, type=float, metavar=('ELO0', 'ELO1'),
+                        help='stop when the results show the first engine is ELO0 or ELO1 stronger')
+    parser.add_argument('--alpha', type=float, default=0.05, help='the false positive rate of the SPRT')
+    parser.add_argument('--beta', type=float, default=0.05, help='the false negative rate of the SPRT')
+    args = parser.parse_args(argv)
+
+    try:
+        configs = parse_config(args.engine1), parse_config(args.engine2)
+    except ValueError as error:
+        parser.error(str(error))
+
+    chess_engine = engine.Engine()
+    openings = read_openings(args.openings, chess_engine) if args.openings else default_openings(chess_engine)
+    if not openings:
+        parser.error('no openings to play')
+    random.Random(args.seed).shuffle(openings)
+
+    bounds = sprt_bounds(args.alpha, args.beta) if args.sprt else None
+    counts = [0, 0, 0]  # the first engine's losses, draws and wins
+    decision = None
+    start = time.perf_counter()
+    for number, score, result, reason, plies in run_match(openings, configs, args.games, args.workers,
+                                                          args.max_plies, args.tablebase):
+        counts[int(score * 2)] += 1
+        losses, draws, wins = counts
+        games = wins + draws + losses
+        elo, margin = elo_estimate(wins, draws, losses)
+        line = (f"game {number + 1}: {result} {reason} after {plies} plies, "
+                f"+{wins} ={draws} -{losses}, elo {elo:+.1f} +/- {margin:.1f}, "
+                f"{games / (time.perf_counter() - start):.2f} games/s")
+        if bounds is not None:
+            llr = sprt_llr(wins, draws, losses, *args.sprt)
+            line += f", llr {llr:.2f} ({bounds[0]:.2f}, {bounds[1]:.2f})"
+            if llr <= bounds[0]:
+                decision = f"H0 accepted: an Elo difference of {args.sprt[0]:g} is more likely than {args.sprt[1]:g}"
+            elif llr >= bounds[1]:
+                decision = f"H1 accepted: an Elo difference of {args.sprt[1]:g} is more likely than {args.sprt[0]:g}"
+        print(line, flush=True)
+        if decision is not None:
+            break
+
+    losses, draws, wins = counts
+    games = wins + draws + losses
+    seconds = time.perf_counter() - start
+    elo, margin = elo_estimate(wins, draws, losses)
+    print(f"{games} games in {seconds:.1f}s ({games / seconds:.2f} games/s): +{wins} ={draws} -{losses}, "
+          f"elo {elo:+.1f} +/- {margin:.1f}")
+    if bounds is not None:
+        print(decision or 'SPRT inconclusive')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,100 @@
+"""
+A fixed-size transposition table keyed by Zobrist position keys
+"""
+
+EXACT = 0
+LOWER = 1  # the value is a lower bound, the search failed high
+UPPER = 2  # the value is an upper bound, the search failed low
+
+
+class TranspositionTable:
+    def __init__(self, size=1 << 20):
+        """
+        :param size: int: the number of slots, rounded down to a power of two
+        """
+
+        self.size = 1 << (max(size, 1).bit_length() - 1)
+        self.mask = self.size - 1
+        # each slot holds None or a (key, depth, value, flag, move, age) tuple
+        self.slots = [None] * self.size
+        self.age = 0
+        self.filled = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.replacements = 0  # entries of another position that were overwritten
+        self.rejections = 0  # stores that were dropped to keep a more valuable entry
+
+    def probe(self, key):
+        """
+        Look up the entry stored for a position
+
+        :param key: int: the position key
+        :return: tuple: the (key, depth, value, flag, move, age) entry, or None if the position isn't stored
+        """
+
+        entry = self.slots[key & self.mask]
+        if entry is not None and entry[0] == key:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        return None
+
+    def store(self, key, depth, value, flag=EXACT, move=None) -> None:
+        """
+        Store the result of searching a position
+
+        The slot of a position is shared with every other position whose key has the same low bits. An entry of
+        another position is only replaced by a search that was at least as deep, or when the entry was left over from
+        an earlier search.
+
+        :param key: int: the position key
+        :param depth: int: the depth the position was searched to
+        :param value: the result of the search
+        :param flag: int: whether the value is EXACT, a LOWER bound or an UPPER bound
+        :param move: the best move found, if any
+        :return: None
+        """
+
+        index = key & self.mask
+        entry = self.slots[index]
+        if entry is None:
+            self.filled += 1
+        elif entry[0] != key:
+            if entry[1] > depth and entry[5] == self.age:
+                self.rejections += 1
+                return
+            self.replacements += 1
+        elif move is None:
+            move = entry[4]  # keep the best move of a shallower search of the same position
+
+        self.slots[index] = (key, depth, value, flag, move, self.age)
+        self.stores += 1
+
+    def new_search(self) -> None:
+        """Mark the current entries as old, so that they are replaced before entries of the next search"""
+
+        self.age += 1
+
+    def clear(self) -> None:
+        """Remove every entry and reset the counters"""
+
+        self.__init__(self.size)
+
+    def get_stats(self) -> dict:
+        """
+        :return: dict: the hit, miss and store counters along with the hit rate and how full the table is
+        """
+
+        probes = self.hits + self.misses
+        return {
+            'size': self.size,
+            'filled': self.filled,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / probes if probes else 0.0,
+            'stores': self.stores,
+            'replacements': self.replacements,
+            'rejections': self.rejections,
+        }
@@ -0,0 +1,412 @@
+"""
+The Universal Chess Interface, for playing the engine from chess GUIs and tournament managers
+
+The GUI sends commands on stdin and reads the engine's replies from stdout, one per line. Searches run on an
+EngineWorker thread, so the command loop keeps reading while the engine thinks and can answer isready, stop and
+ponderhit at any time. pygame is never imported, and the book and tablebase modules are only imported when their
+options are set, so the engine is ready to answer uci soon after it starts.
+
+The time of each move comes from the clock: the time left is split over the moves to go until the next time control
+(MOVES_TO_GO when the GUI doesn't say), plus most of the increment. The search starts no new iteration past that
+soft limit, and is stopped at a hard limit a few times longer, which leaves time for an iteration that changed the
+best move to settle.
+
+usage:
+    python src/uci.py
+    python src/uci.py --check    # send commands that once went unanswered
+"""
+import argparse
+import io
+import sys
+import threading
+import time
+
+import engine
+import perft
+import search
+import transposition
+import worker
+from engine import PROMOTE_N
+
+NAME = 'PyChess'
+AUTHOR = 'the PyChess authors'
+
+MOVES_TO_GO = 30  # the moves the remaining time is split over in sudden death games
+INCREMENT_SHARE = 0.8  # the part of the increment spent on each move
+HARD_LIMIT_FACTOR = 4  # the hard limit is this many times the soft limit
+MAX_TIME_SHARE = 0.5  # the largest part of the time left for one move, unless it is the last before the control
+FILES = 'abcdefgh'
+RANKS = '12345678'
+SLOT_BYTES = 128  # the memory of a transposition table slot and its entry, to turn the Hash option into slots
+
+# name: (type, default, min, max)
+OPTIONS = {
+    'Hash': ('spin', 128, 1, 4096),
+    'Move Overhead': ('spin', 100, 0, 5000),
+    'Ponder': ('check', False, None, None),
+    'OwnBook': ('check', False, None, None),
+    'BookFile': ('string', '', None, None),
+    'TablebasePath': ('string', '', None, None),  # a directory of tables built by tablebase.py
+}
+
+# commands that were once left without a bestmove, each must be answered with one within CHECK_TIMEOUT seconds
+CHECK_COMMANDS = (
+    ('ponderhit straight after go ponder',
+     ('position startpos moves e2e4 e7e5', 'go ponder wtime 2000 btime 2000', 'ponderhit')),
+    ('stop straight after go ponder', ('position startpos moves e2e4 e7e5', 'go ponder wtime 2000 btime 2000', 'stop')),
+)
+CHECK_TIMEOUT = 5.0
+
+
+def allocate_time(time_left, increment=0.0, moves_to_go=None, overhead=0.0) -> tuple:
+    """
+    Decide how long to think about a move from the state of the clock
+
+    :param time_left: float: the seconds left on the engine's clock
+    :param increment: float: the seconds added to the clock after each move
+    :param moves_to_go: int: the moves until the next time control, None in sudden death
+    :param overhead: float: the seconds lost to communication with the GUI on each move
+    :return: tuple: the soft and hard time limits in seconds
+    """
+
+    available = max(time_left - overhead, 0.0)
+    moves = min(moves_to_go, MOVES_TO_GO) if moves_to_go else MOVES_TO_GO
+    # the last move before the time control may use nearly all of the time, as the clock is refilled after it
+    max_time = available * (0.9 if moves == 1 else MAX_TIME_SHARE)
+
+    soft = min(available / moves + increment * INCREMENT_SHARE, max_time)
+    hard = min(soft * HARD_LIMIT_FACTOR, max_time)
+    return soft, hard
+
+
+def parse_move(chess_engine, text):
+    """
+    :param chess_engine: the engine holding the position the move is played in
+    :param text: str: the move in coordinate notation, e.g. 'e2e4' or 'e7e8q'
+    :return: int: the legal packed move, or None if no legal move matches
+    """
+
+    if len(text) not in (4, 5) or text[0] not in FILES or text[2] not in FILES or text[1] not in RANKS \
+            or text[3] not in RANKS or text[4:] not in ('', *engine.PROMOTION_PIECES):
+        return None
+    from_sq = (8 - int(text[1])) * 8 + FILES.index(text[0])
+    to_sq = (8 - int(text[3])) * 8 + FILES.index(text[2])
+    # the flag of a promotion holds the new piece, the flags of other moves are below PROMOTE_N
+    promotion = PROMOTE_N + engine.PROMOTION_PIECES.index(text[4]) if len(text) == 5 else None
+
+    squares = from_sq | to_sq << 6
+    for move in chess_engine.move_generator.get_legal_moves():
+        if move & 0xfff == squares and (move >> 12 == promotion if move >> 12 >= PROMOTE_N else promotion is None):
+            return move
+    return None
+
+
+def format_info(stats) -> str:
+    """
+    :param stats: dict: the stats of a search iteration, see Searcher.get_stats
+    :return: str: the info line sent to the GUI
+    """
+
+    score = f"mate {stats['mate']}" if stats['mate'] is not None else f"cp {stats['score']}"
+    table_stats = stats['hash']
+    return (f"info depth {stats['depth']} seldepth {stats['seldepth']} score {score} nodes {stats['nodes']} "
+            f"nps {stats['nps']} time {int(stats['time'] * 1000)} hashfull "
+            f"{table_stats['filled'] * 1000 // table_stats['size']} tbhits {stats['tbhits']} "
+            f"pv {' '.join(map(perft.format_move, stats['pv']))}")
+
+
+class UCIEngine:
+    def __init__(self, out=sys.stdout):
+        """
+        :param out: the stream the replies are written to
+        """
+
+        self.out = out
+        self._output_lock = threading.Lock()
+
+        self.options = {name: option[1] for name, option in OPTIONS.items()}
+        self.book = None
+        self.worker = worker.EngineWorker(self._on_progress, self._on_best_move, self._make_table())
+
+        self.engine = engine.Engine()
+        self.engine.set_fen(perft.START_FEN)
+        self.previous_position = None  # the packed position before the last move of the position command
+        self.last_move = None
+
+        self._lock = threading.Lock()
+        self.search_id = None
+        self.pondering = False
+        self.infinite = False  # the best move is held back until stop, as the GUI expects
+        self.stopping = False
+        self.held_result = None  # the (best move, stats) of an infinite search that ended before stop
+
+    def run(self, lines) -> None:
+        """
+        Answer commands until quit is received or the input ends
+
+        :param lines: an iterable of command lines
+        :return: None
+        """
+
+        for line in lines:
+            if not self.handle(line):
+                break
+        self.worker.close()
+
+    def handle(self, line) -> bool:
+        """
+        Answer one command, unknown commands are ignored
+
+        :param line: str: the command line
+        :return: bool: False if the command was quit
+        """
+
+        tokens = line.split()
+        if not tokens:
+            return True
+        command, args = tokens[0], tokens[1:]
+
+        if command == 'quit':
+            return False
+        if command == 'uci':
+            self.send(f"id name {NAME}")
+            self.send(f"id author {AUTHOR}")
+            for name, (kind, default, low, high) in OPTIONS.items():
+                default = str(default).lower() if kind == 'check' else default
+                limits = f" min {low} max {high}" if kind == 'spin' else ''
+                self.send(f"option name {name} type {kind} default {default if default != '' else '<empty>'}{limits}")
+            self.send('uciok')
+        elif command == 'isready':
+            self.send('readyok')
+        elif command == 'setoption':
+            self.set_option(args)
+        elif command == 'ucinewgame':
+            self.worker.cancel()
+            self.worker.searcher.table.clear()
+            self.worker.searcher.history = {'w': {}, 'b': {}}
+        elif command == 'position':
+            self.set_position(args)
+        elif command == 'go':
+            self.go(args)
+        elif command == 'stop':
+            self.stop()
+        elif command == 'ponderhit':
+            self.ponder_hit()
+        return True
+
+    def send(self, line) -> None:
+        # the worker thread sends info and bestmove lines while the command loop answers isready
+        with self._output_lock:
+            self.out.write(line + '\n')
+            self.out.flush()
+
+    def set_option(self, args) -> None:
+        """Handle 'setoption name <name> [value <value>]', names and values may contain spaces"""
+
+        if 'name' not in args:
+            return
+        split = args.index('value') if 'value' in args else len(args)
+        name = ' '.join(args[args.index('name') + 1:split])
+        value = ' '.join(args[split + 1:])
+        name = next((option for option in OPTIONS if option.lower() == name.lower()), None)
+        if name is None:
+            return
+
+        kind, _, low, high = OPTIONS[name]
+        if kind == 'spin':
+            try:
+                value = max(low, min(int(value), high))
+            except ValueError:
+                return
+        elif kind == 'check':
+            value = value.lower() == 'true'
+        elif value == '<empty>':
+            value = ''
+        self.options[name] = value
+
+        if name == 'Hash':
+            self.worker.searcher.table = self._make_table()
+        elif name in ('OwnBook', 'BookFile'):
+            self._load_book()
+        elif name == 'TablebasePath':
+            if value:
+                import tablebase
+
+                self.worker.searcher.tablebase = tablebase.Tablebase(value)
+            else:
+                self.worker.searcher.tablebase = None
+
+    def set_position(self, args) -> None:
+        """Handle 'position startpos|fen <fen> [moves <move> ...]'"""
+
+        split = args.index('moves') if 'moves' in args else len(args)
+        if args and args[0] == 'fen':
+            fen = ' '.join(args[1:split])
+        elif args and args[0] == 'startpos':
+            fen = perft.START_FEN
+        else:
+            return
+
+        chess_engine = self.engine
+        try:
+            chess_engine.set_fen(fen)
+        except (ValueError, IndexError, KeyError):
+            self.send(f"info string invalid fen {fen}")
+            return
+        self.previous_position = self.last_move = None
+        for text in args[split + 1:]:
+            move = parse_move(chess_engine, text)
+            if move is None:
+                self.send(f"info string illegal move {text}")
+                return
+            self.previous_position, self.last_move = chess_engine.get_position(), move
+            chess_engine.move_maker.apply_move(move)
+
+    def go(self, args) -> None:
+        """Handle 'go' with wtime, btime, winc, binc, movestogo, movetime, depth, infinite and ponder"""
+
+        limits = {}
+        flags = set()
+        tokens = iter(args)
+        for token in tokens:
+            if token in ('infinite', 'ponder'):
+                flags.add(token)
+            elif token in ('wtime', 'btime', 'winc', 'binc', 'movestogo', 'movetime', 'depth'):
+                try:
+                    limits[token] = int(next(tokens))
+                except (StopIteration, ValueError):
+                    pass
+
+        overhead = self.options['Move Overhead'] / 1000
+        soft_limit = time_limit = None
+        if 'movetime' in limits:
+            time_limit = max(limits['movetime'] / 1000 - overhead, 0.01)
+        elif not flags & {'infinite'}:
+            color = self.engine.current_color
+            if f"{color}time" in limits:
+                soft_limit, time_limit = allocate_time(limits[f"{color}time"] / 1000,
+                                                       limits.get(f"{color}inc", 0) / 1000,
+                                                       limits.get('movestogo'), overhead)
+        max_depth = limits.get('depth', search.MAX_DEPTH)
+
+        pondering = 'ponder' in flags and self.last_move is not None
+        if not pondering and 'infinite' not in flags and self.book is not None:
+            move = self.book.pick_move(self.engine)
+            if move is not None:
+                self.send(f"bestmove {perft.format_move(move)}")
+                return
+
+        with self._lock:
+            self.pondering = pondering
+            self.infinite = 'infinite' in flags
+            self.stopping = False
+            self.held_result = None
+            # the worker searches the position after the expected move, which is the last move of the position
+            if pondering:
+                self.search_id = self.worker.ponder(self.previous_position, self.last_move, time_limit, max_depth,
+                                                    soft_limit)
+            else:
+                self.search_id = self.worker.go(self.engine.get_position(), time_limit, max_depth, soft_limit)
+
+    def stop(self) -> None:
+        """Handle 'stop', the best move found so far is sent"""
+
+        with self._lock:
+            self.stopping = True
+            held_result, self.held_result = self.held_result, None
+            pondering, self.pondering = self.pondering, False
+        if held_result is not None:
+            self._send_best_move(*held_result)
+            return
+        if pondering:
+            # the GUI discards the move of a ponder search that was stopped, but it still expects one
+            self.worker.ponder_hit()
+        self.worker.move_now()
+
+    def ponder_hit(self) -> None:
+        """Handle 'ponderhit', the expected move was played and the clock of the search starts now"""
+
+        with self._lock:
+            self.pondering = False
+        self.worker.ponder_hit()
+
+    def _make_table(self):
+        return transposition.TranspositionTable(self.options['Hash'] * (1 << 20) // SLOT_BYTES)
+
+    def _load_book(self) -> None:
+        if self.book is not None:
+            self.book.close()
+            self.book = None
+        if self.options['OwnBook'] and self.options['BookFile']:
+            import book
+
+            try:
+                self.book = book.OpeningBook(self.options['BookFile'])
+            except (OSError, ValueError) as error:
+                self.send(f"info string can't open book: {error}")
+
+    def _on_progress(self, search_id, stats) -> None:
+        with self._lock:
+            if search_id != self.search_id:
+                return
+        self.send(format_info(stats))
+
+    def _on_best_move(self, search_id, best_move, stats) -> None:
+        with self._lock:
+            if search_id != self.search_id:
+                return
+            if self.infinite and not self.stopping:
+                self.held_result = (best_move, stats)
+                return
+        self._send_best_move(best_move, stats)
+
+    def _send_best_move(self, best_move, stats) -> None:
+        if best_move is None:
+            self.send('bestmove 0000')  # no legal moves
+            return
+        pv = stats['pv']
+        ponder = f" ponder {perft.format_move(pv[1])}" if len(pv) > 1 and pv[0] == best_move else ''
+        self.send(f"bestmove {perft.format_move(best_move)}{ponder}")
+
+
+def run_checks(out=sys.stdout) -> bool:
+    """
+    Send each of CHECK_COMMANDS to a new engine and wait for its bestmove
+
+    :param out: the stream to print the report to
+    :return: bool: True if every command sequence was answered in time
+    """
+
+    passed = True
+    for name, commands in CHECK_COMMANDS:
+        replies = io.StringIO()
+        uci_engine = UCIEngine(replies)
+        start = time.perf_counter()
+        for command in commands:
+            uci_engine.handle(command)
+        while 'bestmove' not in replies.getvalue() and time.perf_counter() - start < CHECK_TIMEOUT:
+            time.sleep(0.01)
+        uci_engine.run(['quit'])
+
+        answered = 'bestmove' in replies.getvalue()
+        passed = passed and answered
+        seconds = time.perf_counter() - start
+        print(f"{name}: {'bestmove' if answered else 'no bestmove'} after {seconds:.2f}s  "
+              f"{'ok' if answered else 'FAIL'}", file=out)
+    print('all commands answered' if passed else 'COMMANDS LEFT UNANSWERED', file=out)
+    return passed
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Play chess over the Universal Chess Interface on stdin and stdout.')
+    parser.add_argument('--check', action='store_true', help='send commands that were once left unanswered and stop')
+    args = parser.parse_args(argv)
+
+    if args.check:
+        return 0 if run_checks() else 1
+    UCIEngine().run(iter(sys.stdin.readline, ''))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
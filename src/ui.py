@@ -1,9 +1,36 @@
 import pygame as pg
-import os
 
 from constants import Color as color
 pg.font.init()
 
+# the banner shown when a game is drawn by a rule, by the reasons of GameHistory.get_draw_reason
+DRAW_BANNERS = {'threefold repetition': 'REPETITION!', 'fifty-move rule': '50 MOVES!', 'insufficient material': 'DRAW!'}
+
+ATLAS_PATH = 'src/images/pieces.png'
+ATLAS_COLUMNS = 'kqbnrp'  # the piece in each column of the atlas, white in the top row and black in the bottom row
+_piece_images = {}  # the scaled piece images of each square size, shared by every board
+
+
+def load_pieces(sq_size) -> dict:
+    """
+    Cut the piece images out of the atlas, loading and scaling them only the first time a size is asked for
+
+    :param sq_size: int: the width and height of a square in pixels
+    :return: dict: the image of each piece, shared between callers so they must not be drawn on
+    """
+
+    if sq_size not in _piece_images:
+        atlas = pg.image.load(ATLAS_PATH).convert_alpha()
+        cell_w, cell_h = atlas.get_width() / len(ATLAS_COLUMNS), atlas.get_height() / 2
+        images = {}
+        for row, piece_color in enumerate('wb'):
+            for col, piece_type in enumerate(ATLAS_COLUMNS):
+                left, top = round(col * cell_w), round(row * cell_h)
+                cell = atlas.subsurface((left, top, round((col + 1) * cell_w) - left, round((row + 1) * cell_h) - top))
+                images[piece_color + piece_type] = pg.transform.scale(cell, (sq_size, sq_size))
+        _piece_images[sq_size] = images
+    return _piece_images[sq_size]
+
 
 class BoardUI:
     def __init__(self, app):
@@ -15,59 +42,106 @@ class BoardUI:
         self.sq_size = int(self.rect.w / 8)
 
         self.endgame_banner = EndgameBanner(self)
+        self.analysis_panel = TextPanel(self, 'topleft')
+        self.analysis = None  # a line of live analysis shown over the top of the board, set by the app
+        self.profile_panel = TextPanel(self, 'bottomleft')
+        self.profile = None  # the profiler's stats shown over the bottom of the board, set by the app
         self.input = self.BoardInput(self)
-        self.piece_images: dict = self.load_pieces()
-
-    def load_pieces(self):
-        pieces = {}
-        image_dir = 'src/images/pieces'
-        for name, ext in [fn.split('.') for fn in os.listdir(image_dir)]:
-            fn = f"{image_dir}/{name}.{ext}"
-            img = pg.transform.scale(pg.image.load(fn), (self.sq_size, self.sq_size)).convert_alpha()
-            pieces.update({name: img})
-        return pieces
-
-    def draw(self):
-        self.draw_board()
-        self.draw_highlights()
-        self.draw_pieces()
+        self.piece_images: dict = load_pieces(self.sq_size)
+        self.background = self.render_background()
 
-        is_stalemate, is_checkmate = self.engine.get_endgame_state()
-        if is_stalemate:
-            self.endgame_banner.draw('STALEMATE!')
-        elif is_checkmate:
-            self.endgame_banner.draw('CHECKMATE!')
+        # what was last drawn, so that only the squares that change are drawn again
+        self.drawn_squares = [None] * 64
+        self.drawn_highlights = set()
+        self.drawn_banner = None
+        self.drawn_analysis = None
+        self.drawn_profile = None
 
-        self.app.display.blit(self.image, self.rect)
+    def render_background(self):
+        """Draw the squares of the board once, to copy from whenever a square is redrawn"""
 
-    def draw_board(self):
+        background = pg.Surface(self.image.get_size())
         for row in range(8):
             for col in range(8):
                 x = col * self.sq_size
                 y = row * self.sq_size
-                # draw current square
                 rgb = color.DARK if (row + col) % 2 else color.LIGHT
-                self.image.fill(rgb, (x, y, self.sq_size, self.sq_size))
+                background.fill(rgb, (x, y, self.sq_size, self.sq_size))
+        return background
 
-    def draw_highlights(self):
-        for move in self.engine.get_moves_of_square(self.input.from_pos):
-            y, x = move.to_pos
-            x *= self.sq_size
-            y *= self.sq_size
-            pg.draw.circle(self.image, 'red', (x+self.sq_size//2, y+self.sq_size//2), self.sq_size//5)
+    def invalidate(self):
+        """Redraw the whole board on the next draw, for when the window has been covered or resized"""
 
-    def draw_pieces(self):
-        for row in range(8):
-            for col in range(8):
-                square = self.engine.get_piece(row, col)
-                x = col * self.sq_size
-                y = row * self.sq_size
-                # draw pieces
-                if square != '--':
-                    image = self.piece_images[square]
-                    """if self.app.mode == 'pvp' and square[0] == 'b':
-                        image = pg.transform.rotate(image, 180)"""
-                    self.image.blit(image, (x, y))
+        self.drawn_squares = [None] * 64
+        self.drawn_highlights = set()
+
+    def draw(self) -> list:
+        """
+        Redraw the squares whose piece, highlight or overlay changed since the last draw
+
+        :return: list: the rects of the display that were drawn on, to pass to pg.display.update
+        """
+
+        squares = self.engine.squares
+        highlights = {move.to_pos for move in self.engine.get_moves_of_square(self.input.from_pos)}
+        dirty = {(sq >> 3, sq & 7) for sq in range(64) if squares[sq] != self.drawn_squares[sq]}
+        dirty |= highlights ^ self.drawn_highlights
+
+        is_stalemate, is_checkmate = self.engine.get_endgame_state()
+        banner = 'STALEMATE!' if is_stalemate else 'CHECKMATE!' if is_checkmate else None
+        if banner is None:
+            banner = DRAW_BANNERS.get(self.app.history.get_draw_reason())
+        overlays = (
+            (self.endgame_banner, banner, self.drawn_banner),
+            (self.analysis_panel, self.analysis, self.drawn_analysis),
+            (self.profile_panel, self.profile, self.drawn_profile),
+        )
+        for overlay, text, drawn_text in overlays:
+            if text != drawn_text:
+                # the squares under the old overlay need to be drawn again to remove it
+                for changed_text in (drawn_text, text):
+                    if changed_text is not None:
+                        dirty |= self.get_squares_in(overlay.get_rect(changed_text))
+        self.drawn_banner = banner
+        self.drawn_analysis = self.analysis
+        self.drawn_profile = self.profile
+
+        if not dirty:
+            return []
+
+        rects = []
+        for row, col in dirty:
+            rects.append(self.draw_square(row, col, (row, col) in highlights))
+        for overlay, text, _ in overlays:
+            if text is not None:
+                rects.append(overlay.draw(text))
+
+        self.drawn_squares = squares.copy()
+        self.drawn_highlights = highlights
+        for rect in rects:
+            self.app.display.blit(self.image, rect.move(self.rect.topleft), rect)
+        return [rect.move(self.rect.topleft) for rect in rects]
+
+    def draw_square(self, row, col, highlight) -> pg.Rect:
+        """Draw a square with its highlight and piece over the background, returning the rect that was drawn"""
+
+        rect = pg.Rect(col * self.sq_size, row * self.sq_size, self.sq_size, self.sq_size)
+        self.image.blit(self.background, rect, rect)
+        if highlight:
+            pg.draw.circle(self.image, 'red', rect.center, self.sq_size // 5)
+
+        square = self.engine.get_piece(row, col)
+        if square != '--':
+            self.image.blit(self.piece_images[square], rect)
+        return rect
+
+    def get_squares_in(self, rect) -> set:
+        """Find the row, column locations of the squares that overlap a rect of the board image"""
+
+        rect = rect.clip(self.image.get_rect())
+        rows = range(rect.top // self.sq_size, (rect.bottom - 1) // self.sq_size + 1)
+        cols = range(rect.left // self.sq_size, (rect.right - 1) // self.sq_size + 1)
+        return {(row, col) for row in rows for col in cols}
 
     class BoardInput:
         def __init__(self, board_ui):
@@ -90,7 +164,7 @@ class BoardUI:
                 # make move
                 for move in self.board_state.get_moves_of_square(self.from_pos):
                     if move.to_pos == square_clicked:
-                        self.board_state.move_maker.apply_move(move)
+                        self.app.history.push(move)
                         break
                 # End move
                 self.move_started = False
@@ -100,10 +174,56 @@ class BoardUI:
 class EndgameBanner:
     def __init__(self, board_ui):
         self.board_ui = board_ui
+        self.font = pg.font.SysFont('arial', 50, bold=True)
+        self.renders = {}  # the rendered text and its rect for each banner shown so far
+
+    def get_render(self, text) -> tuple:
+        if text not in self.renders:
+            font_render = self.font.render(text, False, (0, 0, 0))
+            self.renders[text] = font_render, font_render.get_rect(center=self.board_ui.image.get_rect().center)
+        return self.renders[text]
 
-    def draw(self, text):
-        font = pg.font.SysFont('arial', 50, bold=True)
-        font_render = font.render(text, False, (0, 0, 0))
-        rect = font_render.get_rect(center=self.board_ui.rect.center)
+    def get_rect(self, text) -> pg.Rect:
+        return self.get_render(text)[1]
+
+    def draw(self, text) -> pg.Rect:
+        font_render, rect = self.get_render(text)
         pg.draw.rect(self.board_ui.image, (255, 255, 255), rect, border_radius=25)
         self.board_ui.image.blit(font_render, rect)
+        return rect
+
+
+class TextPanel:
+    def __init__(self, board_ui, corner='topleft'):
+        """
+        :param board_ui: the board to draw on
+        :param corner: str: the corner of the board the panel is placed in, 'topleft' or 'bottomleft'
+        """
+
+        self.board_ui = board_ui
+        self.corner = corner
+        self.font = pg.font.SysFont('arial', 18)
+        self.render = None  # the text last rendered, along with its line surfaces and the panel rect
+
+    def get_render(self, text) -> tuple:
+        if self.render is None or self.render[0] != text:
+            line_renders = [self.font.render(line, True, (0, 0, 0)) for line in text.split('\n')]
+            width = max(line_render.get_width() for line_render in line_renders)
+            height = sum(line_render.get_height() for line_render in line_renders)
+            rect = pg.Rect(0, 0, width + 12, height + 8)
+            board_rect = self.board_ui.image.get_rect().inflate(-8, -8)
+            setattr(rect, self.corner, getattr(board_rect, self.corner))
+            self.render = text, line_renders, rect
+        return self.render[1:]
+
+    def get_rect(self, text) -> pg.Rect:
+        return self.get_render(text)[1]
+
+    def draw(self, text) -> pg.Rect:
+        line_renders, rect = self.get_render(text)
+        pg.draw.rect(self.board_ui.image, (255, 255, 255), rect, border_radius=6)
+        y = rect.top + 4
+        for line_render in line_renders:
+            self.board_ui.image.blit(line_render, (rect.left + 6, y))
+            y += line_render.get_height()
+        return rect
@@ -0,0 +1,199 @@
+"""
+Searching on a background thread
+
+The pygame loop can't wait for a search to finish without freezing the window, so EngineWorker runs searches on a
+thread of its own with its own Engine. Positions are handed over packed by Engine.get_position, and the progress of
+each iteration and the chosen move are passed to callbacks on the worker thread. The UI turns them into pygame events,
+which can be posted from any thread.
+
+Each request gets a search id, and the callbacks of a search that was cancelled or replaced are never called, so a
+late result can't be applied to the wrong position.
+"""
+import queue
+import threading
+import time
+
+import engine
+import search
+
+
+class EngineWorker:
+    def __init__(self, on_progress=None, on_best_move=None, table=None, tablebase=None):
+        """
+        :param on_progress: callable: called with the search id and the stats dict of each finished iteration
+        :param on_best_move: callable: called with the search id, the best move (None when there are no legal moves)
+            and the stats dict when a search ends
+        :param table: TranspositionTable: the table kept between searches, a new one is made by default
+        :param tablebase: Tablebase: endgame tables for the search, see tablebase.py
+        """
+
+        self.on_progress = on_progress
+        self.on_best_move = on_best_move
+
+        self.engine = engine.Engine()
+        self.searcher = search.Searcher(self.engine, table, tablebase)
+
+        self._requests = queue.Queue()
+        self._lock = threading.Lock()
+        self._search_id = 0  # the id of the newest request, results of older requests are dropped
+        self._pondering = False
+        self._ponder_time_limits = None  # the time limits of the ponder search, they start at the ponder hit
+        self._ponder_hit_time = None  # when the ponder hit came, until its time limits are set on the search
+        self._iterated = False  # whether the newest search finished an iteration, so it has set its own deadlines
+        self._move_now = False  # whether the newest search is to stop, even if it hasn't started yet
+        self._ponder_result = None  # the result of a ponder search that ended before the ponder hit
+
+        self._thread = threading.Thread(target=self._run, name='engine-worker', daemon=True)
+        self._thread.start()
+
+    def go(self, position, time_limit=None, max_depth=search.MAX_DEPTH, soft_time_limit=None) -> int:
+        """
+        Start searching a position, replacing any search that is running
+
+        :param position: bytes: the position packed by Engine.get_position
+        :param time_limit: float: the number of seconds the search may take, unlimited by default
+        :param max_depth: int: the deepest iteration to search
+        :param soft_time_limit: float: the number of seconds after which no new iteration is started
+        :return: int: the id of the search, passed to the callbacks
+        """
+
+        return self._request(position, None, (time_limit, soft_time_limit), max_depth, False)
+
+    def ponder(self, position, expected_move, time_limit=None, max_depth=search.MAX_DEPTH,
+               soft_time_limit=None) -> int:
+        """
+        Search the position after the opponent's expected reply while the opponent thinks
+
+        The search runs without a time limit and its move isn't reported until ponder_hit is called, which happens
+        when the opponent plays the expected move. Otherwise call go with the new position.
+
+        :param position: bytes: the position packed by Engine.get_position, with the opponent to move
+        :param expected_move: int: the packed move the opponent is expected to play
+        :param time_limit: float: the number of seconds the search may take once the expected move is played
+        :param max_depth: int: the deepest iteration to search
+        :param soft_time_limit: float: the number of seconds after the expected move is played after which no new
+            iteration is started
+        :return: int: the id of the search
+        """
+
+        return self._request(position, expected_move, (time_limit, soft_time_limit), max_depth, True)
+
+    def ponder_hit(self) -> bool:
+        """
+        Turn the ponder search into a normal search, as the opponent played the expected move
+
+        :return: bool: False if no ponder search is running
+        """
+
+        with self._lock:
+            if not self._pondering:
+                return False
+            self._pondering = False
+            result = self._ponder_result
+            self._ponder_result = None
+            if result is None:
+                # the search keeps the iterations it finished while pondering, the time limit starts now. A search
+                # that hasn't finished an iteration may not have started, and would reset the limits when it does,
+                # so they are set after its first iteration instead
+                self._ponder_hit_time = time.perf_counter()
+                if self._iterated:
+                    self._set_ponder_time_limits()
+
+        if result is not None:
+            self._report_best_move(*result)
+        return True
+
+    def move_now(self) -> None:
+        """Stop the search, reporting the best move found so far"""
+
+        with self._lock:
+            if self._pondering:
+                return  # the opponent hasn't moved yet, so there is nothing to play
+            # a search that hasn't started would reset the stop flag, so it stops after its first iteration
+            self._move_now = True
+            self.searcher.stop()
+
+    def cancel(self) -> None:
+        """Stop the search without reporting its move"""
+
+        with self._lock:
+            self._search_id += 1
+            self._pondering = False
+            self._ponder_hit_time = None
+            self._ponder_result = None
+            self.searcher.stop()
+
+    def close(self) -> None:
+        """Cancel the search and end the thread"""
+
+        self.cancel()
+        self._requests.put(None)
+        self._thread.join()
+
+    def _request(self, position, expected_move, time_limits, max_depth, ponder) -> int:
+        with self._lock:
+            self._search_id += 1
+            search_id = self._search_id
+            self._pondering = ponder
+            self._ponder_time_limits = time_limits
+            self._ponder_hit_time = None
+            self._iterated = False
+            self._move_now = False
+            self._ponder_result = None
+            self.searcher.stop()
+        self._requests.put((search_id, position, expected_move, (None, None) if ponder else time_limits, max_depth))
+        return search_id
+
+    def _is_current(self, search_id) -> bool:
+        return search_id == self._search_id
+
+    def _set_ponder_time_limits(self) -> None:
+        """Start the time limits of the ponder search from the ponder hit, called with the lock held"""
+
+        elapsed = time.perf_counter() - self._ponder_hit_time
+        self._ponder_hit_time = None
+        self.searcher.set_time_limit(*(None if limit is None else limit - elapsed
+                                       for limit in self._ponder_time_limits))
+
+    def _run(self) -> None:
+        while True:
+            request = self._requests.get()
+            if request is None:
+                return
+
+            search_id, position, expected_move, (time_limit, soft_time_limit), max_depth = request
+            if not self._is_current(search_id):
+                continue  # replaced before it started
+
+            self.engine.set_position(position)
+            if expected_move is not None:
+                self.engine.move_maker.apply_move(expected_move)
+
+            def on_iteration(stats, search_id=search_id):
+                with self._lock:
+                    if not self._is_current(search_id):
+                        # the request was replaced before the search reset its stop flag
+                        self.searcher.stop()
+                        return
+                    self._iterated = True
+                    if self._ponder_hit_time is not None:
+                        self._set_ponder_time_limits()
+                    if self._move_now:
+                        self.searcher.stop()
+                if self.on_progress is not None:
+                    self.on_progress(search_id, stats)
+
+            best_move = self.searcher.search(max_depth, time_limit, on_iteration, soft_time_limit=soft_time_limit)
+
+            with self._lock:
+                if not self._is_current(search_id):
+                    continue
+                if self._pondering:
+                    # a ponder search that ends early, e.g. on finding a mate, waits for the opponent's move
+                    self._ponder_result = (search_id, best_move, self.searcher.get_stats())
+                    continue
+            self._report_best_move(search_id, best_move, self.searcher.get_stats())
+
+    def _report_best_move(self, search_id, best_move, stats) -> None:
+        if self.on_best_move is not None:
+            self.on_best_move(search_id, best_move, stats)
@@ -0,0 +1,46 @@
+"""
+Zobrist keys for identifying positions
+
+A position key is the XOR of one random 64-bit number for each piece on its square, one for the castling rights, one for
+the file of the en passant square and one when black is to move. The en passant file only counts when a pawn of the side
+to move can capture onto the square, so that a double push nobody can answer en passant doesn't keep the key from
+matching the same position reached another way. Making a move only changes a few of these terms, so the engine keeps its
+key up to date by XOR-ing the changed terms in and out.
+"""
+import random
+
+from bitboard import PAWN_ATTACKS
+
+_random = random.Random(0x5eed)  # fixed seed so keys are the same in every process and on every run
+
+PIECE_KEYS = {
+    f"{color}{piece_type}": tuple(_random.getrandbits(64) for _ in range(64))
+    for color in 'wb' for piece_type in 'pnbrqk'
+}
+# indexed by castling rights, a bit mask of K=1, Q=2, k=4 and q=8
+CASTLING_KEYS = tuple(_random.getrandbits(64) for _ in range(16))
+EP_KEYS = tuple(_random.getrandbits(64) for _ in range(8))
+SIDE_KEY = _random.getrandbits(64)
+
+
+def get_key(engine) -> int:
+    """
+    Compute the key of the engine's position from scratch
+
+    :param engine: the engine holding the position
+    :return: int: the 64-bit position key
+    """
+
+    key = 0
+    for sq, piece in enumerate(engine.squares):
+        if piece != '--':
+            key ^= PIECE_KEYS[piece][sq]
+
+    key ^= CASTLING_KEYS[engine.castling_rights]
+    if engine.ep_square:
+        ep = engine.ep_square[0] * 8 + engine.ep_square[1]
+        if PAWN_ATTACKS[engine.enemy_color][ep] & engine.pieces[f"{engine.current_color}p"]:
+            key ^= EP_KEYS[ep & 7]
+    if engine.current_color == 'b':
+        key ^= SIDE_KEY
+    return key